@@ -0,0 +1,153 @@
+"""Benchmark the StackPath Authenticator against the local API stand-in.
+
+Runs the real ``Authenticator.perform`` and ``cleanup`` for certificates of 1, 10, 100
+and 1000 names, and reports the wall time of each phase and the API requests made.
+
+    python benchmarks/run_benchmarks.py --latency 0.05 --json results.json
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from unittest import mock
+
+import josepy as jose
+import pystackpath
+from acme import challenges
+from certbot import achallenges
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stackpath_server import StackPathServer  # noqa: E402 pylint: disable=wrong-import-position
+from stackpath_server import StackPathState  # noqa: E402 pylint: disable=wrong-import-position
+
+from certbot_dns_stackpath._internal import client  # noqa: E402 pylint: disable=wrong-import-position
+from certbot_dns_stackpath._internal import dns_stackpath  # noqa: E402 pylint: disable=wrong-import-position
+
+ZONE = 'example.com'
+# Zones besides the certificate's, so that lookups are made against a realistic stack.
+OTHER_ZONES = 200
+
+
+def make_config(tempdir, server, args):
+    """Build the Certbot configuration used by the Authenticator."""
+    credentials = os.path.join(tempdir, 'stackpath.ini')
+    with open(credentials, 'w') as f:
+        f.write('dns_stackpath_client_id = benchmark\n'
+                'dns_stackpath_client_secret = benchmark\n'
+                'dns_stackpath_stack_id = benchmark-stack\n')
+    os.chmod(credentials, 0o600)
+
+    options = {
+        'credentials': credentials,
+        'propagation_seconds': 0,
+        'propagation_check': False,
+        'adaptive_propagation': False,
+        'adaptive_percentile': 95,
+        'adaptive_margin': 5,
+        'token_cache': False,
+        'zone_cache_ttl': 3600,
+        'zone_cache': False,
+        'shared_state': False,
+        'zone_discovery': args.zone_discovery,
+        'persistent_records': False,
+        'cleanup_placeholder': None,
+        'deferred_cleanup': False,
+        'max_retries': 4,
+        'rate_limit': 0,
+        'metrics_file': None,
+        'max_workers': args.max_workers,
+        'pool_size': None,
+        'connect_timeout': 10,
+        'read_timeout': 30,
+        'operation_timeout': 120,
+    }
+    config = mock.MagicMock(work_dir=tempdir, config_dir=tempdir, logs_dir=tempdir)
+    for name, value in options.items():
+        setattr(config, f'dns_stackpath_{name}', value)
+    return config
+
+
+def make_achalls(count, account_key):
+    """Build ``count`` dns-01 challenges for names under the benchmark zone."""
+    return [achallenges.KeyAuthorizationAnnotatedChallenge(
+        challb=challenges.DNS01(token=os.urandom(16)),
+        domain=f'host{index}.{ZONE}', account_key=account_key)
+        for index in range(count)]
+
+
+def run(size, server, account_key, args):
+    """Perform and clean up ``size`` challenges, returning the measurements."""
+    with tempfile.TemporaryDirectory() as tempdir:
+        config = make_config(tempdir, server, args)
+        authenticator = dns_stackpath.Authenticator(config, 'dns-stackpath')
+        achalls = make_achalls(size, account_key)
+        server.state.reset_counters()
+
+        start = time.monotonic()
+        authenticator.perform(achalls)
+        performed = time.monotonic()
+        authenticator.cleanup(achalls)
+        cleaned_up = time.monotonic()
+
+    requests = sorted(server.state.requests.items())
+    return {
+        'names': size,
+        'perform_seconds': round(performed - start, 3),
+        'cleanup_seconds': round(cleaned_up - performed, 3),
+        'requests': sum(count for _, count in requests),
+        'requests_by_endpoint': [
+            {'method': method, 'endpoint': endpoint, 'status': status, 'count': count}
+            for (method, endpoint, status), count in requests
+        ],
+    }
+
+
+def main():
+    """Run the benchmarks and print their results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100, 1000])
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds of latency added to every API response.')
+    parser.add_argument('--rate-limit', type=float, default=0.0,
+                        help='API requests per second before the stand-in answers 429.')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Probability of the stand-in answering with a 503.')
+    parser.add_argument('--max-workers', type=int, default=10)
+    parser.add_argument('--zone-discovery', choices=dns_stackpath.ZONE_DISCOVERY_MODES,
+                        default='filter')
+    parser.add_argument('--json', help='Also write the results to this file.')
+    args = parser.parse_args()
+
+    zones = [ZONE] + [f'zone{index}.example.org' for index in range(OTHER_ZONES)]
+    state = StackPathState(zones, latency=args.latency, rate_limit=args.rate_limit,
+                           error_rate=args.error_rate)
+    server = StackPathServer(state).start()
+    account_key = jose.JWKRSA(key=rsa.generate_private_key(
+        public_exponent=65537, key_size=2048, backend=default_backend()))
+
+    results = []
+    try:
+        with mock.patch.object(pystackpath, 'BASE_URL', server.url), \
+                mock.patch.object(client, 'TOKEN_URL',
+                                  server.url + '/identity/v1/oauth2/token'):
+            for size in args.sizes:
+                results.append(run(size, server, account_key, args))
+                print(f"{size:>5} names: perform {results[-1]['perform_seconds']:>8.3f} s, "
+                      f"cleanup {results[-1]['cleanup_seconds']:>8.3f} s, "
+                      f"{results[-1]['requests']:>6} API requests")
+    finally:
+        server.stop()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'latency': args.latency, 'max_workers': args.max_workers,
+                       'zone_discovery': args.zone_discovery, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
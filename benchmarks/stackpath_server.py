@@ -0,0 +1,265 @@
+"""Local stand-in for the parts of the StackPath API used by the plugin.
+
+It implements the OAuth token exchange and the DNS zone and record endpoints, keeps
+everything in memory, and can add latency, enforce a rate limit and inject server
+errors. Every request is counted by endpoint and status.
+
+Run it on its own with ``python benchmarks/stackpath_server.py --port 8080``.
+"""
+import argparse
+import collections
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+ZONES_PATH = re.compile(r'^/dns/v1/stacks/(?P<stack>[^/]+)/zones$')
+RECORDS_PATH = re.compile(r'^/dns/v1/stacks/(?P<stack>[^/]+)/zones/(?P<zone>[^/]+)/records$')
+RECORD_PATH = re.compile(
+    r'^/dns/v1/stacks/(?P<stack>[^/]+)/zones/(?P<zone>[^/]+)/records/(?P<record>[^/]+)$')
+FILTER_CLAUSE = re.compile(r'''(\w+)\s*=\s*(["'])(.*?)\2''')
+
+
+class StackPathState:
+    """
+    The zones and records served, and the behavior of the server.
+
+    :param list zones: Domains of the zones to create.
+    :param float latency: Seconds added to every response.
+    :param float rate_limit: Requests per second allowed before answering 429 (0: no limit).
+    :param float error_rate: Probability of answering a request with a 503.
+    :param int token_ttl: Lifetime of the OAuth tokens, in seconds.
+    """
+
+    def __init__(self, zones=(), latency=0.0, rate_limit=0.0, error_rate=0.0, token_ttl=3600):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.token_ttl = token_ttl
+        self.lock = threading.Lock()
+        self.zones = collections.OrderedDict()  # type: collections.OrderedDict
+        self.records = {}  # type: dict
+        self.tokens = set()  # type: set
+        self.requests = collections.Counter()  # type: collections.Counter
+        self._allowance = rate_limit
+        self._allowance_updated = time.monotonic()
+        for domain in zones:
+            self.add_zone(domain)
+
+    def add_zone(self, domain):
+        """Create a zone and return its ID."""
+        zone_id = str(uuid.uuid4())
+        self.zones[zone_id] = {'id': zone_id, 'domain': domain,
+                               'nameservers': ['ns1.example.net', 'ns2.example.net']}
+        self.records[zone_id] = collections.OrderedDict()
+        return zone_id
+
+    def reset_counters(self):
+        """Forget the requests counted so far."""
+        with self.lock:
+            self.requests.clear()
+
+    def throttled(self):
+        """Whether the rate limit is exceeded by the current request."""
+        if not self.rate_limit:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            self._allowance = min(self.rate_limit, self._allowance
+                                  + (now - self._allowance_updated) * self.rate_limit)
+            self._allowance_updated = now
+            if self._allowance < 1:
+                return True
+            self._allowance -= 1
+            return False
+
+
+class StackPathHandler(BaseHTTPRequestHandler):
+    """Answers StackPath API requests from the server's `StackPathState`."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def do_GET(self):  # pylint: disable=missing-function-docstring
+        self._handle('GET')
+
+    def do_POST(self):  # pylint: disable=missing-function-docstring
+        self._handle('POST')
+
+    def do_PATCH(self):  # pylint: disable=missing-function-docstring
+        self._handle('PATCH')
+
+    def do_DELETE(self):  # pylint: disable=missing-function-docstring
+        self._handle('DELETE')
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def _handle(self, method):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else {}
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if self.state.latency:
+            time.sleep(self.state.latency)
+
+        if self.state.throttled():
+            self._respond(method, url.path, 429, {'error': 'rate limited'}, {'Retry-After': '1'})
+        elif self.state.error_rate and random.random() < self.state.error_rate:
+            self._respond(method, url.path, 503, {'error': 'injected error'})
+        elif url.path == '/identity/v1/oauth2/token' and method == 'POST':
+            token = uuid.uuid4().hex
+            with self.state.lock:
+                self.state.tokens.add(token)
+            self._respond(method, url.path, 200, {'access_token': token,
+                                                  'token_type': 'bearer',
+                                                  'expires_in': self.state.token_ttl})
+        elif self.headers.get('Authorization', '')[len('Bearer '):] not in self.state.tokens:
+            self._respond(method, url.path, 401, {'error': 'unauthorized'})
+        else:
+            self._route(method, url.path, query, body)
+
+    def _route(self, method, path, query, body):
+        match = ZONES_PATH.match(path)
+        if match and method == 'GET':
+            with self.state.lock:
+                zones = [zone for zone in self.state.zones.values()
+                         if _matches(zone, query.get('page_request.filter'))]
+            page, page_info = _paginate(zones, query)
+            return self._respond(method, path, 200, {'zones': page, 'pageInfo': page_info})
+
+        match = RECORDS_PATH.match(path) or RECORD_PATH.match(path)
+        if not match or match.group('zone') not in self.state.records:
+            return self._respond(method, path, 404, {'error': 'not found'})
+        zone_id = match.group('zone')
+        record_id = match.groupdict().get('record')
+
+        with self.state.lock:
+            records = self.state.records[zone_id]
+            if record_id is None and method == 'GET':
+                found = [record for record in records.values()
+                         if _matches(record, query.get('page_request.filter'))]
+                status, data = 200, None
+            elif record_id is None and method == 'POST':
+                record = dict(body, id=str(uuid.uuid4()), zoneId=zone_id)
+                records[record['id']] = record
+                status, data = 200, {'record': record}
+            elif record_id not in records:
+                status, data = 404, {'error': 'not found'}
+            elif method == 'GET':
+                status, data = 200, {'record': records[record_id]}
+            elif method == 'PATCH':
+                records[record_id].update(body)
+                status, data = 200, {'record': records[record_id]}
+            elif method == 'DELETE':
+                del records[record_id]
+                status, data = 204, {}
+            else:
+                status, data = 405, {'error': 'method not allowed'}
+
+        if data is None:
+            page, page_info = _paginate(found, query)
+            data = {'records': page, 'pageInfo': page_info}
+        return self._respond(method, path, status, data)
+
+    def _respond(self, method, path, status, data, headers=None):
+        endpoint = re.sub(r'/[0-9a-f]{8}-[0-9a-f-]{27}', '/{id}', path)
+        with self.state.lock:
+            self.state.requests[(method, endpoint, status)] += 1
+
+        content = json.dumps(data).encode() if status != 204 else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def _matches(item, query_filter):
+    """Evaluate a filter made of ``key="value"`` clauses joined by ``and``."""
+    if not query_filter:
+        return True
+    return all(str(item.get(key)) == value
+               for key, _, value in FILTER_CLAUSE.findall(query_filter))
+
+
+def _paginate(items, query):
+    start = int(query.get('page_request.after') or 0)
+    size = int(query.get('page_request.first') or 50)
+    page = items[start:start + size]
+    end = start + len(page)
+    return page, {'totalCount': str(len(items)), 'hasPreviousPage': start > 0,
+                  'hasNextPage': end < len(items), 'startCursor': str(start),
+                  'endCursor': str(end)}
+
+
+class StackPathServer(ThreadingHTTPServer):
+    """
+    HTTP server emulating the StackPath API, serving on ``url``.
+
+    :param StackPathState state: The zones, records and behavior of the server.
+    :param int port: The port to listen on; 0 picks a free one.
+    """
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients closing idle keep-alive connections are expected, not worth a traceback.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super(StackPathServer, self).handle_error(request, client_address)
+
+    def __init__(self, state, port=0):
+        super(StackPathServer, self).__init__(('127.0.0.1', port), StackPathHandler)
+        self.state = state
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        """Serve requests from a background thread."""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the socket."""
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    """Run the server in the foreground."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--zone', action='append', default=[], help='Zone to create.')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    state = StackPathState(args.zone or ['example.com'], latency=args.latency,
+                           rate_limit=args.rate_limit, error_rate=args.error_rate)
+    server = StackPathServer(state, args.port)
+    print(f'Serving the StackPath API stand-in on {server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -13,6 +13,100 @@ Named Arguments
                                           to propagate before asking the ACME
                                           server to verify the DNS record.
                                           (Default: 10)
+``--dns-stackpath-propagation-check``    Poll the zones' authoritative
+                                          nameservers and stop waiting as soon
+                                          as every TXT record is visible,
+                                          waiting at most the propagation
+                                          seconds. Requires the
+                                          ``propagation`` extra (dnspython).
+                                          (Default: off)
+``--dns-stackpath-adaptive-propagation``
+                                          Poll the authoritative nameservers,
+                                          but wait at least as long as TXT
+                                          records usually take to become
+                                          visible in the zones, as recorded by
+                                          previous runs; waiting at most the
+                                          propagation seconds. Requires the
+                                          ``propagation`` extra (dnspython).
+                                          (Default: off)
+``--dns-stackpath-adaptive-percentile``  The percentile of the propagation
+                                          times observed in a zone adaptive
+                                          waits are based on. (Default: 95)
+``--dns-stackpath-adaptive-margin``      The number of seconds added to
+                                          adaptive waits. (Default: 5)
+``--dns-stackpath-token-cache``          Cache the StackPath OAuth token under
+                                          Certbot's work directory and reuse it
+                                          across invocations until it expires.
+                                          (Default: off)
+``--dns-stackpath-zone-cache-ttl``       The number of seconds zone lookups
+                                          are cached for; 0 disables caching.
+                                          (Default: 3600)
+``--dns-stackpath-zone-cache``           Persist cached zone lookups under
+                                          Certbot's work directory and share
+                                          them across invocations.
+                                          (Default: off)
+``--dns-stackpath-shared-state``         Coordinate with the other Certbot
+                                          processes of this host through
+                                          Certbot's work directory: share the
+                                          OAuth token, zone lookups and the
+                                          rate limit budget, and hold back
+                                          every process when one is throttled.
+                                          Implies the token and zone caches.
+                                          (Default: off)
+``--dns-stackpath-zone-discovery``       ``filter`` looks up each candidate
+                                          zone name, ``list`` lists all zones
+                                          of the stacks once and matches
+                                          domains locally. (Default: filter)
+``--dns-stackpath-persistent-records``   Keep one TXT record per validation
+                                          name across runs, remembering its ID
+                                          under Certbot's work directory, and
+                                          update its content for each
+                                          challenge instead of creating and
+                                          deleting records. (Default: off)
+``--dns-stackpath-cleanup-placeholder``  With persistent records, set them to
+                                          this content on cleanup instead of
+                                          leaving the last validation.
+``--dns-stackpath-deferred-cleanup``     Queue the TXT records for deletion
+                                          under Certbot's work directory and
+                                          delete them in the background, before
+                                          Certbot exits; records that could not
+                                          be deleted are retried by the next
+                                          run. (Default: off)
+``--dns-stackpath-max-retries``          The number of times a throttled or
+                                          failed StackPath API call is retried,
+                                          with exponential backoff.
+                                          (Default: 4)
+``--dns-stackpath-rate-limit``           The maximum number of StackPath API
+                                          calls made per second; 0 for no
+                                          limit. (Default: 0)
+``--dns-stackpath-metrics-file``         Write counts and timings of the
+                                          StackPath API calls and of the
+                                          propagation wait to this file: JSON,
+                                          or the Prometheus text format if the
+                                          name ends in ``.prom``.
+``--dns-stackpath-max-workers``          The maximum number of StackPath API
+                                          calls made concurrently while
+                                          creating or deleting TXT records;
+                                          they are made on an asyncio session
+                                          with the ``async`` extra (aiohttp),
+                                          otherwise on as many threads.
+                                          (Default: 10)
+``--dns-stackpath-pool-size``            The maximum number of HTTP
+                                          connections kept open to the
+                                          StackPath API. (Default: the maximum
+                                          number of workers)
+``--dns-stackpath-connect-timeout``      The number of seconds to wait for a
+                                          connection to the StackPath API.
+                                          (Default: 10)
+``--dns-stackpath-read-timeout``         The number of seconds to wait for
+                                          each StackPath API response.
+                                          (Default: 30)
+``--dns-stackpath-operation-timeout``    The number of seconds a StackPath API
+                                          call may take, retries included. A
+                                          request still running then is
+                                          abandoned with the ``async`` extra;
+                                          otherwise each wait for the API is
+                                          cut to the time left. (Default: 120)
 ========================================  =====================================
 
 
@@ -36,6 +130,14 @@ python module.
    dns_stackpath_client_secret = 0123456789abcdef0123456789abcdef012340123456789abcdef0123456789abcdef01234
    dns_stackpath_stack_id = f92247a9-a539-4711-b86e-5ad6f03e32c4
 
+To issue certificates for zones in several stacks, list their IDs separated by
+commas. The zone of each domain is searched for in every stack; a zone present
+in more than one stack is taken from the first one listed.
+
+.. code-block:: ini
+
+   dns_stackpath_stack_id = f92247a9-a539-4711-b86e-5ad6f03e32c4, my-other-stack-def456
+
 The path to this file can be provided interactively or using the
 ``--dns-stackpath-credentials`` command-line argument. Certbot records the path
 to this file for use during renewal, but does not store the file's contents.
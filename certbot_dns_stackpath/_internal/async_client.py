@@ -0,0 +1,544 @@
+"""asyncio client for the parts of the StackPath API used by the plugin."""
+import asyncio
+import concurrent.futures
+import functools
+import json
+import logging
+
+import pystackpath
+import requests
+from certbot.plugins import dns_common
+
+from certbot import errors
+from certbot_dns_stackpath._internal.client import _quote
+from certbot_dns_stackpath._internal.client import _Zone
+from certbot_dns_stackpath._internal.client import RECORD_PAGE_SIZE
+from certbot_dns_stackpath._internal.client import ZONE_PAGE_SIZE
+from certbot_dns_stackpath._internal.zone_index import ZoneIndex
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+
+def available():
+    """
+    Whether `AsyncStackPathClient` is supported, which requires the optional ``aiohttp``.
+
+    :rtype: bool
+    """
+    return aiohttp is not None
+
+
+class AsyncStackPathClient:
+    """
+    Makes the StackPath API calls of the plugin as coroutines, on an aiohttp session.
+
+    The configuration comes from a `_StackPathClient`: the stacks, zone discovery mode, zone
+    cache, retry policy, metrics, record journal and timeouts. The OAuth token is shared with
+    it too, and obtained through it, as the token cache may block on a lock file. That, the
+    rate limiter and the other local files are handled on the loop's default executor; every
+    API call is made on the aiohttp session, with at most ``max_connections`` calls in flight
+    and ``pool_size`` connections open at once.
+
+    The client is bound to the event loop it is first used on, and must be closed with
+    `close` on that loop.
+
+    :param _StackPathClient client: The client whose configuration and token are used.
+    :param int max_connections: The maximum number of concurrent API calls.
+    :param int pool_size: The maximum number of connections open to the API; defaults to
+        ``max_connections``.
+    """
+
+    def __init__(self, client, max_connections=10, pool_size=None):
+        self.client = client
+        self.max_connections = max(1, max_connections)
+        self.pool_size = max(1, pool_size or max_connections)
+        self._session = None
+        self._slots = None
+        self._zone_executor = None
+        self._zone_index = None
+        self._zone_index_expires_at = 0.0
+        self._zone_index_lock = None
+        # zone name -> future of its lookup, so that concurrent lookups of a name share one
+        self._zone_lookups = {}  # type: dict
+
+    async def add_txt_record(self, domain, record_name, record_content, record_ttl, zone=None,
+                             journal=True):
+        """
+        Add a TXT record; see `_StackPathClient.add_txt_record`.
+
+        :returns: The zone the record was added to and the ID of the new record.
+        :rtype: tuple
+        :raises certbot.errors.PluginError: if an error occurs communicating with the StackPath API
+        """
+        if zone is None:
+            zone = await self.find_zone(domain)
+
+        payload = {
+            'name': zone.relative_name(record_name),
+            'type': 'TXT',
+            'ttl': record_ttl,
+            'data': record_content,
+            'weight': 0
+        }
+        attempted = []
+
+        async def add():
+            if attempted:
+                # The failed attempt may have created the record before failing, so look for
+                # it before creating it again.
+                record_ids = await self._find_txt_record_ids(zone, record_name, [record_content],
+                                                             strict=True)
+                if record_ids:
+                    logger.debug('TXT record was added by a failed attempt.')
+                    return record_ids[0]
+            attempted.append(True)
+            response = await self._send('POST', _records_path(zone), json_body=payload)
+            record = response.get('record')
+            if not isinstance(record, dict) or 'id' not in record:
+                raise _unexpected_response(_records_path(zone))
+            return record['id']
+
+        try:
+            logger.debug('Attempting to add record to zone %s: %s', zone.id, payload)
+            record_id = await self._call('records.add', add)
+        except requests.RequestException as e:
+            logger.error('Encountered error adding TXT record: %s', e)
+            raise errors.PluginError(f'Error adding TXT record to zone {zone.domain}: {e}')
+        logger.debug('Successfully added TXT record with record_id: %s', record_id)
+        if self.client.journal and journal:
+            await self._run_blocking(self.client.journal.record_added, zone, record_id,
+                                     record_name)
+        return zone, record_id
+
+    async def update_txt_record(self, zone, record_id, record_content, record_ttl):
+        """
+        Replace the content of a TXT record; see `_StackPathClient.update_txt_record`.
+
+        :returns: Whether the record was updated; ``False`` if it no longer exists.
+        :rtype: bool
+        :raises certbot.errors.PluginError: if an error occurs communicating with the StackPath API
+        """
+        payload = {'ttl': record_ttl, 'data': record_content}
+        try:
+            logger.debug('Attempting to update record %s of zone %s: %s',
+                         record_id, zone.id, payload)
+            await self._call('records.update', lambda: self._send(
+                'PATCH', f'{_records_path(zone)}/{record_id}', json_body=payload))
+        except requests.RequestException as e:
+            if _status(e) == 404:
+                logger.debug('TXT record %s no longer exists.', record_id)
+                return False
+            logger.error('Encountered error updating TXT record: %s', e)
+            raise errors.PluginError(f'Error updating TXT record in zone {zone.domain}: {e}')
+        logger.debug('Successfully updated TXT record.')
+        return True
+
+    async def del_txt_record(self, domain, record_name, record_content):
+        """Delete a TXT record after looking it up; see `_StackPathClient.del_txt_record`."""
+        await self.del_txt_records(domain, record_name, [record_content])
+
+    async def del_txt_records(self, domain, record_name, record_contents):
+        """Delete TXT records sharing a name; see `_StackPathClient.del_txt_records`."""
+        try:
+            zone = await self.find_zone(domain)
+        except errors.PluginError as e:
+            logger.debug('Encountered error finding zone_id during deletion: %s', e)
+            return
+
+        record_ids = await self._find_txt_record_ids(zone, record_name, record_contents)
+        await asyncio.gather(*[self.del_txt_record_by_id(zone, record_id)
+                               for record_id in record_ids])
+        if not record_ids:
+            logger.debug('TXT record not found; no cleanup needed.')
+
+    async def del_txt_record_by_id(self, zone, record_id):
+        """
+        Delete a TXT record by ID; see `_StackPathClient.del_txt_record_by_id`.
+
+        :returns: Whether the record is gone, i.e. was deleted or did not exist.
+        :rtype: bool
+        """
+        try:
+            await self._call('records.delete', lambda: self._send(
+                'DELETE', f'{_records_path(zone)}/{record_id}'))
+            logger.debug('Successfully deleted TXT record.')
+        except requests.RequestException as e:
+            if _status(e) != 404:
+                logger.warning('Encountered error deleting TXT record: %s', e)
+                return False
+            logger.debug('TXT record was already deleted.')
+        if self.client.journal:
+            await self._run_blocking(self.client.journal.record_deleted, zone, record_id)
+        return True
+
+    async def find_zone(self, domain):
+        """
+        Find the zone for a domain; see `_StackPathClient.find_zone`.
+
+        :rtype: _Zone
+        :raises certbot.errors.PluginError: if no zone is found, or a zone lookup failed.
+        """
+        if self.client.zone_discovery == 'list':
+            match = (await self._get_zone_index()).find(domain)
+            if match:
+                logger.debug('Found zone_id of %s for %s using name %s', match[0], domain, match[1])
+                return _Zone(*match)
+            raise errors.PluginError(f'Zone ID for domain {domain} not found')
+
+        for zone_name in dns_common.base_domain_name_guesses(domain):
+            zone = await self._lookup_zone(zone_name)
+            if zone['zone_id']:
+                logger.debug('Found zone_id of %s in stack %s for %s using name %s',
+                             zone['zone_id'], zone['stack_id'], domain, zone_name)
+                return _Zone(zone['zone_id'], zone['domain'], zone['stack_id'])
+        raise errors.PluginError(f'Zone ID for domain {domain} not found')
+
+    async def close(self):
+        """Close the connections of the session."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._zone_executor is not None:
+            self._zone_executor.shutdown(wait=True)
+            self._zone_executor = None
+
+    async def _lookup_zone(self, zone_name):
+        """
+        Look up the zone with the given name in every stack, consulting the zone cache first.
+
+        Concurrent lookups of the same name share the first one's API calls.
+
+        :rtype: dict
+        :raises certbot.errors.PluginError: if a stack could not be searched and the zone was
+            not found in the others.
+        """
+        zone_cache = self.client.zone_cache
+        if zone_cache:
+            zone = zone_cache.get(zone_name)
+            if zone and self._accept_zone(zone):
+                return zone
+
+        lookup = self._zone_lookups.get(zone_name)
+        if lookup is None:
+            lookup = self._zone_lookups[zone_name] = asyncio.ensure_future(
+                self._fetch_zone(zone_name))
+            lookup.add_done_callback(lambda unused: self._zone_lookups.pop(zone_name, None))
+        zone = await asyncio.shield(lookup)
+        return zone
+
+    async def _fetch_zone(self, zone_name):
+        """
+        Look up a zone through the zone cache's `ZoneCache.fetch`.
+
+        When the cache is persisted, it holds the zone name's lock file during the lookup
+        and re-reads the store, so concurrent processes wait for the first lookup instead
+        of repeating it. It blocks, so it runs on the client's own threads, which wait for
+        the lookup made on this loop: they must not be those of the default executor, which
+        the lookup itself may need.
+        """
+        zone_cache = self.client.zone_cache
+        if not zone_cache:
+            return await self._search_stacks(zone_name)
+
+        loop = asyncio.get_event_loop()
+
+        def search():
+            return asyncio.run_coroutine_threadsafe(self._search_stacks(zone_name),
+                                                    loop).result()
+
+        if self._zone_executor is None:
+            self._zone_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_connections, thread_name_prefix='stackpath-zones')
+        zone = await loop.run_in_executor(self._zone_executor, zone_cache.fetch, zone_name,
+                                          search, self._accept_zone)
+        return zone or {'zone_id': None, 'domain': None, 'stack_id': None}
+
+    def _accept_zone(self, zone):
+        # Entries cached before a stack was removed from the configuration are ignored.
+        return not zone['zone_id'] or zone.get('stack_id') in self.client.stack_ids
+
+    async def _search_stacks(self, zone_name):
+        logger.debug(f'Looking for {zone_name}')
+        stack_ids = self.client.stack_ids
+        results = await asyncio.gather(*[self._lookup_zone_in_stack(stack_id, zone_name)
+                                         for stack_id in stack_ids], return_exceptions=True)
+        for result, stack_id in zip(results, stack_ids):
+            if result is not None and not isinstance(result, BaseException):
+                return {'zone_id': result, 'domain': zone_name, 'stack_id': stack_id}
+        for result, stack_id in zip(results, stack_ids):
+            if isinstance(result, requests.RequestException):
+                raise errors.PluginError(f'Error looking up zone {zone_name} in stack '
+                                         f'{stack_id}: {result}')
+            if isinstance(result, BaseException):
+                raise result
+        return {'zone_id': None, 'domain': None, 'stack_id': None}
+
+    async def _lookup_zone_in_stack(self, stack_id, zone_name):
+        try:
+            zones, _ = await self._get_page(
+                'zones.lookup', f'/dns/v1/stacks/{stack_id}/zones', 'zones',
+                {'page_request.filter': f"domain='{zone_name}'"})
+        except requests.RequestException as e:
+            logger.debug('Encountered error looking up zone %s in stack %s: %s',
+                         zone_name, stack_id, e)
+            raise
+        return zones[0]['id'] if zones else None
+
+    async def _get_zone_index(self):
+        """
+        Return an index of all zones in the stacks, listing them on first use and again once
+        the index is older than the client's ``zone_index_ttl``.
+
+        :rtype: ZoneIndex
+        :raises certbot.errors.PluginError: if the zones could not be listed.
+        """
+        if self._zone_index_lock is None:
+            self._zone_index_lock = asyncio.Lock()
+        async with self._zone_index_lock:
+            loop = asyncio.get_event_loop()
+            if self._zone_index is None or (self.client.zone_index_ttl is not None
+                                            and loop.time() >= self._zone_index_expires_at):
+                stack_ids = self.client.stack_ids
+                listings = await asyncio.gather(*[self._list_stack_zones(stack_id)
+                                                  for stack_id in stack_ids])
+                index = ZoneIndex()
+                # Added last stack first, so that the first stack listed wins for a zone in
+                # several.
+                for stack_id, zones in reversed(list(zip(stack_ids, listings))):
+                    for zone in zones:
+                        index.add(zone['domain'], zone['id'], stack_id)
+                logger.debug('Listed %d zones in stacks %s', len(index), ', '.join(stack_ids))
+                self._zone_index = index
+                self._zone_index_expires_at = loop.time() + (self.client.zone_index_ttl or 0)
+            return self._zone_index
+
+    async def _list_stack_zones(self, stack_id):
+        zones = []
+        after = ''
+        while True:
+            params = {'page_request.first': str(ZONE_PAGE_SIZE)}
+            if after:
+                params['page_request.after'] = after
+            try:
+                page, after = await self._get_page('zones.list',
+                                                   f'/dns/v1/stacks/{stack_id}/zones', 'zones',
+                                                   params, fields=('id', 'domain'))
+            except requests.RequestException as e:
+                raise errors.PluginError(f'Error listing StackPath zones of stack {stack_id}: {e}')
+            zones.extend(page)
+            if after is None:
+                return zones
+
+    async def _find_txt_record_ids(self, zone, record_name, record_contents, strict=False):
+        """
+        Find the record_ids of the TXT records with the given name and contents; see
+        `_StackPathClient._find_txt_record_ids`.
+        """
+        query_filter = f'name="{_quote(zone.relative_name(record_name))}" and type="TXT"'
+        if len(record_contents) == 1:
+            query_filter += f' and data="{_quote(record_contents[0])}"'
+
+        found = {}  # type: dict
+        after = ''
+        try:
+            while len(found) < len(set(record_contents)):
+                params = {'page_request.first': str(RECORD_PAGE_SIZE),
+                          'page_request.filter': query_filter}
+                if after:
+                    params['page_request.after'] = after
+                records, after = await self._get_page('records.index', _records_path(zone),
+                                                      'records', params)
+                for record in records:
+                    content = record.get('data')
+                    if content in record_contents and content not in found:
+                        found[content] = record['id']
+                if after is None:
+                    break
+        except requests.RequestException as e:
+            if strict:
+                raise
+            logger.debug('Encountered error getting TXT record_id: %s', e)
+
+        record_ids = []
+        for record_content in record_contents:
+            if record_content in found:
+                record_ids.append(found.pop(record_content))
+            else:
+                logger.debug('Unable to find TXT record.')
+        return record_ids
+
+    async def _get_page(self, operation, path, key, params, fields=('id',)):
+        """
+        Get one page of an API listing.
+
+        :param str operation: The name the call is recorded under in the client's metrics.
+        :param str key: The key of the items in the response, e.g. ``zones``.
+        :param tuple fields: The fields every item must have.
+        :returns: The items of the page, and the cursor of the next page or ``None`` if it is
+            the last one.
+        :rtype: tuple
+        :raises requests.RequestException: if the call failed or its response is not a listing.
+        """
+        async def get():
+            response = await self._send('GET', path, params=params)
+            items = response.get(key)
+            pageinfo = response.get('pageInfo') or {}
+            if not isinstance(items, list) or not isinstance(pageinfo, dict) or not all(
+                    isinstance(item, dict) and all(field in item for field in fields)
+                    for item in items):
+                raise _unexpected_response(path)
+            return items, (pageinfo.get('endCursor') if pageinfo.get('hasNextPage') and items
+                           else None)
+        return await self._call(operation, get)
+
+    async def _call(self, operation, func, idempotent=True):
+        """
+        Make an API call, retrying it according to the client's retry policy.
+
+        :param str operation: The name the call is recorded under in the client's metrics.
+        :param callable func: Returns a coroutine making the API call.
+        :param bool idempotent: Whether the call may safely be repeated after a server error.
+        :raises requests.RequestException: if the call failed.
+        """
+        async def attempt():
+            with self.client.metrics.measure(operation):
+                return await func()
+        return await self.client.retry_policy.call_async(attempt, idempotent=idempotent)
+
+    async def _send(self, method, path, params=None, json_body=None):
+        """
+        Send one API request and return its decoded JSON response.
+
+        Errors are raised as their `requests` counterparts, so that they are retried and
+        reported as those of `_StackPathClient`. A request rejected with a 401 is repeated
+        once with a new token.
+
+        :raises requests.RequestException: if the request failed.
+        """
+        session = self._get_session()
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_connections)
+        token = await self._run_blocking(self.client.get_token)
+        url = pystackpath.BASE_URL + path
+        for attempt in range(2):
+            try:
+                async with self._slots, session.request(
+                        method, url, params=params, json=json_body,
+                        headers={'Authorization': f'Bearer {token}'}) as response:
+                    body = await response.read()
+                    if response.status == 401 and attempt == 0:
+                        token = await self._run_blocking(self.client.get_token, token)
+                        continue
+                    if response.status >= 400:
+                        raise _http_error(response, body)
+                    try:
+                        data = json.loads(body.decode()) if body else {}
+                    except ValueError as e:
+                        raise requests.RequestException(f'Invalid JSON response from {url}: {e}')
+                    if not isinstance(data, dict):
+                        raise _unexpected_response(url)
+                    return data
+            except asyncio.TimeoutError as e:
+                raise requests.Timeout(f'Timed out requesting {url}: {e!r}')
+            except aiohttp.ClientError as e:
+                raise requests.ConnectionError(f'Error requesting {url}: {e}')
+        raise AssertionError('unreachable')  # pragma: no cover
+
+    def _get_session(self):
+        if self._session is None:
+            connect_timeout, read_timeout = self.client.timeout
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout,
+                                              sock_read=read_timeout))
+        return self._session
+
+    async def _run_blocking(self, func, *args):
+        """Run a function doing local, blocking I/O on the loop's default executor."""
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+
+class ExecutorStackPathClient:
+    """
+    Exposes the operations of a `_StackPathClient` as coroutines, running its blocking calls
+    on a pool of at most ``max_connections`` threads.
+
+    This is the fallback used when the ``async`` extra (aiohttp) is not installed; it offers
+    the same coroutines as `AsyncStackPathClient`.
+
+    :param _StackPathClient client: The client performing the API calls.
+    :param int max_connections: The maximum number of concurrent API calls.
+    :param int pool_size: Ignored: the connections are those of the client's own pool.
+    """
+
+    def __init__(self, client, max_connections=10, pool_size=None):
+        self.client = client
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, max_connections), thread_name_prefix='stackpath')
+
+    async def add_txt_record(self, domain, record_name, record_content, record_ttl, zone=None,
+                             journal=True):
+        """Add a TXT record; see `_StackPathClient.add_txt_record`."""
+        return await self._call(self.client.add_txt_record, domain, record_name,
+                                record_content, record_ttl, zone=zone, journal=journal)
+
+    async def update_txt_record(self, zone, record_id, record_content, record_ttl):
+        """Replace the content of a TXT record; see `_StackPathClient.update_txt_record`."""
+        return await self._call(self.client.update_txt_record,
+                                zone, record_id, record_content, record_ttl)
+
+    async def del_txt_record(self, domain, record_name, record_content):
+        """Delete a TXT record after looking it up; see `_StackPathClient.del_txt_record`."""
+        return await self._call(self.client.del_txt_record, domain, record_name, record_content)
+
+    async def del_txt_records(self, domain, record_name, record_contents):
+        """Delete TXT records sharing a name; see `_StackPathClient.del_txt_records`."""
+        return await self._call(self.client.del_txt_records, domain, record_name, record_contents)
+
+    async def del_txt_record_by_id(self, zone, record_id):
+        """Delete a TXT record by ID; see `_StackPathClient.del_txt_record_by_id`."""
+        return await self._call(self.client.del_txt_record_by_id, zone, record_id)
+
+    async def find_zone(self, domain):
+        """Find the zone for a domain; see `_StackPathClient.find_zone`."""
+        return await self._call(self.client.find_zone, domain)
+
+    async def close(self):
+        """Stop the worker threads once pending calls have completed."""
+        self._executor.shutdown(wait=True)
+
+    async def _call(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor,
+                                          functools.partial(func, *args, **kwargs))
+
+
+def _records_path(zone):
+    return f'/dns/v1/stacks/{zone.stack_id}/zones/{zone.id}/records'
+
+
+def _http_error(response, body):
+    """Build the `requests.HTTPError` matching an aiohttp response."""
+    error_response = requests.Response()
+    error_response.status_code = response.status
+    error_response.reason = response.reason
+    error_response.url = str(response.url)
+    error_response.headers.update(response.headers)
+    error_response._content = body  # pylint: disable=protected-access
+    return requests.HTTPError(f'{response.status} Error: {response.reason} for url: '
+                              f'{error_response.url}', response=error_response)
+
+
+def _unexpected_response(url):
+    """Build the error raised for a response that is not shaped as expected."""
+    return requests.RequestException(f'Unexpected response from {url}')
+
+
+def _status(error):
+    response = getattr(error, 'response', None)
+    return response.status_code if response is not None else None
@@ -0,0 +1,376 @@
+"""On-disk caches shared between invocations of the StackPath plugin."""
+import collections
+import contextlib
+import hashlib
+import json
+import logging
+import math
+import threading
+import time
+
+from certbot.compat import filesystem
+from certbot.compat import os
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+
+class JSONFileStore:
+    """
+    A JSON document on disk, only readable by its owner and updated under an exclusive lock.
+
+    Updates replace the file in a single rename, so a crash cannot leave it half written,
+    and readers need no lock. Writers serialize on a separate lock file.
+
+    :param str path: The path of the file backing the store.
+    :param bool sync: Whether updates are flushed to disk before replacing the file; not
+        worth it for state that is cheap to lose and updated often.
+    """
+
+    def __init__(self, path, sync=True):
+        self.path = path
+        self.sync = sync
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Lock the store and yield its content as a dict.
+
+        Changes made to the dict are written back when the block exits without error. The
+        lock is held for the whole block, so concurrent processes serialize on it. A corrupt
+        file is moved aside to ``<path>.corrupt`` rather than saved over, and the block
+        starts from an empty dict.
+        """
+        with file_lock(self.path + '.lock'):
+            data = self._load()
+            if data is None:
+                filesystem.replace(self.path, self.path + '.corrupt')
+                logger.warning('Moved the corrupt file %s aside to %s.corrupt',
+                               self.path, self.path)
+                data = {}
+            yield data
+            replace_file(self.path, json.dumps(data), sync=self.sync)
+
+    def read(self):
+        """
+        Return the content of the store as a dict, empty if the file is missing or corrupt.
+
+        :rtype: dict
+        """
+        data = self._load()
+        if data is None:
+            logger.debug('Ignoring corrupt cache file %s', self.path)
+            return {}
+        return data
+
+    def _load(self):
+        """Return the content of the store, or None if the file is corrupt."""
+        try:
+            with open(self.path) as handle:
+                content = handle.read()
+        except FileNotFoundError:
+            return {}
+        try:
+            data = json.loads(content) if content else {}
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive lock on a file, created if needed, while the enclosed block runs.
+
+    :param str path: The path of the lock file.
+    """
+    fd = _open_private(path)
+    try:
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def replace_file(path, content, sync=True):
+    """
+    Replace the content of a file, so that readers see either the old or the new content.
+
+    The content is written to a temporary file next to it, which is then renamed over it.
+    Writers must serialize on a lock other than the file itself, as the rename replaces it.
+
+    :param str path: The path of the file.
+    :param str content: The new content of the file.
+    :param bool sync: Whether to flush the content to disk before renaming the file.
+    """
+    temp_path = path + '.tmp'
+    fd = filesystem.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as handle:
+        handle.write(content)
+        handle.flush()
+        if sync:
+            os.fsync(handle.fileno())
+    filesystem.replace(temp_path, path)
+
+
+def _open_private(path):
+    """Open a file for reading and writing, creating it and its directory for the owner only."""
+    if not os.path.isdir(os.path.dirname(path)):
+        filesystem.makedirs(os.path.dirname(path), 0o700)
+    return filesystem.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+
+class TokenCache:
+    """
+    Cache of StackPath OAuth tokens, keyed by client ID.
+
+    :param str path: The path of the cache file.
+    """
+
+    def __init__(self, path):
+        self._store = JSONFileStore(path)
+
+    def fetch(self, client_id, request_token, min_ttl=0):
+        """
+        Return a cached token for the client, obtaining a new one if none is usable.
+
+        The cache stays locked while ``request_token`` runs, so concurrent invocations wait
+        for the first one to authenticate instead of all authenticating at once.
+
+        :param str client_id: The StackPath client ID.
+        :param callable request_token: Called without arguments to obtain a new token; it must
+            return a ``(token, expires_at)`` tuple.
+        :param int min_ttl: Cached tokens expiring within this many seconds are not used.
+        :returns: A ``(token, expires_at)`` tuple.
+        :rtype: tuple
+        """
+        with self._store.transaction() as data:
+            entry = data.get(client_id)
+            if entry and entry['expires_at'] > time.time() + min_ttl:
+                logger.debug('Using cached StackPath OAuth token for %s', client_id)
+                return entry['token'], entry['expires_at']
+            token, expires_at = request_token()
+            data[client_id] = {'token': token, 'expires_at': expires_at}
+            return token, expires_at
+
+    def put(self, client_id, token, expires_at):
+        """
+        Store a token for the client.
+
+        :param str client_id: The StackPath client ID.
+        :param str token: The OAuth access token.
+        :param float expires_at: When the token expires, as a UNIX timestamp.
+        """
+        with self._store.transaction() as data:
+            data[client_id] = {'token': token, 'expires_at': expires_at}
+
+
+class PropagationHistory:
+    """
+    How long TXT records took to become visible on the nameservers of each zone.
+
+    The last ``max_samples`` observations of every zone are kept, and used to predict how
+    long the next records of the zone will take.
+
+    :param str path: The path of the history file.
+    :param int max_samples: Number of observations kept per zone.
+    """
+
+    def __init__(self, path, max_samples=50):
+        self.max_samples = max_samples
+        self._store = JSONFileStore(path)
+
+    def record(self, observations):
+        """
+        Record observations.
+
+        :param dict observations: Number of seconds records took to become visible, keyed by
+            zone domain.
+        """
+        with self._store.transaction() as data:
+            for zone_domain, seconds in observations.items():
+                samples = data.setdefault(zone_domain, [])
+                samples.append(round(seconds, 3))
+                del samples[:-self.max_samples]
+
+    def estimate(self, zone_domain, percentile, min_samples=5):
+        """
+        Return the given percentile of the observations of a zone.
+
+        :param str zone_domain: The zone's domain.
+        :param float percentile: The percentile, between 0 and 100.
+        :param int min_samples: Minimum number of observations needed for an estimate.
+        :returns: The number of seconds, or ``None`` if there are too few observations.
+        :rtype: float
+        """
+        samples = sorted(self._store.read().get(zone_domain, []))
+        if not samples or len(samples) < min_samples:
+            return None
+        # Nearest-rank method: the smallest sample at least ``percentile`` % of them reach.
+        rank = max(1, math.ceil(percentile / 100.0 * len(samples)))
+        return samples[min(rank, len(samples)) - 1]
+
+
+class RecordStore:
+    """
+    The IDs of the TXT records kept between invocations, keyed by record name.
+
+    Each name maps to a list of ``{"zone_id": ..., "zone_domain": ..., "stack_id": ...,
+    "record_id": ...}`` entries, one per record: a name validated for several challenges at
+    once, such as a domain and its wildcard, needs as many records.
+
+    :param str path: The path of the store file.
+    """
+
+    def __init__(self, path):
+        self._store = JSONFileStore(path)
+
+    def get(self, record_name):
+        """
+        Return the records kept for a name.
+
+        :param str record_name: The record name.
+        :rtype: list
+        """
+        return self._store.read().get(record_name, [])
+
+    def put(self, record_name, records):
+        """
+        Store the records kept for a name, replacing the previous ones.
+
+        :param str record_name: The record name.
+        :param list records: The entries of the records.
+        """
+        with self._store.transaction() as data:
+            data[record_name] = records
+
+
+class ZoneCache:
+    """
+    LRU cache of zone lookups, keyed by the zone name that was looked up.
+
+    Both hits (the zone ID and domain) and misses are cached; misses expire after at most
+    ``NEGATIVE_TTL`` seconds so that newly created zones are picked up quickly. When a path
+    is given, entries are also persisted there and shared with later and concurrent
+    invocations.
+
+    :param int ttl: Number of seconds a zone lookup is cached for.
+    :param str path: Optional path of the file persisting the cache.
+    :param int max_entries: Maximum number of entries kept in memory.
+    """
+
+    NEGATIVE_TTL = 300
+
+    def __init__(self, ttl, path=None, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._store = JSONFileStore(path) if path else None
+        self._entries = collections.OrderedDict()  # type: collections.OrderedDict
+        self._lock = threading.Lock()
+        self._lookup_locks = collections.defaultdict(threading.Lock)  # type: dict
+        if self._store:
+            now = time.time()
+            for name, entry in sorted(self._store.read().items(),
+                                      key=lambda item: item[1]['expires_at']):
+                if entry['expires_at'] > now:
+                    self._remember(name, entry)
+
+    def get(self, zone_name):
+        """
+        Look up a cached zone.
+
+        :param str zone_name: The zone name that was looked up.
+        :returns: ``None`` if the lookup is not cached, otherwise a dict with the ``zone_id``,
+            ``domain`` and ``stack_id`` of the zone, all ``None`` when the zone was not found.
+        :rtype: dict
+        """
+        with self._lock:
+            entry = self._entries.get(zone_name)
+            if entry is None:
+                return None
+            if entry['expires_at'] <= time.time():
+                del self._entries[zone_name]
+                return None
+            self._entries.move_to_end(zone_name)
+            return entry
+
+    def fetch(self, zone_name, lookup, accept=None):
+        """
+        Return the cached lookup of a zone name, looking it up on a miss.
+
+        A lookup holds a lock for the zone name, so concurrent threads missing the same name
+        wait for the first one to look it up and use its result. When the cache is persisted,
+        so do concurrent processes.
+
+        :param str zone_name: The zone name to look up.
+        :param callable lookup: Called without arguments on a miss; it must return a dict
+            with the ``zone_id``, ``domain`` and ``stack_id`` found, or ``None`` if the lookup
+            failed, in which case nothing is cached. Nothing is cached either if it raises.
+        :param callable accept: Optional predicate; cached entries it rejects are looked up
+            again.
+        :returns: The entry, as returned by `get`, or ``None`` if the lookup failed.
+        :rtype: dict
+        """
+        entry = self.get(zone_name)
+        if entry and (accept is None or accept(entry)):
+            return entry
+
+        with self._lock:
+            lookup_lock = self._lookup_locks[zone_name]
+        with lookup_lock:
+            entry = self.get(zone_name)
+            if entry and (accept is None or accept(entry)):
+                return entry
+            if not self._store:
+                return self._lookup(zone_name, lookup)
+
+            with file_lock(self._get_lock_path(zone_name)):
+                entry = self._store.read().get(zone_name)
+                if entry and entry['expires_at'] > time.time() \
+                        and (accept is None or accept(entry)):
+                    with self._lock:
+                        self._remember(zone_name, entry)
+                    return entry
+                return self._lookup(zone_name, lookup)
+
+    def _lookup(self, zone_name, lookup):
+        zone = lookup()
+        if zone is not None:
+            self.put(zone_name, zone['zone_id'], zone['domain'], zone['stack_id'])
+        return zone
+
+    def _get_lock_path(self, zone_name):
+        digest = hashlib.sha256(zone_name.encode()).hexdigest()[:16]
+        return os.path.join(os.path.dirname(self._store.path), 'locks', f'zone-{digest}.lock')
+
+    def put(self, zone_name, zone_id, domain, stack_id=None):
+        """
+        Cache the result of a zone lookup.
+
+        :param str zone_name: The zone name that was looked up.
+        :param str zone_id: The ID of the zone found, or ``None`` if there is no such zone.
+        :param str domain: The domain of the zone found, or ``None`` if there is no such zone.
+        :param str stack_id: The ID of the stack the zone was found in.
+        """
+        ttl = self.ttl if zone_id else min(self.ttl, self.NEGATIVE_TTL)
+        entry = {'zone_id': zone_id, 'domain': domain, 'stack_id': stack_id,
+                 'expires_at': time.time() + ttl}
+        with self._lock:
+            self._remember(zone_name, entry)
+        if self._store:
+            with self._store.transaction() as data:
+                data[zone_name] = entry
+                now = time.time()
+                for name in [name for name, value in data.items() if value['expires_at'] <= now]:
+                    del data[name]
+
+    def _remember(self, zone_name, entry):
+        self._entries[zone_name] = entry
+        self._entries.move_to_end(zone_name)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -0,0 +1,272 @@
+"""Command line interface: the challenge daemon, the manual hooks talking to it and batches."""
+import argparse
+import collections
+import concurrent.futures
+import json
+import logging
+import signal
+import sys
+import time
+
+from certbot import errors
+from certbot.compat import os
+from certbot.plugins import dns_common
+from certbot_dns_stackpath._internal import daemon
+from certbot_dns_stackpath._internal import retry
+from certbot_dns_stackpath._internal.cache import ZoneCache
+from certbot_dns_stackpath._internal.client import _StackPathClient
+from certbot_dns_stackpath._internal.client import _Zone
+from certbot_dns_stackpath._internal.dns_stackpath import journal_path
+from certbot_dns_stackpath._internal.dns_stackpath import ZONE_DISCOVERY_MODES
+from certbot_dns_stackpath._internal.journal import RecordJournal
+
+logger = logging.getLogger(__name__)
+
+# Certbot's default --work-dir.
+DEFAULT_WORK_DIR = '/var/lib/letsencrypt'
+
+
+def main(args=None):
+    """
+    Run the ``certbot-dns-stackpath`` command.
+
+    :param list args: The command line arguments, ``sys.argv[1:]`` by default.
+    :returns: The exit status.
+    :rtype: int
+    """
+    args = _get_parser().parse_args(args)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    try:
+        return args.func(args)
+    except errors.PluginError as e:
+        logger.error('%s', e)
+        return 1
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        prog='certbot-dns-stackpath',
+        description='Present dns-01 challenges through a long-running StackPath client.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log debug messages.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    serve = subparsers.add_parser(
+        'daemon', help='Keep an authenticated StackPath client and its zones in memory, and '
+                       'present and clean up challenges requested on a UNIX socket.')
+    _add_client_arguments(serve)
+    serve.add_argument('--socket', default=daemon.DEFAULT_SOCKET,
+                       help=f'The socket to listen on. (Default: {daemon.DEFAULT_SOCKET})')
+    serve.add_argument('--ttl', type=int, default=120,
+                       help='The TTL of the TXT records created, in seconds. (Default: 120)')
+    serve.set_defaults(func=_serve)
+
+    auth_hook = subparsers.add_parser(
+        'auth-hook', help='Present the challenge in $CERTBOT_DOMAIN and $CERTBOT_VALIDATION '
+                          'through the daemon; for use as a Certbot --manual-auth-hook.')
+    auth_hook.add_argument('--propagation-seconds', type=int, default=10,
+                           help='The number of seconds to wait for DNS to propagate once the '
+                                'record is created. (Default: 10)')
+    auth_hook.set_defaults(func=_hook, action='present')
+
+    cleanup_hook = subparsers.add_parser(
+        'cleanup-hook', help='Clean up the challenge in $CERTBOT_DOMAIN and '
+                             '$CERTBOT_VALIDATION through the daemon; for use as a Certbot '
+                             '--manual-cleanup-hook.')
+    cleanup_hook.set_defaults(func=_hook, action='cleanup', propagation_seconds=0)
+
+    sweep = subparsers.add_parser(
+        'sweep', help='Delete the TXT records created by the plugin or the daemon and never '
+                      'deleted, e.g. because Certbot was interrupted.')
+    _add_client_arguments(sweep)
+    sweep.add_argument('--min-age', type=int, default=3600,
+                       help='Only delete records created at least this many seconds ago, so '
+                            'that challenges in progress are left alone. (Default: 3600)')
+    sweep.add_argument('--max-workers', type=int, default=10,
+                       help='The maximum number of records deleted concurrently. (Default: 10)')
+    sweep.set_defaults(func=_sweep)
+
+    batch = subparsers.add_parser(
+        'batch', help='Present and clean up the challenges read from standard input as JSON '
+                      'lines, such as {"action": "present", "domain": ..., "validation": ...}, '
+                      'and write a JSON line with the result of each, in the same order.')
+    _add_client_arguments(batch)
+    batch.add_argument('--ttl', type=int, default=120,
+                       help='The TTL of the TXT records created, in seconds. (Default: 120)')
+    batch.add_argument('--max-workers', type=int, default=10,
+                       help='The maximum number of challenges processed concurrently. '
+                            '(Default: 10)')
+    batch.set_defaults(func=_batch)
+
+    for hook in (auth_hook, cleanup_hook):
+        hook.add_argument('--socket', default=daemon.DEFAULT_SOCKET,
+                          help=f'The socket of the daemon. (Default: {daemon.DEFAULT_SOCKET})')
+    return parser
+
+
+def _add_client_arguments(parser):
+    parser.add_argument('--credentials', required=True, help='StackPath credentials INI file.')
+    parser.add_argument('--work-dir', default=DEFAULT_WORK_DIR,
+                        help='Certbot\'s work directory, where the journal of the TXT records '
+                             f'created is kept. (Default: {DEFAULT_WORK_DIR})')
+    parser.add_argument('--zone-discovery', choices=ZONE_DISCOVERY_MODES, default='list',
+                        help='How zones are found: "filter" looks up each candidate zone name, '
+                             '"list" lists all zones of the stacks and matches domains '
+                             'locally. (Default: list)')
+    parser.add_argument('--zone-cache-ttl', type=int, default=3600,
+                        help='The number of seconds zone lookups, or the zones listed, are '
+                             'cached for. (Default: 3600)')
+    parser.add_argument('--max-retries', type=int, default=4,
+                        help='The number of times a throttled or failed StackPath API call is '
+                             'retried, with exponential backoff. (Default: 4)')
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help='The maximum number of StackPath API calls made per second; 0 for '
+                             'no limit. (Default: 0)')
+    parser.add_argument('--pool-size', type=int, default=10,
+                        help='The maximum number of HTTP connections kept open to the StackPath '
+                             'API. (Default: 10)')
+    parser.add_argument('--connect-timeout', type=float, default=10,
+                        help='The number of seconds to wait for a connection to the StackPath '
+                             'API. (Default: 10)')
+    parser.add_argument('--read-timeout', type=float, default=30,
+                        help='The number of seconds to wait for each StackPath API response. '
+                             '(Default: 30)')
+    parser.add_argument('--operation-timeout', type=float, default=120,
+                        help='The number of seconds a StackPath API call may take, retries '
+                             'included; each wait for the API is cut to the time left. '
+                             '(Default: 120)')
+
+
+def _get_client(args):
+    """Create a StackPath client from the credentials file and client arguments."""
+    credentials = dns_common.CredentialsConfiguration(
+        args.credentials, lambda name: 'dns_stackpath_' + name.replace('-', '_'))
+    credentials.require({
+        'client-id': 'StackPath API client ID',
+        'client-secret': 'StackPath API client secret',
+        'stack-id': 'StackPath stack ID',
+    })
+    rate_limiter = retry.RateLimiter(args.rate_limit) if args.rate_limit else None
+    return _StackPathClient(
+        credentials.conf('client-id'),
+        credentials.conf('client-secret'),
+        credentials.conf('stack-id'),
+        zone_cache=ZoneCache(args.zone_cache_ttl) if args.zone_cache_ttl else None,
+        zone_discovery=args.zone_discovery,
+        retry_policy=retry.RetryPolicy(max_attempts=args.max_retries + 1,
+                                       rate_limiter=rate_limiter,
+                                       deadline=args.operation_timeout),
+        zone_index_ttl=args.zone_cache_ttl or None,
+        journal=RecordJournal(journal_path(args.work_dir)),
+        timeout=(args.connect_timeout, args.read_timeout),
+        pool_size=args.pool_size
+    )
+
+
+def _serve(args):
+    client = _get_client(args)
+    client.warm_up()
+    server = daemon.ChallengeServer(args.socket, daemon.ChallengeHandler(client, args.ttl))
+    # Stop serving on SIGTERM as on Ctrl+C.
+    signal.signal(signal.SIGTERM, lambda *unused_args: sys.exit(0))
+    logger.info('Listening on %s', args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+def _sweep(args):
+    client = _get_client(args)
+    cutoff = time.time() - args.min_age
+    orphans = [entry for entry in client.journal.pending() if entry['time'] <= cutoff]
+    logger.info('Deleting %d orphaned TXT records', len(orphans))
+
+    def delete(entry):
+        zone = _Zone(entry['zone_id'], entry['zone_domain'], entry['stack_id'])
+        client.del_txt_record_by_id(zone, entry['record_id'])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.max_workers)) as executor:
+        list(executor.map(delete, orphans))
+
+    client.journal.compact()
+    remaining = {(entry['zone_id'], entry['record_id']) for entry in client.journal.pending()}
+    failed = [entry for entry in orphans if (entry['zone_id'], entry['record_id']) in remaining]
+    if failed:
+        raise errors.PluginError(f'Unable to delete {len(failed)} of {len(orphans)} orphaned '
+                                 f'TXT records; they will be retried by the next sweep')
+    return 0
+
+
+def _batch(args):
+    """
+    Process the requests read from standard input with one client.
+
+    Requests are handled as by the daemon, concurrently, except that the requests for the
+    same domain are handled one after the other, in order. The response to each request is
+    written in the order of the requests, with the request's ``id``, if it has one.
+    """
+    requests = []
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            requests.append(json.loads(line))
+        except ValueError as e:
+            requests.append(e)
+    if not requests:
+        return 0
+
+    client = _get_client(args)
+    client.warm_up()
+    handler = daemon.ChallengeHandler(client, args.ttl)
+    responses = [None] * len(requests)  # type: list
+
+    def handle(indices):
+        for index in indices:
+            request = requests[index]
+            if isinstance(request, ValueError):
+                responses[index] = {'ok': False, 'error': f'Invalid request: {request}'}
+                continue
+            responses[index] = handler.handle(request)
+            if isinstance(request, dict) and 'id' in request:
+                responses[index]['id'] = request['id']
+
+    groups = collections.OrderedDict()  # type: collections.OrderedDict
+    for index, request in enumerate(requests):
+        domain = request.get('domain') if isinstance(request, dict) else None
+        groups.setdefault(str(domain), []).append(index)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.max_workers)) as executor:
+        list(executor.map(handle, groups.values()))
+
+    for response in responses:
+        sys.stdout.write(json.dumps(response) + '\n')
+    sys.stdout.flush()
+    failed = sum(1 for response in responses if not response['ok'])
+    if failed:
+        logger.error('%d of %d requests failed', failed, len(responses))
+        return 1
+    return 0
+
+
+def _hook(args):
+    domain = os.environ.get('CERTBOT_DOMAIN')
+    validation = os.environ.get('CERTBOT_VALIDATION')
+    if not domain or validation is None:
+        raise errors.PluginError('CERTBOT_DOMAIN and CERTBOT_VALIDATION must be set')
+
+    response = daemon.send_request(args.socket, {'action': args.action, 'domain': domain,
+                                                 'validation': validation})
+    if not response.get('ok'):
+        raise errors.PluginError(response.get('error') or 'The daemon reported an error')
+    if args.propagation_seconds:
+        logger.info('Waiting %d seconds for DNS changes to propagate', args.propagation_seconds)
+        time.sleep(args.propagation_seconds)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())  # pragma: no cover
@@ -0,0 +1,616 @@
+"""Client for the parts of the StackPath API used by the plugin."""
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+
+import pystackpath
+import requests
+from requests.adapters import HTTPAdapter
+from certbot.plugins import dns_common
+
+from certbot import errors
+from certbot_dns_stackpath._internal import retry
+from certbot_dns_stackpath._internal.metrics import Metrics
+from certbot_dns_stackpath._internal.zone_index import ZoneIndex
+
+logger = logging.getLogger(__name__)
+
+TOKEN_URL = pystackpath.config.BASE_URL + '/identity/v1/oauth2/token'
+# Default (connect, read) timeouts of API requests, in seconds.
+DEFAULT_TIMEOUT = (10.0, 30.0)
+# Refresh the OAuth token this many seconds before StackPath expires it.
+TOKEN_EXPIRY_MARGIN = 60
+# Number of zones requested per page when listing all zones of a stack.
+ZONE_PAGE_SIZE = 100
+# Number of records requested per page when looking records up.
+RECORD_PAGE_SIZE = 50
+
+
+class _StackPathClient:
+    """
+    Encapsulates all communication with the StackPath API.
+
+    The client may manage zones in several stacks: zones are searched for in every stack,
+    in parallel, and a zone present in more than one stack is taken from the first one listed.
+    All stacks share the client's OAuth token and connection pool.
+
+    :param str client_id: The API client ID.
+    :param str client_secret: The API client secret.
+    :param str stack_id: The ID of the stack, or a comma-separated list of stack IDs.
+    :param int zone_index_ttl: Number of seconds after which the zones listed in ``list``
+        discovery mode are listed again; ``None`` lists them only once.
+    :param RecordJournal journal: Optional journal of the records created and deleted.
+    :param tuple timeout: The ``(connect, read)`` timeouts of every request, in seconds.
+    :param int pool_size: The maximum number of connections kept open to the API; it should
+        be at least the number of threads making API calls concurrently.
+    """
+
+    def __init__(self, client_id, client_secret, stack_id, token_cache=None, zone_cache=None,
+                 zone_discovery='filter', retry_policy=None, metrics=None, zone_index_ttl=None,
+                 journal=None, timeout=DEFAULT_TIMEOUT, pool_size=10):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.stackpath = pystackpath.Stackpath(
+            client_id,
+            client_secret,
+            custom_hooks=[retry.raise_for_status]
+        )
+        # pystackpath refreshes the token itself when a request is rejected with a 401; route
+        # that through our refresh so the expiry we track stays accurate.
+        self.stackpath.client._refresh_token = self._refresh_token
+        # pystackpath sets no timeout, so a hung connection would block a call forever.
+        adapter = TimeoutHTTPAdapter(timeout, pool_maxsize=max(1, pool_size))
+        for prefix in ('https://', 'http://'):
+            self.stackpath.client.mount(prefix, adapter)
+        self.stack_ids = parse_stack_ids(stack_id)
+        self.timeout = timeout
+        self.token_cache = token_cache
+        self.zone_cache = zone_cache
+        self.zone_discovery = zone_discovery
+        self.retry_policy = retry_policy or retry.RetryPolicy()
+        self.metrics = metrics or Metrics()
+        self.zone_index_ttl = zone_index_ttl
+        self.journal = journal
+        self._zone_index = None
+        self._zone_index_expires_at = 0.0
+        self._token_expires_at = 0.0
+        self._stacks = {}  # type: dict
+        self._executor = None
+        if len(self.stack_ids) > 1:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(self.stack_ids), thread_name_prefix='stackpath-stacks')
+        # The client is shared by concurrent workers; these guard the lazily created state.
+        self._token_lock = threading.Lock()
+        self._zone_index_lock = threading.Lock()
+
+    def warm_up(self):
+        """
+        Obtain the OAuth token and, in ``list`` discovery mode, list the zones ahead of the
+        first challenge, so that it only waits for the API call creating its record.
+
+        :raises certbot.errors.PluginError: if the token could not be obtained or the zones
+            could not be listed.
+        """
+        self._ensure_token()
+        if self.zone_discovery == 'list':
+            self._get_zone_index()
+
+    def add_txt_record(self, domain, record_name, record_content, record_ttl, zone=None,
+                       journal=True):
+        """
+        Add a TXT record using the supplied information.
+
+        :param str domain: The domain to use to look up the StackPath zone.
+        :param str record_name: The record name (typically beginning with '_acme-challenge.').
+        :param str record_content: The record content (typically the challenge validation).
+        :param int record_ttl: The record TTL (number of seconds that the record may be cached).
+        :param _Zone zone: The zone of the domain, if already resolved with `find_zone`.
+        :param bool journal: Whether to journal the record, so that it is swept if it is never
+            deleted. Records meant to outlive the run must not be.
+        :returns: The zone the record was added to and the ID of the new record.
+        :rtype: tuple
+        :raises certbot.errors.PluginError: if an error occurs communicating with the StackPath API
+        """
+
+        if zone is None:
+            zone = self.find_zone(domain)
+
+        payload = {
+            'name': zone.relative_name(record_name),  # we don't need full record name
+            'type': 'TXT',
+            'ttl': record_ttl,
+            'data': record_content,
+            'weight': 0
+        }
+
+        attempted = []
+
+        def add():
+            if attempted:
+                # The failed attempt may have created the record before failing, so look for
+                # it before creating it again.
+                record_ids = self._find_txt_record_ids(zone, record_name, [record_content],
+                                                       strict=True)
+                if record_ids:
+                    logger.debug('TXT record was added by a failed attempt.')
+                    return record_ids[0]
+            attempted.append(True)
+            return self._get_records(zone).add(**payload).id
+
+        try:
+            logger.debug('Attempting to add record to zone %s: %s', zone.id, payload)
+            record_id = self._call('records.add', add)
+        except requests.RequestException as e:
+            logger.error('Encountered error adding TXT record: %s', e)
+            raise errors.PluginError(f'Error adding TXT record to zone {zone.domain}: {e}')
+        logger.debug('Successfully added TXT record with record_id: %s', record_id)
+        if self.journal and journal:
+            self.journal.record_added(zone, record_id, record_name)
+        return zone, record_id
+
+    def update_txt_record(self, zone, record_id, record_content, record_ttl):
+        """
+        Replace the content of a TXT record whose zone and ID are already known.
+
+        :param _Zone zone: The zone which contains the record.
+        :param str record_id: The ID of the record.
+        :param str record_content: The new content of the record.
+        :param int record_ttl: The record TTL (number of seconds that the record may be cached).
+        :returns: Whether the record was updated; ``False`` if it no longer exists.
+        :rtype: bool
+        :raises certbot.errors.PluginError: if an error occurs communicating with the StackPath API
+        """
+        payload = {'ttl': record_ttl, 'data': record_content}
+        try:
+            logger.debug('Attempting to update record %s of zone %s: %s',
+                         record_id, zone.id, payload)
+            self._call('records.update',
+                       lambda: self._get_records(zone).pk(record_id).update(**payload))
+        except requests.RequestException as e:
+            if getattr(e.response, 'status_code', None) == 404:
+                logger.debug('TXT record %s no longer exists.', record_id)
+                return False
+            logger.error('Encountered error updating TXT record: %s', e)
+            raise errors.PluginError(f'Error updating TXT record in zone {zone.domain}: {e}')
+        logger.debug('Successfully updated TXT record.')
+        return True
+
+    def del_txt_record(self, domain, record_name, record_content):
+        """
+        Delete a TXT record using the supplied information.
+
+        Note that both the record's name and content are used to ensure that similar records
+        created concurrently (e.g., due to concurrent invocations of this plugin) are not deleted.
+
+        Failures are logged, but not raised.
+
+        :param str domain: The domain to use to look up the StackPath zone.
+        :param str record_name: The record name (typically beginning with '_acme-challenge.').
+        :param str record_content: The record content (typically the challenge validation).
+        """
+        self.del_txt_records(domain, record_name, [record_content])
+
+    def del_txt_records(self, domain, record_name, record_contents):
+        """
+        Delete the TXT records with the given name and contents.
+
+        This is used for the validations of a domain and its wildcard, which share a record
+        name: the zone and the existing records are only looked up once for all of them.
+
+        Failures are logged, but not raised.
+
+        :param str domain: The domain to use to look up the StackPath zone.
+        :param str record_name: The record name (typically beginning with '_acme-challenge.').
+        :param list record_contents: The contents of the records to delete.
+        """
+
+        try:
+            zone = self.find_zone(domain)
+        except errors.PluginError as e:
+            logger.debug('Encountered error finding zone_id during deletion: %s', e)
+            return
+
+        record_ids = self._find_txt_record_ids(zone, record_name, record_contents)
+        for record_id in record_ids:
+            self.del_txt_record_by_id(zone, record_id)
+        if not record_ids:
+            logger.debug('TXT record not found; no cleanup needed.')
+
+    def del_txt_record_by_id(self, zone, record_id):
+        """
+        Delete a TXT record whose zone and ID are already known.
+
+        Failures are logged, but not raised.
+
+        :param _Zone zone: The zone which contains the record.
+        :param str record_id: The ID of the record.
+        :returns: Whether the record is gone, i.e. was deleted or did not exist.
+        :rtype: bool
+        """
+        try:
+            self._call('records.delete', lambda: self._get_records(zone).pk(record_id).delete())
+            logger.debug('Successfully deleted TXT record.')
+        except requests.RequestException as e:
+            if getattr(e.response, 'status_code', None) != 404:
+                logger.warning('Encountered error deleting TXT record: %s', e)
+                return False
+            logger.debug('TXT record was already deleted.')
+        if self.journal:
+            self.journal.record_deleted(zone, record_id)
+        return True
+
+    def find_zone(self, domain):
+        """
+        Find the zone for a given domain.
+
+        :param str domain: The domain for which to find the zone.
+        :returns: The zone, if found.
+        :rtype: _Zone
+        :raises certbot.errors.PluginError: if no zone is found.
+        """
+
+        if self.zone_discovery == 'list':
+            match = self._get_zone_index().find(domain)
+            if match:
+                logger.debug('Found zone_id of %s for %s using name %s', match[0], domain, match[1])
+                return _Zone(*match)
+            raise errors.PluginError(f'Zone ID for domain {domain} not found')
+
+        zone_name_guesses = dns_common.base_domain_name_guesses(domain)
+        for zone_name in zone_name_guesses:
+            zone = self._lookup_zone(zone_name)
+            if zone['zone_id']:
+                logger.debug('Found zone_id of %s in stack %s for %s using name %s',
+                             zone['zone_id'], zone['stack_id'], domain, zone_name)
+                return _Zone(zone['zone_id'], zone['domain'], zone['stack_id'])
+        raise errors.PluginError(f'Zone ID for domain {domain} not found')
+
+    def get_token(self, stale=None):
+        """
+        Return a valid OAuth token, obtaining one if needed.
+
+        This lets `AsyncStackPathClient` share the client's token and token cache.
+
+        :param str stale: A token the API rejected; it is replaced, unless another caller
+            already did.
+        :rtype: str
+        :raises certbot.errors.PluginError: if the token could not be obtained.
+        """
+        session = self.stackpath.client
+        with self._token_lock:
+            if stale is not None and session._token == stale:  # pylint: disable=protected-access
+                self._refresh_token()
+        self._ensure_token()
+        return session._token  # pylint: disable=protected-access
+
+    def _request_token(self):
+        """
+        Exchange the client credentials for a new OAuth token.
+
+        The token request is sent through the client's session so it reuses the same
+        keep-alive connection pool as the API calls.
+
+        :returns: A ``(token, expires_at)`` tuple.
+        :rtype: tuple
+        :raises certbot.errors.PluginError: if the token could not be obtained.
+        """
+        session = self.stackpath.client
+        request = requests.Request('POST', TOKEN_URL, json={
+            'grant_type': 'client_credentials',
+            'client_id': self.client_id,
+            'client_secret': self.client_secret
+        })
+        def send():
+            prepared = session.prepare_request(request)
+            # Apply the same settings as the session's own requests, so the token request
+            # uses the same connection pool as the API calls.
+            settings = session.merge_environment_settings(prepared.url, {}, None, None, None)
+            response = session.send(prepared, **settings)
+            response.raise_for_status()
+            return response
+
+        try:
+            token = self._call('auth', send).json()
+        except (requests.RequestException, ValueError) as e:
+            raise errors.PluginError(f'Error obtaining a StackPath OAuth token: {e}')
+
+        logger.debug('Obtained StackPath OAuth token, valid for %s seconds',
+                     token.get('expires_in', 3600))
+        return token['access_token'], time.time() + int(token.get('expires_in', 3600))
+
+    def _call(self, operation, func, idempotent=True):
+        """
+        Make an API call, retrying it according to the client's retry policy.
+
+        Every attempt is recorded in the client's metrics.
+
+        :param str operation: The name the call is recorded under.
+        :param callable func: Makes the API call; called without arguments.
+        :param bool idempotent: Whether the call may safely be repeated after a server error.
+        :returns: What ``func`` returned.
+        :raises requests.RequestException: if the call failed.
+        """
+        def attempt():
+            with self.metrics.measure(operation):
+                return func()
+        return self.retry_policy.call(attempt, idempotent=idempotent)
+
+    def _set_token(self, token, expires_at):
+        self.stackpath.client._token = token  # pylint: disable=protected-access
+        self._token_expires_at = expires_at
+
+    def _refresh_token(self):
+        """Obtain a new OAuth token, bypassing (but updating) the token cache."""
+        token, expires_at = self._request_token()
+        if self.token_cache:
+            self.token_cache.put(self.client_id, token, expires_at)
+        self._set_token(token, expires_at)
+
+    def _ensure_token(self):
+        """Load or refresh the OAuth token if it is missing or about to expire."""
+        with self._token_lock:
+            if time.time() + TOKEN_EXPIRY_MARGIN < self._token_expires_at:
+                return
+            if self.token_cache:
+                self._set_token(*self.token_cache.fetch(self.client_id, self._request_token,
+                                                        TOKEN_EXPIRY_MARGIN))
+            else:
+                self._set_token(*self._request_token())
+
+    def _get_stack(self, stack_id):
+        """
+        Return a stack object, with a valid OAuth token.
+
+        The stack is addressed by its ID, so no request is needed to obtain it.
+        """
+        self._ensure_token()
+        stack = self._stacks.get(stack_id)
+        if stack is None:
+            stack = self._stacks[stack_id] = self.stackpath.stacks().pk(stack_id)
+        return stack
+
+    def _get_records(self, zone):
+        """Return the records endpoint of a zone, addressed by the zone's ID."""
+        # zones | pylint: disable=no-member
+        return self._get_stack(zone.stack_id).zones().pk(zone.id).records()
+
+    def _map_stacks(self, func):
+        """
+        Call ``func`` with the ID of every stack, in parallel when there are several.
+
+        :param callable func: Called with a stack ID.
+        :returns: The results, in the order of the stacks.
+        :rtype: list
+        """
+        if self._executor is None:
+            return [func(stack_id) for stack_id in self.stack_ids]
+        return list(self._executor.map(func, self.stack_ids))
+
+    def _lookup_zone(self, zone_name):
+        """
+        Look up the zone with the given name in every stack, consulting the zone cache first.
+
+        :param str zone_name: The zone name to look up.
+        :returns: A dict with the ``zone_id``, ``domain`` and ``stack_id`` of the zone, all
+            ``None`` if there is no such zone.
+        :rtype: dict
+        :raises certbot.errors.PluginError: if a stack could not be searched and the zone was
+            not found in the others.
+        """
+        if self.zone_cache:
+            # Entries cached before a stack was removed from the configuration are ignored.
+            zone = self.zone_cache.fetch(
+                zone_name, lambda: self._search_stacks(zone_name),
+                accept=lambda zone: not zone['zone_id'] or zone.get('stack_id') in self.stack_ids)
+        else:
+            zone = self._search_stacks(zone_name)
+        return zone or {'zone_id': None, 'domain': None, 'stack_id': None}
+
+    def _search_stacks(self, zone_name):
+        """
+        Look up the zone with the given name in every stack.
+
+        :returns: A dict with the ``zone_id``, ``domain`` and ``stack_id`` of the zone, all
+            ``None`` if there is no such zone.
+        :rtype: dict
+        :raises certbot.errors.PluginError: if a stack could not be searched and the zone was
+            not found in the others. Moving on to the parent domain instead could put the
+            records in the wrong zone.
+        """
+        logger.debug(f'Looking for {zone_name}')
+        results = self._map_stacks(lambda stack_id: self._lookup_zone_in_stack(stack_id,
+                                                                               zone_name))
+        for result, stack_id in zip(results, self.stack_ids):
+            if result is not None and not isinstance(result, requests.RequestException):
+                return {'zone_id': result, 'domain': zone_name, 'stack_id': stack_id}
+        for result, stack_id in zip(results, self.stack_ids):
+            if isinstance(result, requests.RequestException):
+                raise errors.PluginError(f'Error looking up zone {zone_name} in stack '
+                                         f'{stack_id}: {result}')
+        return {'zone_id': None, 'domain': None, 'stack_id': None}
+
+    def _lookup_zone_in_stack(self, stack_id, zone_name):
+        """
+        Look up the zone with the given name in one stack.
+
+        :returns: The ID of the zone, ``None`` if there is no such zone, or the error if the
+            lookup failed.
+        """
+        try:
+            zones = self._call('zones.lookup', lambda: self._get_stack(stack_id).zones().index(
+                filter=f"domain='{zone_name}'"))  # zones | pylint: disable=no-member
+        except requests.RequestException as e:
+            logger.debug('Encountered error looking up zone %s in stack %s: %s',
+                         zone_name, stack_id, e)
+            return e
+        return zones['zones'][0].id if zones['zones'] else None
+
+    def _get_zone_index(self):
+        """
+        Return an index of all zones in the stacks, listing them on first use and again
+        once the index is older than ``zone_index_ttl``.
+
+        :rtype: ZoneIndex
+        :raises certbot.errors.PluginError: if the zones could not be listed.
+        """
+        with self._zone_index_lock:
+            if self._zone_index is None or (self.zone_index_ttl is not None
+                                            and time.time() >= self._zone_index_expires_at):
+                self._zone_index = self._list_zones()
+                self._zone_index_expires_at = time.time() + (self.zone_index_ttl or 0)
+            return self._zone_index
+
+    def _list_zones(self):
+        index = ZoneIndex()
+        # Added last stack first, so that the first stack listed wins for a zone in several.
+        for stack_id, zones in reversed(list(zip(self.stack_ids,
+                                                 self._map_stacks(self._list_stack_zones)))):
+            for zone in zones:
+                index.add(zone.domain, zone.id, stack_id)
+        logger.debug('Listed %d zones in stacks %s', len(index), ', '.join(self.stack_ids))
+        return index
+
+    def _list_stack_zones(self, stack_id):
+        zones = []
+        after = ''
+        while True:
+            try:
+                # zones | pylint: disable=no-member
+                resp = self._call('zones.list', lambda: self._get_stack(stack_id).zones().index(
+                    first=str(ZONE_PAGE_SIZE), after=after))
+            except requests.RequestException as e:
+                raise errors.PluginError(f'Error listing StackPath zones of stack {stack_id}: {e}')
+            zones.extend(resp['zones'])
+            pageinfo = resp['pageinfo']
+            if not pageinfo.hasNextPage or not resp['zones']:
+                break
+            after = pageinfo.endCursor
+        return zones
+
+    def _find_txt_record_ids(self, zone, record_name, record_contents, strict=False):
+        """
+        Find the record_ids of the TXT records with the given name and contents.
+
+        The records are filtered by the API on their name and type and, when a single content
+        is looked for, on their content too. Pages of results are only requested until every
+        content is found.
+
+        :param _Zone zone: The zone which contains the records.
+        :param str record_name: The record name (typically beginning with '_acme-challenge.').
+        :param list record_contents: The contents of the records.
+        :param bool strict: Whether to raise errors, rather than log them and return the
+            record_ids found so far.
+        :returns: The record_ids found, at most one per content, in the order of the contents.
+        :rtype: list
+        :raises requests.RequestException: if ``strict`` and the records could not be listed.
+        """
+        query_filter = f'name="{_quote(zone.relative_name(record_name))}" and type="TXT"'
+        if len(record_contents) == 1:
+            query_filter += f' and data="{_quote(record_contents[0])}"'
+
+        # Cleanup is returning the system to the state we found it. If, for some reason, there
+        # are multiple matching records, we only delete one per content because we only added
+        # one: the first one listed, since StackPath lists records in a stable order.
+        found = {}  # type: dict
+        try:
+            for record in self._iter_records(zone, query_filter):
+                content = getattr(record, 'data', None)
+                if content in record_contents and content not in found:
+                    found[content] = record.id
+                    if len(found) == len(set(record_contents)):
+                        break
+        except requests.RequestException as e:
+            if strict:
+                raise
+            logger.debug('Encountered error getting TXT record_id: %s', e)
+
+        record_ids = []
+        for record_content in record_contents:
+            if record_content in found:
+                record_ids.append(found.pop(record_content))
+            else:
+                logger.debug('Unable to find TXT record.')
+        return record_ids
+
+    def _iter_records(self, zone, query_filter):
+        """
+        Yield the records of a zone matching a filter, requesting each page when it is reached.
+
+        :param _Zone zone: The zone which contains the records.
+        :param str query_filter: The StackPath filter expression.
+        :raises requests.RequestException: if a page could not be requested.
+        """
+        records = self._get_records(zone)
+        after = ''
+        while True:
+            resp = self._call('records.index', lambda: records.index(
+                first=str(RECORD_PAGE_SIZE), after=after, filter=query_filter))
+            yield from resp['records']
+            pageinfo = resp['pageinfo']
+            if not pageinfo.hasNextPage or not resp['records']:
+                return
+            after = pageinfo.endCursor
+
+
+def _quote(value):
+    """Escape a value for a double-quoted string of a StackPath filter expression."""
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def parse_stack_ids(value):
+    """
+    Parse the stack IDs of the credentials file.
+
+    :param str value: A stack ID, or several separated by commas.
+    :returns: The stack IDs, in order and without duplicates.
+    :rtype: list
+    """
+    stack_ids = []  # type: list
+    for stack_id in (value or '').split(','):
+        stack_id = stack_id.strip()
+        if stack_id and stack_id not in stack_ids:
+            stack_ids.append(stack_id)
+    return stack_ids
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    HTTP adapter applying a default timeout to the requests sent without one, cut to the time
+    left before the deadline of the `RetryPolicy` call they are made for.
+
+    :param tuple timeout: The ``(connect, read)`` timeouts, in seconds.
+    """
+
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        super(TimeoutHTTPAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+            remaining = retry.remaining_time()
+            if remaining is not None:
+                # Do not wait past the deadline of the call the request is made for.
+                kwargs['timeout'] = tuple(min(timeout, max(remaining, 0.001))
+                                          for timeout in self.timeout)
+        return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+class _Zone(collections.namedtuple('_Zone', ['id', 'domain', 'stack_id'])):
+    """A StackPath zone, as resolved for a domain, and the stack it belongs to."""
+
+    def relative_name(self, record_name):
+        """
+        Return a record name relative to the zone apex, as expected by the StackPath API.
+
+        :param str record_name: The fully qualified record name.
+        :rtype: str
+        """
+        if record_name == self.domain:
+            return '@'
+        suffix = f'.{self.domain}'
+        if record_name.endswith(suffix):
+            return record_name[:-len(suffix)]
+        return record_name
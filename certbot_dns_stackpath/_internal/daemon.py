@@ -0,0 +1,179 @@
+"""Daemon presenting and cleaning up dns-01 challenges for manual auth hooks."""
+import json
+import logging
+import socket
+import socketserver
+import threading
+
+from certbot import errors
+from certbot.compat import filesystem
+from certbot.compat import os
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = '/run/certbot-dns-stackpath.sock'
+ACTIONS = ('present', 'cleanup')
+# Longest request line accepted, in bytes.
+MAX_REQUEST_SIZE = 64 * 1024
+
+
+class ChallengeHandler:
+    """
+    Presents and cleans up dns-01 challenges with a shared `_StackPathClient`.
+
+    Requests and responses are dicts: ``{"action": "present", "domain": ..., "validation":
+    ...}`` (or ``"cleanup"``) is answered with ``{"ok": true}``, or ``{"ok": false, "error":
+    ...}`` if it failed. The records presented are remembered, so cleaning one up takes a
+    single API call.
+
+    :param _StackPathClient client: The client performing the API calls.
+    :param int ttl: The TTL of the TXT records created, in seconds.
+    """
+
+    def __init__(self, client, ttl=120):
+        self.client = client
+        self.ttl = ttl
+        # (validation_name, validation) -> (zone, record_id) of the records presented
+        self._records = {}  # type: dict
+        self._lock = threading.Lock()
+
+    def handle(self, request):
+        """
+        Handle one request.
+
+        :param dict request: The request.
+        :returns: The response.
+        :rtype: dict
+        """
+        try:
+            action, domain, validation = _parse_request(request)
+            validation_name = f'_acme-challenge.{domain}'
+            if action == 'present':
+                self._present(domain, validation_name, validation)
+            else:
+                self._cleanup(domain, validation_name, validation)
+        except errors.PluginError as e:
+            return {'ok': False, 'error': str(e)}
+        except Exception as e:  # pylint: disable=broad-except
+            logger.exception('Unexpected error handling %s', request)
+            return {'ok': False, 'error': f'Unexpected error: {e}'}
+        return {'ok': True}
+
+    def _present(self, domain, validation_name, validation):
+        created = self.client.add_txt_record(domain, validation_name, validation, self.ttl)
+        with self._lock:
+            self._records[(validation_name, validation)] = created
+        logger.info('Presented challenge for %s', domain)
+
+    def _cleanup(self, domain, validation_name, validation):
+        with self._lock:
+            created = self._records.pop((validation_name, validation), None)
+        if created:
+            self.client.del_txt_record_by_id(*created)
+        else:
+            # Not presented by this daemon (e.g. it was restarted in between), so look it up.
+            self.client.del_txt_record(domain, validation_name, validation)
+        logger.info('Cleaned up challenge for %s', domain)
+
+
+def _parse_request(request):
+    if not isinstance(request, dict):
+        raise errors.PluginError('Invalid request: expected a JSON object')
+    action = request.get('action')
+    if action not in ACTIONS:
+        raise errors.PluginError(f'Invalid request: action must be one of {", ".join(ACTIONS)}')
+    domain = request.get('domain')
+    validation = request.get('validation')
+    if not isinstance(domain, str) or not domain or not isinstance(validation, str):
+        raise errors.PluginError('Invalid request: domain and validation are required')
+    # Wildcard certificates are validated on the base domain.
+    if domain.startswith('*.'):
+        domain = domain[2:]
+    return action, domain, validation
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Answers each JSON line received with a JSON line."""
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline(MAX_REQUEST_SIZE + 1)
+            if not line:
+                return
+            if len(line) > MAX_REQUEST_SIZE:
+                self._respond({'ok': False, 'error': 'Request too large'})
+                return
+            try:
+                request = json.loads(line.decode())
+            except ValueError as e:
+                response = {'ok': False, 'error': f'Invalid request: {e}'}
+            else:
+                response = self.server.handler.handle(request)
+            self._respond(response)
+
+    def _respond(self, response):
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class ChallengeServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves a `ChallengeHandler` on a UNIX socket, one thread per connection.
+
+    The socket is only accessible to the user running the daemon.
+
+    :param str path: The path of the socket.
+    :param ChallengeHandler handler: Handles the requests received.
+    :raises certbot.errors.PluginError: if another daemon is listening on the socket.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, handler):
+        _remove_stale_socket(path)
+        self.handler = handler
+        previous_umask = filesystem.umask(0o177)
+        try:
+            super(ChallengeServer, self).__init__(path, _RequestHandler)
+        finally:
+            filesystem.umask(previous_umask)
+
+    def server_close(self):
+        super(ChallengeServer, self).server_close()
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+
+def _remove_stale_socket(path):
+    """Remove a socket left behind by a daemon which is no longer running."""
+    if not os.path.exists(path):
+        return
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+    except OSError:
+        os.remove(path)
+    else:
+        raise errors.PluginError(f'A daemon is already listening on {path}')
+
+
+def send_request(path, request, timeout=60.0):
+    """
+    Send a request to the daemon and return its response.
+
+    :param str path: The path of the daemon's socket.
+    :param dict request: The request, see `ChallengeHandler`.
+    :param float timeout: How long to wait for the daemon, in seconds.
+    :rtype: dict
+    :raises certbot.errors.PluginError: if the daemon could not be reached.
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.sendall(json.dumps(request).encode() + b'\n')
+            with sock.makefile('rb') as response:
+                return json.loads(response.readline().decode())
+    except (OSError, ValueError) as e:
+        raise errors.PluginError(f'Error communicating with the daemon on {path}: {e}')
@@ -1,16 +1,39 @@
 """DNS Authenticator for StackPath."""
+import asyncio
+import collections
+import concurrent.futures
 import logging
+import threading
+import time
 
-import pystackpath
 import zope.interface
-from acme.magic_typing import Any, Dict
+from certbot.compat import os
 from certbot.plugins import dns_common
 
 from certbot import errors, interfaces
+from certbot_dns_stackpath._internal import retry
+from certbot_dns_stackpath._internal.cache import PropagationHistory
+from certbot_dns_stackpath._internal.cache import RecordStore
+from certbot_dns_stackpath._internal.cache import TokenCache
+from certbot_dns_stackpath._internal.cache import ZoneCache
+from certbot_dns_stackpath._internal.journal import CleanupQueue
+from certbot_dns_stackpath._internal.journal import RecordJournal
+from certbot_dns_stackpath._internal.metrics import Metrics
 
 logger = logging.getLogger(__name__)
 
 ACCOUNT_URL = 'https://control.stackpath.com/api-management'
+ZONE_DISCOVERY_MODES = ('filter', 'list')
+
+
+def journal_path(work_dir):
+    """
+    Return the path of the record journal in a Certbot work directory.
+
+    :param str work_dir: Certbot's work directory.
+    :rtype: str
+    """
+    return os.path.join(work_dir, 'dns-stackpath', 'journal.jsonl')
 
 
 @zope.interface.implementer(interfaces.IAuthenticator)
@@ -28,11 +51,88 @@ class Authenticator(dns_common.DNSAuthenticator):
     def __init__(self, *args, **kwargs):
         super(Authenticator, self).__init__(*args, **kwargs)
         self.credentials = None
+        self._client = None
+        self._async_client = None
+        # The event loop shared by every batch of this run, which the async client is bound to
+        self._loop = None
+        self._propagation_checker = None
+        self._journal = None
+        self._record_store = None
+        self._cleanup_worker = None
+        # Serializes the workers draining the cleanup queue.
+        self._cleanup_lock = threading.Lock()
+        self._metrics = Metrics()
+        # (validation_name, validation) -> (zone, record_id) of the records added by _perform
+        self._records = {}  # type: dict
+        # domain -> zone, as resolved by _resolve_zones before adding any record
+        self._zones = {}  # type: dict
 
     @classmethod
     def add_parser_arguments(cls, add):  # pylint: disable=arguments-differ
         super(Authenticator, cls).add_parser_arguments(add)
         add('credentials', help='StackPath credentials INI file.')
+        add('token-cache', action='store_true', default=False,
+            help='Cache the StackPath OAuth token in the work directory and reuse it across '
+                 'invocations until it expires.')
+        add('zone-cache-ttl', type=int, default=3600,
+            help='The number of seconds zone lookups are cached for (0 disables caching).')
+        add('zone-cache', action='store_true', default=False,
+            help='Persist cached zone lookups in the work directory and share them across '
+                 'invocations.')
+        add('shared-state', action='store_true', default=False,
+            help='Coordinate with the other Certbot processes of this host through the work '
+                 'directory: share the OAuth token, zone lookups and the --dns-stackpath-rate-'
+                 'limit budget, and hold back every process when one is throttled. Implies '
+                 '--dns-stackpath-token-cache and --dns-stackpath-zone-cache.')
+        add('zone-discovery', choices=ZONE_DISCOVERY_MODES, default='filter',
+            help='How zones are found: "filter" looks up each candidate zone name, "list" '
+                 'lists all zones of the stacks once and matches domains locally.')
+        add('propagation-check', action='store_true', default=False,
+            help='Poll the authoritative nameservers until the TXT records are visible, waiting '
+                 'at most --dns-stackpath-propagation-seconds (requires dnspython).')
+        add('adaptive-propagation', action='store_true', default=False,
+            help='Poll the authoritative nameservers, but wait at least as long as TXT records '
+                 'usually take to propagate in the zones, as learned from previous runs; '
+                 'waiting at most --dns-stackpath-propagation-seconds (requires dnspython).')
+        add('adaptive-percentile', type=float, default=95,
+            help='The percentile of the propagation times observed in a zone that adaptive '
+                 'waits are based on.')
+        add('adaptive-margin', type=float, default=5,
+            help='The number of seconds added to adaptive waits, as a safety margin.')
+        add('persistent-records', action='store_true', default=False,
+            help='Keep one TXT record per validation name across runs, remembering its ID in the '
+                 'work directory, and update its content for each challenge instead of '
+                 'creating and deleting records: a challenge then costs a single API call.')
+        add('cleanup-placeholder', default=None,
+            help='With --dns-stackpath-persistent-records, set the records to this content on '
+                 'cleanup, instead of leaving the last validation in place.')
+        add('deferred-cleanup', action='store_true', default=False,
+            help='Queue the TXT records for deletion in the work directory and return from '
+                 'cleanup immediately; a background thread deletes them before Certbot exits, '
+                 'and records it could not delete are retried by the next run.')
+        add('max-retries', type=int, default=4,
+            help='The number of times a throttled or failed StackPath API call is retried, '
+                 'with exponential backoff.')
+        add('rate-limit', type=float, default=0,
+            help='The maximum number of StackPath API calls made per second (0 for no limit).')
+        add('metrics-file', default=None,
+            help='Write counts and timings of the StackPath API calls to this file, as JSON or, '
+                 'if its name ends in .prom, for the node_exporter textfile collector.')
+        add('max-workers', type=int, default=10,
+            help='The maximum number of StackPath API calls made concurrently while creating '
+                 'or deleting TXT records; they are made on an asyncio session with the '
+                 '"async" extra (aiohttp), otherwise on as many threads.')
+        add('pool-size', type=int, default=None,
+            help='The maximum number of HTTP connections kept open to the StackPath API. '
+                 '(Default: --dns-stackpath-max-workers)')
+        add('connect-timeout', type=float, default=10,
+            help='The number of seconds to wait for a connection to the StackPath API.')
+        add('read-timeout', type=float, default=30,
+            help='The number of seconds to wait for each StackPath API response.')
+        add('operation-timeout', type=float, default=120,
+            help='The number of seconds a StackPath API call may take, retries included. A '
+                 'request still running then is abandoned with the "async" extra (aiohttp); '
+                 'otherwise each wait for the API is cut to the time left.')
 
     def more_info(self):  # pylint: disable=missing-function-docstring
         return 'This plugin configures a DNS TXT record to respond to a dns-01 challenge using ' \
@@ -67,167 +167,498 @@ class Authenticator(dns_common.DNSAuthenticator):
             self._validate_credentials
         )
 
-    def _perform(self, domain, validation_name, validation):
-        self._get_stackpath_client().add_txt_record(domain, validation_name, validation, self.ttl)
+    def perform(self, achalls):  # pylint: disable=missing-function-docstring
+        self._setup_credentials()
 
-    def _cleanup(self, domain, validation_name, unused):
-        self._get_stackpath_client().del_txt_record(domain, validation_name, unused)
+        self._attempt_cleanup = True
+        if self.conf('deferred-cleanup'):
+            # Delete what previous runs left in the queue while this one proceeds.
+            self._start_cleanup_worker()
 
-    def _get_stackpath_client(self):
-        if self.credentials.conf('client-id') \
-            and self.credentials.conf('client-secret') \
-            and self.credentials.conf('stack-id'):
-            return _StackPathClient(
-                self.credentials.conf('client-id'),
-                self.credentials.conf('client-secret'),
-                self.credentials.conf('stack-id')
-            )
-        return _StackPathClient(None, None, None)
+        try:
+            self._resolve_zones(achalls)
+            self._run_batch(self._perform_async, achalls)
 
+            with self._metrics.measure('propagation'):
+                self._wait_for_propagation(achalls)
+        finally:
+            self._report_metrics('perform')
 
-class _StackPathClient:
-    """
-    Encapsulates all communication with the StackPath API.
-    """
+        return [achall.response(achall.account_key) for achall in achalls]
 
-    def __init__(self, client_id, client_secret, stack_id):
-        self.stackpath = pystackpath.Stackpath(
-            client_id,
-            client_secret
-        )
-        self.stack_id = stack_id
+    def cleanup(self, achalls):  # pylint: disable=missing-function-docstring
+        if self._attempt_cleanup:
+            try:
+                if self.conf('deferred-cleanup') and not self.conf('persistent-records'):
+                    achalls = self._defer_cleanup(achalls)
+                self._run_batch(self._cleanup_async, achalls)
+            finally:
+                self._close_event_loop()
+                self._report_metrics('cleanup')
+                self._compact_journal()
+
+    def _defer_cleanup(self, achalls):
+        """
+        Queue the records added for the challenges for deletion by the cleanup worker.
 
-    def add_txt_record(self, domain, record_name, record_content, record_ttl):
+        :param list achalls: The challenges to clean up.
+        :returns: The challenges whose records were not added by this run, and so must be
+            looked up to be deleted.
+        :rtype: list
         """
-        Add a TXT record using the supplied information.
+        created = []
+        remaining = []
+        for achall in achalls:
+            key = (achall.validation_domain_name(achall.domain),
+                   achall.validation(achall.account_key))
+            if key in self._records:
+                created.append(self._records[key])
+            else:
+                remaining.append(achall)
+        if created:
+            try:
+                self._get_cleanup_queue().put(created)
+            except OSError as e:
+                logger.warning('Unable to queue the TXT records for deletion: %s', e)
+                return achalls
+            for achall in achalls:
+                self._records.pop((achall.validation_domain_name(achall.domain),
+                                   achall.validation(achall.account_key)), None)
+            logger.info('Deleting %d TXT records in the background', len(created))
+            self._start_cleanup_worker()
+        return remaining
+
+    def _start_cleanup_worker(self):
+        """
+        Start a thread deleting the records in the cleanup queue.
 
-        :param str domain: The domain to use to look up the StackPath zone.
-        :param str record_name: The record name (typically beginning with '_acme-challenge.').
-        :param str record_content: The record content (typically the challenge validation).
-        :param int record_ttl: The record TTL (number of seconds that the record may be cached).
-        :raises certbot.errors.PluginError: if an error occurs communicating with the StackPath API
+        The thread is not a daemon thread, so the interpreter lets it finish before exiting.
+        Records it fails to delete stay queued for the next run.
         """
+        # Created here, so that the worker and this thread do not race to create the client.
+        client = self._get_stackpath_client()
+        self._cleanup_worker = threading.Thread(target=self._drain_cleanup_queue, args=(client,),
+                                                name='stackpath-cleanup')
+        self._cleanup_worker.start()
+
+    def _drain_cleanup_queue(self, client):
+        # Imported here, as in _get_stackpath_client.
+        from certbot_dns_stackpath._internal.client import _Zone
+        with self._cleanup_lock:
+            queue = self._get_cleanup_queue()
+            try:
+                entries = queue.pending()
+                if not entries:
+                    return
+
+                def delete(entry):
+                    zone = _Zone(entry['zone_id'], entry['zone_domain'], entry['stack_id'])
+                    return client.del_txt_record_by_id(zone, entry['record_id'])
+                with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=max(1, self.conf('max-workers'))) as executor:
+                    deleted = [entry for entry, gone in zip(entries, executor.map(delete, entries))
+                               if gone]
+                queue.remove(deleted)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Error deleting the queued TXT records')
+                return
+            logger.info('Deleted %d of %d queued TXT records', len(deleted), len(entries))
+            self._compact_journal()
+
+    def _compact_journal(self):
+        """Drop the records this run created and deleted from the record journal."""
+        if self._journal:
+            try:
+                self._journal.compact()
+            except OSError as e:
+                logger.warning('Unable to compact the record journal %s: %s',
+                               self._journal.path, e)
+
+    def _report_metrics(self, phase):
+        """Log the metrics collected so far and write them to the metrics file, if any."""
+        logger.info('StackPath plugin operations after %s:\n%s',
+                    phase, self._metrics.format_summary())
+        if self.conf('metrics-file'):
+            try:
+                self._metrics.write(self.conf('metrics-file'))
+            except OSError as e:
+                logger.warning('Unable to write metrics to %s: %s', self.conf('metrics-file'), e)
 
-        zone_id = self._find_zone_id(domain)
-        zone = self._get_zone_info(zone_id)
-        record_name = record_name.replace(f'.{zone.domain}', '')
+    def _wait_for_propagation(self, achalls):
+        """
+        Wait for the TXT records of the challenges to propagate.
 
-        payload = {
-            'name': record_name,  # we don't need full record name
-            'type': 'TXT',
-            'ttl': record_ttl,
-            'data': record_content,
-            'weight': 0
-        }
+        With ``--dns-stackpath-propagation-check``, the zones' authoritative nameservers are
+        polled until they all serve every record, ``--dns-stackpath-propagation-seconds``
+        being the upper bound. With ``--dns-stackpath-adaptive-propagation``, they are polled
+        too, but once the zones have enough history the wait lasts at least as long as records
+        usually take to propagate in them. Otherwise that number of seconds is slept
+        unconditionally.
 
-        try:
-            logger.debug('Attempting to add record to zone %s: %s', zone_id, payload)
-            self.stackpath.stacks().get(self.stack_id).zones().get(zone_id).records().add(
-                **payload)  # zones | pylint: disable=no-member
-        except pystackpath.HTTPError as e:
-            code = int(e)
-            hint = None
-        record_id = self._find_txt_record_id(zone_id, record_name)
-        logger.debug('Successfully added TXT record with record_id: %s', record_id)
+        How long the records took to be seen on the nameservers is recorded per zone in the
+        propagation history, which adaptive waits are based on.
+        """
+        seconds = self.conf('propagation-seconds')
+        adaptive = self.conf('adaptive-propagation')
+        if self.conf('propagation-check') or adaptive:
+            records = []
+            for achall in achalls:
+                validation_name = achall.validation_domain_name(achall.domain)
+                validation = achall.validation(achall.account_key)
+                zone = self._records[(validation_name, validation)][0]
+                records.append((zone.domain, validation_name, validation))
+            minimum = None
+            if adaptive:
+                minimum = self._get_adaptive_wait({zone_domain for zone_domain, _, _ in records})
+
+            # Imported here: dnspython is slow to import and only needed for this check.
+            from certbot_dns_stackpath._internal import propagation
+            if propagation.available():
+                if self._propagation_checker is None:
+                    self._propagation_checker = propagation.PropagationChecker()
+                start = time.monotonic()
+                seen_after = {}  # type: dict
+                logger.info("Waiting up to %d seconds for DNS changes to propagate", seconds)
+                if self._propagation_checker.wait(records, seconds, seen_after):
+                    logger.info("DNS changes are visible on the authoritative nameservers")
+                else:
+                    logger.warning("DNS changes are still not visible on every authoritative "
+                                   "nameserver after %d seconds", seconds)
+                self._record_propagation(records, seen_after, seconds)
+
+                remaining = (minimum or 0) - (time.monotonic() - start)
+                if remaining > 0:
+                    logger.info("Waiting %.1f more seconds, as DNS changes usually take %.1f "
+                                "seconds to propagate in these zones", remaining, minimum)
+                    time.sleep(remaining)
+                return
+            logger.warning('Checking DNS propagation requires dnspython; waiting instead.')
+            if minimum is not None:
+                seconds = minimum
+
+        # DNS updates take time to propagate and checking to see if the update has occurred is not
+        # reliable (the machine this code is running on might be able to see an update before
+        # the ACME server). So: we sleep for a short amount of time we believe to be long enough.
+        logger.info("Waiting %d seconds for DNS changes to propagate", seconds)
+        time.sleep(seconds)
+
+    def _get_adaptive_wait(self, zone_domains):
+        """
+        Return how long to wait for records in the given zones to propagate.
 
-    def del_txt_record(self, domain, record_name, unused):
+        That is the ``--dns-stackpath-adaptive-percentile`` of the propagation times
+        observed in the slowest zone, plus ``--dns-stackpath-adaptive-margin``, capped by
+        ``--dns-stackpath-propagation-seconds``.
+
+        :param set zone_domains: The domains of the zones.
+        :returns: The number of seconds, or ``None`` if a zone has too few observations.
+        :rtype: float
         """
-        Delete a TXT record using the supplied information.
+        seconds = self.conf('propagation-seconds')
+        try:
+            estimates = [self._get_propagation_history().estimate(
+                zone_domain, self.conf('adaptive-percentile'))
+                for zone_domain in zone_domains]
+        except OSError as e:
+            logger.warning('Unable to read the propagation history: %s', e)
+            return None
+        if None in estimates:
+            logger.debug('Not enough propagation history for these zones yet')
+            return None
+        return min(seconds, max(estimates) + self.conf('adaptive-margin'))
+
+    def _record_propagation(self, records, seen_after, timeout):
+        """
+        Record how long the records took to be seen in each zone, or ``timeout`` if they
+        were not all seen.
+        """
+        observations = {}  # type: dict
+        for record in records:
+            observations[record[0]] = max(observations.get(record[0], 0.0),
+                                          seen_after.get(record, timeout))
+        try:
+            self._get_propagation_history().record(observations)
+        except OSError as e:
+            logger.warning('Unable to record the propagation history: %s', e)
 
-        Note that both the record's name and content are used to ensure that similar records
-        created concurrently (e.g., due to concurrent invocations of this plugin) are not deleted.
+    def _get_propagation_history(self):
+        return PropagationHistory(
+            os.path.join(self.config.work_dir, 'dns-stackpath', 'propagation.json'))
 
-        Failures are logged, but not raised.
+    def _run_batch(self, operation, achalls):
+        """
+        Run ``operation(domain, validation_name, validations)`` for the challenges.
+
+        Challenges sharing a validation name (e.g. ``example.com`` and ``*.example.com``) are
+        grouped into a single call, so their zone and existing records are only looked up once.
+        All the calls run on one event loop, through the asynchronous client, so at most
+        ``--dns-stackpath-max-workers`` API calls are in flight at once. Every group is
+        attempted even if some of them fail.
 
-        :param str domain: The domain to use to look up the StackPath zone.
-        :param str record_name: The record name (typically beginning with '_acme-challenge.').
-        :param str record_content: The record content (typically the challenge validation).
+        :param callable operation: `_perform_async` or `_cleanup_async`.
+        :param list achalls: The challenges to process.
+        :raises certbot.errors.PluginError: if the operation failed for any challenge.
         """
+        groups = collections.OrderedDict()  # type: collections.OrderedDict
+        for achall in achalls:
+            validation_name = achall.validation_domain_name(achall.domain)
+            groups.setdefault(validation_name, (achall.domain, []))[1].append(
+                achall.validation(achall.account_key))
+
+        async def run_all():
+            return await asyncio.gather(*[
+                operation(domain, validation_name, validations)
+                for validation_name, (domain, validations) in groups.items()
+            ], return_exceptions=True)
+
+        results = self._run_coroutine(run_all())
+        _raise_failures([domain for domain, _ in groups.values()], results)
+
+    def _resolve_zones(self, achalls):
+        """
+        Find the zone of every domain before any record is added.
+
+        The domains are resolved concurrently. Domains of the same zone share the lookups of
+        its name through the zone cache. An unknown zone fails the whole batch up front,
+        instead of after records were added for the other domains.
 
+        :param list achalls: The challenges to process.
+        :raises certbot.errors.PluginError: if the zone of any domain could not be found.
+        """
+        domains = list(collections.OrderedDict.fromkeys(achall.domain for achall in achalls))
+        client = self._get_async_client()
+
+        async def resolve_all():
+            return await asyncio.gather(*[client.find_zone(domain) for domain in domains],
+                                        return_exceptions=True)
+
+        results = self._run_coroutine(resolve_all())
+        _raise_failures(domains, results)
+        self._zones.update(zip(domains, results))
+
+    def _run_coroutine(self, coroutine):
+        # Create the clients up front so concurrent calls do not race to do it.
+        self._get_async_client()
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(coroutine)
+
+    def _close_event_loop(self):
+        """Close the async client's connections and the event loop, once cleanup is done."""
+        if self._loop is None:
+            return
         try:
-            zone_id = self._find_zone_id(domain)
-        except errors.PluginError as e:
-            logger.debug('Encountered error finding zone_id during deletion: %s', e)
+            if self._async_client is not None:
+                self._loop.run_until_complete(self._async_client.close())
+        finally:
+            self._async_client = None
+            self._loop.close()
+            self._loop = None
+
+    def _perform(self, domain, validation_name, validation):
+        self._run_coroutine(self._perform_async(domain, validation_name, [validation]))
+
+    def _cleanup(self, domain, validation_name, unused):
+        self._run_coroutine(self._cleanup_async(domain, validation_name, [unused]))
+
+    async def _perform_async(self, domain, validation_name, validations):
+        if self.conf('persistent-records'):
+            await self._update_persistent_async(domain, validation_name, validations)
             return
+        # Records sharing a name are added one after the other, so the zone is only resolved
+        # once for all of them.
+        for validation in validations:
+            self._records[(validation_name, validation)] = await self._get_async_client() \
+                .add_txt_record(domain, validation_name, validation, self.ttl,
+                                zone=self._zones.get(domain))
+
+    async def _update_persistent_async(self, domain, validation_name, validations):
+        """
+        Set the persistent records of a name to the validations, creating missing records.
 
-        if zone_id:
-            zone = self._get_zone_info(zone_id)
-            record_name = record_name.replace(f'.{zone.domain}', '')
-            record_id = self._find_txt_record_id(zone_id, record_name)
-            if record_id:
-                try:
-                    # zones | pylint: disable=no-member
-                    self.stackpath.stacks().get(self.stack_id) \
-                        .zones().get(zone_id) \
-                        .records().get(record_id).delete()
-                    logger.debug('Successfully deleted TXT record.')
-                except pystackpath.HTTPError as e:
-                    logger.warning('Encountered pystackpath.HTTPError deleting TXT record: %s', e)
+        The records kept from previous runs are updated in place, with a single API call
+        each; a record is only created when the name has fewer records than validations, or
+        when a kept record was deleted or belongs to another zone. In the latter case, the
+        kept record is deleted once replaced.
+        """
+        client = self._get_async_client()
+        loop = asyncio.get_event_loop()
+        zone = self._zones.get(domain) or await client.find_zone(domain)
+        # The record store is a locked file: keep its I/O off the event loop.
+        kept = await loop.run_in_executor(None, self._get_persistent_records, validation_name)
+        records = []
+        replaced = []
+        for index, validation in enumerate(validations):
+            entry = kept[index] if index < len(kept) else None
+            if entry and entry['zone_id'] == zone.id and await client.update_txt_record(
+                    zone, entry['record_id'], validation, self.ttl):
+                record_id = entry['record_id']
             else:
-                logger.debug('TXT record not found; no cleanup needed.')
-        else:
-            logger.debug(f'Zone not found; no cleanup needed. {domain}')
+                _, record_id = await client.add_txt_record(domain, validation_name, validation,
+                                                           self.ttl, zone=zone, journal=False)
+                if entry and entry['zone_id'] != zone.id:
+                    replaced.append(entry)
+            self._records[(validation_name, validation)] = (zone, record_id)
+            records.append({'zone_id': zone.id, 'zone_domain': zone.domain,
+                            'stack_id': zone.stack_id, 'record_id': record_id})
+        if records != kept[:len(records)]:
+            await loop.run_in_executor(None, self._put_persistent_records, validation_name,
+                                       records + kept[len(records):])
+        await asyncio.gather(*[self._delete_replaced_record(validation_name, entry)
+                               for entry in replaced])
+
+    async def _delete_replaced_record(self, validation_name, entry):
+        """
+        Delete a kept record replaced by one in another zone, journaling it for the sweep if
+        that fails, as the record store no longer refers to it.
+        """
+        from certbot_dns_stackpath._internal.client import _Zone
+        zone = _Zone(entry['zone_id'], entry['zone_domain'], entry['stack_id'])
+        if not await self._get_async_client().del_txt_record_by_id(zone, entry['record_id']):
+            await asyncio.get_event_loop().run_in_executor(
+                None, self._get_journal().record_added, zone, entry['record_id'], validation_name)
 
-    def _get_zone_info(self, zone_id):
+    def _get_persistent_records(self, validation_name):
         try:
-            zone = self.stackpath.stacks().get(self.stack_id).zones().get(zone_id)
-            return zone
-        except pystackpath.HTTPError as e:
-            logger.debug(f'Zone not found; {zone_id}')
+            return self._get_record_store().get(validation_name)
+        except OSError as e:
+            logger.warning('Unable to read the TXT records kept for %s: %s', validation_name, e)
+            return []
 
-    def _find_zone_id(self, domain):
+    def _put_persistent_records(self, validation_name, records):
+        try:
+            self._get_record_store().put(validation_name, records)
+        except OSError as e:
+            logger.warning('Unable to remember the TXT records of %s: %s', validation_name, e)
+
+    async def _cleanup_async(self, domain, validation_name, validations):
+        client = self._get_async_client()
+        if self.conf('persistent-records'):
+            # The records are kept for the next challenges.
+            placeholder = self.conf('cleanup-placeholder')
+            created = [self._records.pop((validation_name, validation), None)
+                       for validation in validations]
+            if placeholder is not None:
+                await asyncio.gather(*[
+                    client.update_txt_record(zone, record_id, placeholder, self.ttl)
+                    for zone, record_id in filter(None, created)])
+            return
+        unknown = []
+        deletions = []
+        for validation in validations:
+            created = self._records.pop((validation_name, validation), None)
+            if created:
+                deletions.append(client.del_txt_record_by_id(*created))
+            else:
+                unknown.append(validation)
+        if unknown:
+            # These records were not added by this run (e.g. after a crash), so look them up.
+            deletions.append(client.del_txt_records(domain, validation_name, unknown))
+        await asyncio.gather(*deletions)
+
+    def _get_async_client(self):
         """
-        Find the zone_id for a given domain.
+        Return the asynchronous client for this run, sharing the StackPath client's
+        configuration and token.
 
-        :param str domain: The domain for which to find the zone_id.
-        :returns: The zone_id, if found.
-        :rtype: str
-        :raises certbot.errors.PluginError: if no zone_id is found.
+        Without the ``async`` extra (aiohttp), the StackPath client's calls are run on a pool
+        of threads instead.
         """
+        if self._async_client is None:
+            # Imported here for the same reason as the StackPath client.
+            from certbot_dns_stackpath._internal import async_client
+            client_class = async_client.AsyncStackPathClient if async_client.available() \
+                else async_client.ExecutorStackPathClient
+            self._async_client = client_class(self._get_stackpath_client(),
+                                              self.conf('max-workers'), self.conf('pool-size'))
+        return self._async_client
 
-        zone_name_guesses = dns_common.base_domain_name_guesses(domain)
-        zones = {}  # type: Dict[str, Any]
-        code = msg = None
-        for zone_name in zone_name_guesses:
-            try:
-                logger.debug(f'Looking for {zone_name}')
-                zones = self.stackpath.stacks().get(self.stack_id) \
-                    .zones().index(
-                    filter=f"domain='{zone_name}'")  # zones | pylint: disable=no-member
-            except pystackpath.HTTPError as e:
-                code = int(e)
-                msg = str(e)
-                hint = None
-            if zones['zones']:
-                zone_id = zones['zones'][0].id
-                logger.debug('Found zone_id of %s for %s using name %s', zone_id, domain, zone_name)
-                return zone_id
-        raise errors.PluginError(f'Zone ID for domain {domain} not found')
-
-    def _find_txt_record_id(self, zone_id, record_name):
-        """
-        Find the record_id for a TXT record with the given name and content.
-
-        :param str zone_id: The zone_id which contains the record.
-        :param str record_name: The record name (typically beginning with '_acme-challenge.').
-        :returns: The record_id, if found.
-        :rtype: str
+    def _get_stackpath_client(self):
         """
-        try:
-            zone = self._get_zone_info(zone_id)
-            record_name = record_name.replace(f'.{zone.domain}', '')
-            # zones | pylint: disable=no-member
-            resp = self.stackpath.stacks().get(self.stack_id) \
-                .zones().get(zone_id) \
-                .records().index(filter=f'name="{record_name}" and type="TXT"')
-            records = resp.get('records', [])
-        except pystackpath.HTTPError as e:
-            logger.debug('Encountered pystackpath.HTTPError getting TXT record_id: %s', e)
-            records = []
+        Return the StackPath client for this run, creating it on first use.
 
-        if records:
-            # Cleanup is returning the system to the state we found it. If, for some reason,
-            # there are multiple matching records, we only delete one because we only added one.
-            return records[0].id
-        logger.debug('Unable to find TXT record.')
+        The same client (and so the same OAuth token and HTTP connection pool) is shared by
+        every challenge performed and cleaned up by this Authenticator.
+        """
+        if self._client is None:
+            # Imported here: pystackpath is only needed once a challenge is performed, and this
+            # module is loaded by every Certbot command through the plugin entry point.
+            from certbot_dns_stackpath._internal.client import _StackPathClient
+            if self.credentials.conf('client-id') \
+                and self.credentials.conf('client-secret') \
+                and self.credentials.conf('stack-id'):
+                self._client = _StackPathClient(
+                    self.credentials.conf('client-id'),
+                    self.credentials.conf('client-secret'),
+                    self.credentials.conf('stack-id'),
+                    token_cache=self._get_token_cache(),
+                    zone_cache=self._get_zone_cache(),
+                    zone_discovery=self.conf('zone-discovery'),
+                    retry_policy=self._get_retry_policy(),
+                    metrics=self._metrics,
+                    journal=self._get_journal(),
+                    timeout=(self.conf('connect-timeout'), self.conf('read-timeout')),
+                    pool_size=self.conf('pool-size') or self.conf('max-workers')
+                )
+            else:
+                self._client = _StackPathClient(None, None, None)
+        return self._client
+
+    def _get_journal(self):
+        if self._journal is None:
+            self._journal = RecordJournal(journal_path(self.config.work_dir))
+        return self._journal
+
+    def _get_cleanup_queue(self):
+        return CleanupQueue(os.path.join(self.config.work_dir, 'dns-stackpath',
+                                         'cleanup-queue.json'))
+
+    def _get_record_store(self):
+        if self._record_store is None:
+            self._record_store = RecordStore(
+                os.path.join(self.config.work_dir, 'dns-stackpath', 'records.json'))
+        return self._record_store
+
+    def _get_token_cache(self):
+        if self.conf('token-cache') or self.conf('shared-state'):
+            return TokenCache(os.path.join(self.config.work_dir, 'dns-stackpath', 'tokens.json'))
         return None
+
+    def _get_retry_policy(self):
+        rate_limiter = None
+        if self.conf('shared-state'):
+            rate_limiter = retry.SharedRateLimiter(
+                os.path.join(self.config.work_dir, 'dns-stackpath', 'rate-limit.json'),
+                self.conf('rate-limit'), key=self.credentials.conf('client-id'))
+        elif self.conf('rate-limit'):
+            rate_limiter = retry.RateLimiter(self.conf('rate-limit'))
+        return retry.RetryPolicy(max_attempts=self.conf('max-retries') + 1,
+                                 rate_limiter=rate_limiter,
+                                 deadline=self.conf('operation-timeout'))
+
+    def _get_zone_cache(self):
+        if not self.conf('zone-cache-ttl'):
+            return None
+        path = None
+        if self.conf('zone-cache') or self.conf('shared-state'):
+            path = os.path.join(self.config.work_dir, 'dns-stackpath', 'zones.json')
+        return ZoneCache(self.conf('zone-cache-ttl'), path)
+
+
+def _raise_failures(domains, results):
+    """
+    Raise the errors of the per-domain operations run concurrently, if any.
+
+    :param list domains: The domain of each operation.
+    :param list results: What each operation returned or raised.
+    :raises certbot.errors.PluginError: listing every domain whose operation failed.
+    """
+    failures = []
+    for domain, result in zip(domains, results):
+        if isinstance(result, errors.PluginError):
+            logger.error('Encountered error for %s: %s', domain, result)
+            failures.append(f'{domain}: {result}')
+        elif isinstance(result, BaseException):
+            raise result
+    if failures:
+        raise errors.PluginError('; '.join(failures))
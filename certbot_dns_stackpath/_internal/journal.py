@@ -0,0 +1,156 @@
+"""Journal of the TXT records created by the StackPath plugin."""
+import contextlib
+import json
+import logging
+import time
+
+from certbot.compat import filesystem
+from certbot.compat import os
+from certbot_dns_stackpath._internal.cache import file_lock
+from certbot_dns_stackpath._internal.cache import JSONFileStore
+from certbot_dns_stackpath._internal.cache import replace_file
+
+logger = logging.getLogger(__name__)
+
+
+class RecordJournal:
+    """
+    Append-only log of the TXT records created and deleted, shared by all invocations.
+
+    A record created but never deleted, e.g. because Certbot was killed between performing
+    and cleaning up its challenge, stays pending in the journal until it is swept. Each line
+    is a JSON object: ``{"op": "add", "zone_id": ..., "zone_domain": ..., "stack_id": ...,
+    "record_id": ..., "name": ..., "time": ...}`` or ``{"op": "delete", "zone_id": ...,
+    "record_id": ..., "time": ...}``.
+
+    Failures to write the journal are logged, but not raised: they must not fail challenges.
+
+    :param str path: The path of the journal file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def record_added(self, zone, record_id, record_name):
+        """
+        Journal a record that was created.
+
+        :param _Zone zone: The zone the record was added to.
+        :param str record_id: The ID of the record.
+        :param str record_name: The name of the record.
+        """
+        self._append({'op': 'add', 'zone_id': zone.id, 'zone_domain': zone.domain,
+                      'stack_id': zone.stack_id, 'record_id': record_id, 'name': record_name,
+                      'time': time.time()})
+
+    def record_deleted(self, zone, record_id):
+        """
+        Journal a record that was deleted.
+
+        :param _Zone zone: The zone the record was deleted from.
+        :param str record_id: The ID of the record.
+        """
+        self._append({'op': 'delete', 'zone_id': zone.id, 'record_id': record_id,
+                      'time': time.time()})
+
+    def pending(self):
+        """
+        Return the records created and not deleted since.
+
+        :returns: The ``add`` entries of those records, oldest first.
+        :rtype: list
+        """
+        with self._locked() as handle:
+            return _pending(handle)
+
+    def compact(self):
+        """
+        Rewrite the journal with only the pending records.
+
+        The compacted journal replaces the old one in a single rename, so a crash while
+        compacting cannot lose the pending records.
+        """
+        with self._locked() as handle:
+            entries = _pending(handle)
+            replace_file(self.path, ''.join(json.dumps(entry) + '\n' for entry in entries))
+
+    def _append(self, entry):
+        try:
+            with self._locked() as handle:
+                handle.write(json.dumps(entry) + '\n')
+                handle.flush()
+        except OSError as e:
+            logger.warning('Unable to write to the record journal %s: %s', self.path, e)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Open the journal and yield it, holding an exclusive lock.
+
+        The lock is taken on a separate file, as `compact` replaces the journal itself.
+        """
+        with file_lock(self.path + '.lock'):
+            fd = filesystem.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+            with os.fdopen(fd, 'r+') as handle:
+                yield handle
+
+
+class CleanupQueue:
+    """
+    Durable queue of the TXT records waiting to be deleted, shared by all invocations.
+
+    Records are keyed by zone and record ID, so a record queued twice is only deleted once.
+    They stay queued until their deletion succeeds.
+
+    :param str path: The path of the queue file.
+    """
+
+    def __init__(self, path):
+        self._store = JSONFileStore(path)
+
+    def put(self, records):
+        """
+        Queue records for deletion.
+
+        :param list records: ``(zone, record_id)`` tuples.
+        """
+        with self._store.transaction() as data:
+            for zone, record_id in records:
+                data[f'{zone.id}/{record_id}'] = {'zone_id': zone.id, 'zone_domain': zone.domain,
+                                                  'stack_id': zone.stack_id,
+                                                  'record_id': record_id}
+
+    def pending(self):
+        """
+        Return the records waiting to be deleted.
+
+        :rtype: list
+        """
+        return list(self._store.read().values())
+
+    def remove(self, entries):
+        """
+        Remove records from the queue, once deleted.
+
+        :param list entries: The entries of the records, as returned by `pending`.
+        """
+        with self._store.transaction() as data:
+            for entry in entries:
+                data.pop(f'{entry["zone_id"]}/{entry["record_id"]}', None)
+
+
+def _pending(handle):
+    handle.seek(0)
+    added = {}  # type: dict
+    for line in handle:
+        try:
+            entry = json.loads(line)
+            key = (entry['zone_id'], entry['record_id'])
+            if entry['op'] == 'add':
+                added[key] = entry
+            else:
+                added.pop(key, None)
+        except (ValueError, KeyError, TypeError):
+            # A line cut short by a crash; the rest of the journal is still usable.
+            logger.debug('Ignoring corrupt record journal entry: %r', line)
+    return list(added.values())
@@ -0,0 +1,125 @@
+"""Counts and timings of the operations performed by the StackPath plugin."""
+import contextlib
+import json
+import threading
+import time
+
+import requests
+
+from certbot.compat import filesystem
+from certbot.compat import os
+
+PROMETHEUS_PREFIX = 'certbot_dns_stackpath'
+
+
+class Metrics:
+    """
+    Collects the number and duration of operations, by operation name and outcome.
+
+    API calls are recorded per attempt under names such as ``records.add``; their status is
+    ``ok``, the HTTP status code of the error, or ``error`` for transport failures. Other
+    operations, such as the propagation wait, are recorded the same way.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}  # type: dict
+
+    @contextlib.contextmanager
+    def measure(self, operation):
+        """
+        Time the enclosed block and record it under ``operation``.
+
+        :param str operation: The operation name.
+        """
+        start = time.monotonic()
+        status = 'ok'
+        try:
+            yield
+        except requests.RequestException as e:
+            response = getattr(e, 'response', None)
+            status = str(response.status_code) if response is not None else 'error'
+            raise
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            self.record(operation, status, time.monotonic() - start)
+
+    def record(self, operation, status, seconds):
+        """
+        Record one operation.
+
+        :param str operation: The operation name.
+        :param str status: The outcome of the operation.
+        :param float seconds: How long the operation took.
+        """
+        with self._lock:
+            stats = self._stats.setdefault((operation, status), [0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+
+    def summary(self):
+        """
+        Return the recorded metrics, sorted by operation and status.
+
+        :returns: A list of dicts with the ``operation``, ``status``, ``count`` and total
+            ``seconds``.
+        :rtype: list
+        """
+        with self._lock:
+            return [{'operation': operation, 'status': status, 'count': count, 'seconds': seconds}
+                    for (operation, status), (count, seconds) in sorted(self._stats.items())]
+
+    def format_summary(self):
+        """
+        Return a human-readable summary of the recorded metrics.
+
+        :rtype: str
+        """
+        return '\n'.join(
+            f"{entry['operation']:<20} {entry['status']:<6} {entry['count']:>6} calls "
+            f"{entry['seconds']:>9.3f} s"
+            for entry in self.summary())
+
+    def write(self, path):
+        """
+        Write the recorded metrics to a file.
+
+        Files ending in ``.prom`` are written in the Prometheus text format, for the
+        node_exporter textfile collector; other files are written as JSON. The file is
+        replaced atomically, so readers never see a partial file.
+
+        :param str path: Where to write the metrics.
+        """
+        if path.endswith('.prom'):
+            content = self._format_prometheus()
+        else:
+            content = json.dumps({'operations': self.summary()}, indent=2)
+
+        temp_path = f'{path}.tmp'
+        fd = filesystem.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        with os.fdopen(fd, 'w') as handle:
+            handle.write(content + '\n')
+        filesystem.replace(temp_path, path)
+
+    def _format_prometheus(self):
+        lines = [
+            f'# HELP {PROMETHEUS_PREFIX}_operations_total Number of operations performed.',
+            f'# TYPE {PROMETHEUS_PREFIX}_operations_total counter',
+        ]
+        summary = self.summary()
+        for entry in summary:
+            lines.append(f'{PROMETHEUS_PREFIX}_operations_total{_labels(entry)} {entry["count"]}')
+        lines.extend([
+            f'# HELP {PROMETHEUS_PREFIX}_operation_seconds_total Time spent in operations.',
+            f'# TYPE {PROMETHEUS_PREFIX}_operation_seconds_total counter',
+        ])
+        for entry in summary:
+            lines.append(f'{PROMETHEUS_PREFIX}_operation_seconds_total{_labels(entry)} '
+                         f'{entry["seconds"]:.6f}')
+        return '\n'.join(lines)
+
+
+def _labels(entry):
+    return f'{{operation="{entry["operation"]}",status="{entry["status"]}"}}'
@@ -0,0 +1,138 @@
+"""Checks whether TXT records are visible on the authoritative nameservers of their zone."""
+import concurrent.futures
+import logging
+import threading
+import time
+
+try:
+    import dns.exception
+    import dns.message
+    import dns.query
+    import dns.rdatatype
+    import dns.resolver
+except ImportError:  # pragma: no cover
+    dns = None  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+
+def available():
+    """
+    Whether propagation checks are supported, which requires the optional ``dnspython``.
+
+    :rtype: bool
+    """
+    return dns is not None
+
+
+class PropagationChecker:
+    """
+    Polls the authoritative nameservers of zones until TXT records are visible on all of them.
+
+    The nameservers of each zone are found through the system resolver and cached.
+
+    :param float interval: Number of seconds between two polls.
+    :param float query_timeout: Number of seconds to wait for a nameserver to answer.
+    :param int max_workers: Maximum number of DNS queries in flight at once.
+    """
+
+    def __init__(self, interval=1.0, query_timeout=2.0, max_workers=10):
+        self.interval = interval
+        self.query_timeout = query_timeout
+        self.max_workers = max_workers
+        self._nameservers = {}  # type: dict
+        self._lock = threading.Lock()
+
+    def wait(self, records, timeout, seen_after=None):
+        """
+        Wait until every record is visible, or until the timeout expires.
+
+        :param list records: ``(zone_domain, record_name, record_content)`` tuples.
+        :param float timeout: Maximum number of seconds to wait.
+        :param dict seen_after: Optional dict in which the number of seconds after which each
+            record was first seen is stored, keyed by record.
+        :returns: Whether all the records were seen before the timeout.
+        :rtype: bool
+        """
+        start = time.monotonic()
+        deadline = start + timeout
+        pending = list(set(records))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending:
+                visible = list(executor.map(self._is_visible, pending))
+                if seen_after is not None:
+                    elapsed = time.monotonic() - start
+                    seen_after.update((record, elapsed)
+                                      for record, seen in zip(pending, visible) if seen)
+                pending = [record for record, seen in zip(pending, visible) if not seen]
+                remaining = deadline - time.monotonic()
+                if pending and remaining <= 0:
+                    logger.debug('TXT records not yet visible: %s', pending)
+                    return False
+                if pending:
+                    time.sleep(min(self.interval, remaining))
+        return True
+
+    def _is_visible(self, record):
+        zone_domain, record_name, record_content = record
+        nameservers = self._get_nameservers(zone_domain)
+        if not nameservers:
+            return False
+        return all(record_content in self._query_txt(address, record_name)
+                   for address in nameservers)
+
+    def _get_nameservers(self, zone_domain):
+        """
+        Return the addresses of the authoritative nameservers of a zone.
+
+        The addresses are cached once found; a failed lookup is tried again on the next poll.
+
+        :param str zone_domain: The zone's domain.
+        :returns: The addresses, empty if none could be found.
+        :rtype: list
+        """
+        with self._lock:
+            if zone_domain in self._nameservers:
+                return self._nameservers[zone_domain]
+
+        resolve = getattr(dns.resolver, 'resolve', None) or dns.resolver.query
+        try:
+            nameservers = [ns.target for ns in resolve(zone_domain, 'NS')]
+        except dns.exception.DNSException as e:
+            logger.debug('Unable to find the nameservers of %s: %s', zone_domain, e)
+            return []
+        addresses = []
+        for nameserver in nameservers:
+            try:
+                addresses.extend(address.to_text() for address in resolve(nameserver, 'A'))
+            except dns.exception.DNSException as e:
+                logger.debug('Unable to resolve the nameserver %s of %s: %s',
+                             nameserver, zone_domain, e)
+
+        if addresses:
+            with self._lock:
+                self._nameservers[zone_domain] = addresses
+        return addresses
+
+    def _query_txt(self, address, record_name):
+        """
+        Query a nameserver for the TXT records of a name.
+
+        :param str address: The nameserver's IP address.
+        :param str record_name: The name to query.
+        :returns: The TXT values found, empty if the query failed.
+        :rtype: set
+        """
+        request = dns.message.make_query(record_name, dns.rdatatype.TXT)
+        try:
+            response = dns.query.udp(request, address, timeout=self.query_timeout)
+        except (dns.exception.DNSException, OSError) as e:
+            logger.debug('Error querying %s for %s: %s', address, record_name, e)
+            return set()
+
+        values = set()
+        for rrset in response.answer:
+            if rrset.rdtype == dns.rdatatype.TXT:
+                for rdata in rrset:
+                    values.add(b''.join(rdata.strings).decode())
+        return values
@@ -0,0 +1,297 @@
+"""Retries and client-side rate limiting of StackPath API calls."""
+import asyncio
+import email.utils
+import logging
+import random
+import threading
+import time
+
+import requests
+
+from certbot_dns_stackpath._internal.cache import JSONFileStore
+
+logger = logging.getLogger(__name__)
+
+# Statuses worth retrying: the request was throttled or the server had a transient failure.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# The deadline, as a time.monotonic() value, of the call the current thread is making.
+_call_state = threading.local()
+
+
+def remaining_time():
+    """
+    Return the number of seconds left before the deadline of the call `RetryPolicy.call` is
+    making in the current thread, so that requests can be cut short at that deadline.
+
+    :returns: The seconds left, or ``None`` if there is no such deadline.
+    :rtype: float
+    """
+    deadline = getattr(_call_state, 'deadline', None)
+    return None if deadline is None else deadline - time.monotonic()
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all the threads making API calls.
+
+    :param float rate: Number of calls allowed per second, on average.
+    :param int burst: Number of calls that may be made at once after a quiet period.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a call may be made."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Hold back every call for some time, e.g. after the API asked us to slow down.
+
+        :param float seconds: Number of seconds to pause for.
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+
+class SharedRateLimiter:
+    """
+    Token bucket shared by all the processes on this host using the same file.
+
+    It behaves as `RateLimiter`, except that the bucket and pauses are kept in a file, so
+    concurrent Certbot processes draw from a single budget and all hold back when one of them
+    is throttled. With a rate of 0, calls are not limited but pauses are still shared.
+
+    :param str path: The path of the file holding the bucket.
+    :param float rate: Number of calls allowed per second, on average, across processes.
+    :param int burst: Number of calls that may be made at once after a quiet period.
+    :param str key: The name of the bucket in the file, e.g. the API client ID.
+    """
+
+    def __init__(self, path, rate, burst=None, key='default'):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.key = key
+        # Updated on every call when calls are limited, and harmless to lose.
+        self._store = JSONFileStore(path, sync=False)
+
+    def acquire(self):
+        """Block until a call may be made."""
+        if not self.rate:
+            # Only pauses are shared: they are written by `pause`, and reading them needs no
+            # lock, so calls do not serialize on the file.
+            while True:
+                bucket = self._store.read().get(self.key)
+                wait = bucket['paused_until'] - time.time() if bucket else 0
+                if wait <= 0:
+                    return
+                time.sleep(wait)
+        while True:
+            with self._store.transaction() as data:
+                # Wall-clock time: monotonic clocks are not comparable across processes.
+                now = time.time()
+                bucket = data.setdefault(self.key, {'tokens': float(self.burst), 'updated': now,
+                                                    'paused_until': 0.0})
+                bucket['tokens'] = min(self.burst, bucket['tokens']
+                                       + max(0.0, now - bucket['updated']) * self.rate)
+                bucket['updated'] = now
+                wait = max(bucket['paused_until'] - now, (1 - bucket['tokens']) / self.rate)
+                if wait <= 0:
+                    bucket['tokens'] -= 1
+                    return
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Hold back every call, in every process, for some time.
+
+        :param float seconds: Number of seconds to pause for.
+        """
+        with self._store.transaction() as data:
+            bucket = data.setdefault(self.key, {'tokens': 0.0, 'updated': time.time(),
+                                                'paused_until': 0.0})
+            bucket['paused_until'] = max(bucket['paused_until'], time.time() + seconds)
+            bucket['tokens'] = 0.0
+
+
+class RetryPolicy:
+    """
+    Retries failed API calls with jittered exponential backoff.
+
+    Throttled calls (429) are retried after the delay requested by the ``Retry-After`` header
+    when there is one. Server errors and connection failures are only retried for idempotent
+    calls, since the failed request may have been processed.
+
+    :param int max_attempts: Maximum number of attempts per call.
+    :param float backoff: Base delay, in seconds, doubled after every failed attempt.
+    :param float max_backoff: Maximum delay between two attempts, in seconds, unless the
+        server asks for a longer one with ``Retry-After``.
+    :param RateLimiter rate_limiter: Optional rate limiter every attempt goes through, either a
+        `RateLimiter` or a `SharedRateLimiter`.
+    :param float deadline: Optional number of seconds a call may take, counted from its first
+        attempt. It is not retried past that point; with `call_async`, an attempt still running
+        at the deadline is abandoned, while with `call` the timeouts of its requests are cut
+        to the time left (see `remaining_time`).
+    """
+
+    def __init__(self, max_attempts=5, backoff=0.5, max_backoff=30.0, rate_limiter=None,
+                 deadline=None):
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rate_limiter = rate_limiter
+        self.deadline = deadline
+
+    def call(self, func, idempotent=True):
+        """
+        Call ``func`` until it succeeds, it fails permanently or the attempts are exhausted.
+
+        :param callable func: Makes the API call; called without arguments.
+        :param bool idempotent: Whether the call may safely be repeated after a server error.
+        :returns: What ``func`` returned.
+        :raises requests.RequestException: the error of the last attempt.
+        """
+        attempt = 1
+        start = time.monotonic()
+        outer_deadline = getattr(_call_state, 'deadline', None)
+        if self.deadline is not None:
+            _call_state.deadline = min(filter(None, (outer_deadline, start + self.deadline)))
+        try:
+            while True:
+                if self.rate_limiter:
+                    self.rate_limiter.acquire()
+                try:
+                    return func()
+                except requests.RequestException as e:
+                    delay = self._get_retry_delay(e, attempt, idempotent, start)
+                    if delay is None:
+                        raise
+                    if self.rate_limiter and _status(e) == 429:
+                        self.rate_limiter.pause(delay)
+                time.sleep(delay)
+                attempt += 1
+        finally:
+            _call_state.deadline = outer_deadline
+
+    async def call_async(self, func, idempotent=True):
+        """
+        Await ``func()`` until it succeeds, it fails permanently or the attempts are exhausted.
+
+        This is `call` for coroutines: the delays between attempts are awaited, and the rate
+        limiter, which may block on a lock file, is called from the loop's default executor.
+
+        :param callable func: Returns a coroutine making the API call; called without arguments.
+        :param bool idempotent: Whether the call may safely be repeated after a server error.
+        :returns: What the coroutine returned.
+        :raises requests.RequestException: the error of the last attempt.
+        """
+        loop = asyncio.get_event_loop()
+        attempt = 1
+        start = time.monotonic()
+        while True:
+            if self.rate_limiter:
+                await loop.run_in_executor(None, self.rate_limiter.acquire)
+            try:
+                return await self._attempt_async(func, start)
+            except requests.RequestException as e:
+                delay = self._get_retry_delay(e, attempt, idempotent, start)
+                if delay is None:
+                    raise
+                if self.rate_limiter and _status(e) == 429:
+                    await loop.run_in_executor(None, self.rate_limiter.pause, delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _attempt_async(self, func, start):
+        """Await ``func()``, abandoning it at the deadline of a call started at ``start``."""
+        if self.deadline is None:
+            return await func()
+        try:
+            return await asyncio.wait_for(func(),
+                                          max(0.0, self.deadline - (time.monotonic() - start)))
+        except asyncio.TimeoutError:
+            raise requests.Timeout(f'StackPath API call did not complete within '
+                                   f'{self.deadline:g} seconds')
+
+    def _get_retry_delay(self, error, attempt, idempotent, start):
+        """
+        Return how long to wait before retrying after ``error``, or None not to retry, taking
+        the deadline of a call first attempted at ``start`` into account.
+        """
+        delay = self._get_delay(error, attempt, idempotent)
+        if delay is None:
+            return None
+        if self.deadline is not None and time.monotonic() - start + delay > self.deadline:
+            logger.debug('StackPath API call failed (%s), not retrying after %.1f seconds',
+                         error, time.monotonic() - start)
+            return None
+        logger.debug('StackPath API call failed (%s), retrying in %.1f seconds', error, delay)
+        return delay
+
+    def _get_delay(self, error, attempt, idempotent):
+        """Return how long to wait before retrying after ``error``, or None not to retry."""
+        if attempt >= self.max_attempts:
+            return None
+        status = _status(error)
+        if status == 429:
+            retry_after = _retry_after(error.response)
+            if retry_after is not None:
+                return retry_after
+        elif not idempotent:
+            return None
+        elif status is None and not isinstance(error, (requests.ConnectionError,
+                                                       requests.Timeout)):
+            return None
+        elif status is not None and status not in RETRY_STATUSES:
+            return None
+        # "Full jitter": spreads out the retries of concurrent callers.
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+
+def raise_for_status(response, *unused_args, **unused_kwargs):
+    """
+    Response hook raising `requests.HTTPError` for failed API calls.
+
+    pystackpath does not check response statuses itself. 401 responses are left alone so
+    that pystackpath can refresh the OAuth token and repeat the request.
+    """
+    if response.status_code != 401:
+        response.raise_for_status()
+
+
+def _status(error):
+    response = getattr(error, 'response', None)
+    return response.status_code if response is not None else None
+
+
+def _retry_after(response):
+    """Parse a Retry-After header, in seconds or as an HTTP date."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
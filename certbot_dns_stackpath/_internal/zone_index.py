@@ -0,0 +1,57 @@
+"""Suffix index mapping domains to the StackPath zones that contain them."""
+
+# Key under which a trie node stores the zone ending at that node. Labels are never None.
+_ZONE = None
+
+
+class ZoneIndex:
+    """
+    Trie of zone domains keyed by their labels in reverse order.
+
+    Looking up a domain walks its labels from the TLD down and returns the deepest zone on
+    the way, i.e. the zone with the longest matching suffix.
+    """
+
+    def __init__(self):
+        self._root = {}  # type: dict
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, domain, zone_id, stack_id=None):
+        """
+        Add a zone to the index, replacing any zone with the same domain.
+
+        :param str domain: The zone's domain.
+        :param str zone_id: The zone's ID.
+        :param str stack_id: The ID of the stack the zone belongs to.
+        """
+        node = self._root
+        for label in _labels(domain):
+            node = node.setdefault(label, {})
+        if _ZONE not in node:
+            self._size += 1
+        node[_ZONE] = (zone_id, domain, stack_id)
+
+    def find(self, domain):
+        """
+        Find the zone containing a domain.
+
+        :param str domain: The domain to look up.
+        :returns: A ``(zone_id, zone_domain, stack_id)`` tuple, or ``None`` if no zone
+            contains it.
+        :rtype: tuple
+        """
+        node = self._root
+        match = None
+        for label in _labels(domain):
+            node = node.get(label)
+            if node is None:
+                break
+            match = node.get(_ZONE, match)
+        return match
+
+
+def _labels(domain):
+    return reversed(domain.lower().rstrip('.').split('.'))
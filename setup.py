@@ -17,6 +17,14 @@ install_requires = [
     'certbot>=1.1.0',
 ]
 
+propagation_extras = [
+    'dnspython>=1.15.0',
+]
+
+async_extras = [
+    'aiohttp>=3.6',
+]
+
 docs_extras = [
     'Sphinx>=1.0',  # autodoc_member_order = 'bysource', autodoc_default_flags
     'sphinx_rtd_theme',
@@ -55,9 +63,14 @@ setup(
     include_package_data=True,
     install_requires=install_requires,
     extras_require={
+        'async': async_extras,
         'docs': docs_extras,
+        'propagation': propagation_extras,
     },
     entry_points={
+        'console_scripts': [
+            'certbot-dns-stackpath = certbot_dns_stackpath._internal.cli:main',
+        ],
         'certbot.plugins': [
             'dns-stackpath = certbot_dns_stackpath._internal.dns_stackpath:Authenticator',
         ],
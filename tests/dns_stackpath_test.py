@@ -1,17 +1,30 @@
 """Tests for certbot_dns_stackpath._internal.dns_stackpath."""
 
+import asyncio
+import collections
+import io
+import json
+import re
+import subprocess
+import sys
+import threading
+import time
 import unittest
 
 import pystackpath
+import requests
 try:
     import mock
 except ImportError: # pragma: no cover
     from unittest import mock # type: ignore
 
+from certbot import achallenges
 from certbot import errors
+from certbot.compat import filesystem
 from certbot.compat import os
 from certbot.plugins import dns_test_common
 from certbot.plugins.dns_test_common import DOMAIN
+from certbot.tests import acme_util
 from certbot.tests import util as test_util
 
 API_ERROR = pystackpath.HTTPError()
@@ -30,33 +43,316 @@ class AuthenticatorTest(test_util.TempDirTestCase, dns_test_common.BaseAuthentic
 
         path = os.path.join(self.tempdir, 'file.ini')
         dns_test_common.write({
-            "dns_stackpath_client_id": CLIENT_ID,
-            "dns_stackpath_client_secret": CLIENT_SECRET,
-            "dns_stackpath_stack_id": STACK_ID
+            "stackpath_client_id": CLIENT_ID,
+            "stackpath_client_secret": CLIENT_SECRET,
+            "stackpath_stack_id": STACK_ID
         }, path)
 
         self.config = mock.MagicMock(stackpath_credentials=path,
-                                     stackpath_propagation_seconds=0)  # don't wait during tests
+                                     stackpath_propagation_seconds=0,  # don't wait during tests
+                                     stackpath_token_cache=False,
+                                     stackpath_zone_cache_ttl=3600,
+                                     stackpath_zone_cache=False,
+                                     stackpath_shared_state=False,
+                                     stackpath_zone_discovery='filter',
+                                     stackpath_propagation_check=False,
+                                     stackpath_adaptive_propagation=False,
+                                     stackpath_adaptive_percentile=95,
+                                     stackpath_adaptive_margin=5,
+                                     stackpath_persistent_records=False,
+                                     stackpath_cleanup_placeholder=None,
+                                     stackpath_deferred_cleanup=False,
+                                     stackpath_max_retries=4,
+                                     stackpath_rate_limit=0,
+                                     stackpath_metrics_file=None,
+                                     stackpath_max_workers=4,
+                                     stackpath_pool_size=None,
+                                     stackpath_connect_timeout=10,
+                                     stackpath_read_timeout=30,
+                                     stackpath_operation_timeout=120,
+                                     work_dir=self.tempdir)
 
         self.auth = Authenticator(self.config, "stackpath")
 
+        # Run the calls on the mock client, through the executor-backed client.
+        patcher = mock.patch('certbot_dns_stackpath._internal.async_client.available',
+                             return_value=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
         self.mock_client = mock.MagicMock()
         # _get_stackpath_client | pylint: disable=protected-access
         self.auth._get_stackpath_client = mock.MagicMock(return_value=self.mock_client)
 
     def test_perform(self):
         self.auth.perform([self.achall])
-        expected = [mock.call.add_txt_record(DOMAIN, '_acme-challenge.'+DOMAIN, mock.ANY, mock.ANY)]
+        expected = [mock.call.find_zone(DOMAIN),
+                    mock.call.add_txt_record(DOMAIN, '_acme-challenge.'+DOMAIN, mock.ANY, mock.ANY,
+                                             zone=self.mock_client.find_zone.return_value,
+                                             journal=True)]
         self.assertEqual(expected, self.mock_client.mock_calls)
 
+    def test_perform_fails_fast_on_unknown_zone(self):
+        achalls = [achallenges.KeyAuthorizationAnnotatedChallenge(
+            challb=acme_util.DNS01, domain=domain, account_key=dns_test_common.KEY)
+            for domain in (DOMAIN, 'unknown.org')]
+
+        def find_zone(domain):
+            if domain == 'unknown.org':
+                raise errors.PluginError('Zone ID for domain unknown.org not found')
+            return mock.sentinel.zone
+        self.mock_client.find_zone.side_effect = find_zone
+
+        with self.assertRaises(errors.PluginError) as context:
+            self.auth.perform(achalls)
+        self.assertIn('unknown.org', str(context.exception))
+        self.mock_client.add_txt_record.assert_not_called()
+
     def test_cleanup(self):
         # _attempt_cleanup | pylint: disable=protected-access
         self.auth._attempt_cleanup = True
         self.auth.cleanup([self.achall])
 
-        expected = [mock.call.del_txt_record(DOMAIN, '_acme-challenge.'+DOMAIN, mock.ANY)]
+        expected = [mock.call.del_txt_records(DOMAIN, '_acme-challenge.'+DOMAIN, [mock.ANY])]
+        self.assertEqual(expected, self.mock_client.mock_calls)
+
+    def test_cleanup_groups_records_by_name(self):
+        # The challenges of example.com and *.example.com share a validation name.
+        wildcard_achall = achallenges.KeyAuthorizationAnnotatedChallenge(
+            challb=acme_util.DNS01_2, domain=DOMAIN, account_key=dns_test_common.KEY)
+        # _attempt_cleanup | pylint: disable=protected-access
+        self.auth._attempt_cleanup = True
+        self.auth.cleanup([self.achall, wildcard_achall])
+
+        expected = [mock.call.del_txt_records(DOMAIN, '_acme-challenge.'+DOMAIN,
+                                              [mock.ANY, mock.ANY])]
+        self.assertEqual(expected, self.mock_client.mock_calls)
+
+    def test_cleanup_after_perform(self):
+        self.mock_client.add_txt_record.return_value = ('zone', 'record_id')
+        self.auth.perform([self.achall])
+        self.auth.cleanup([self.achall])
+
+        expected = [mock.call.find_zone(DOMAIN),
+                    mock.call.add_txt_record(DOMAIN, '_acme-challenge.'+DOMAIN, mock.ANY, mock.ANY,
+                                             zone=mock.ANY, journal=True),
+                    mock.call.del_txt_record_by_id('zone', 'record_id')]
         self.assertEqual(expected, self.mock_client.mock_calls)
 
+    def test_perform_concurrently(self):
+        achalls = [achallenges.KeyAuthorizationAnnotatedChallenge(
+            challb=acme_util.DNS01, domain=f'{name}.{DOMAIN}', account_key=dns_test_common.KEY)
+            for name in ('a', 'b', 'c')]
+        self.auth.perform(achalls)
+
+        self.assertEqual(sorted(f'_acme-challenge.{name}.{DOMAIN}' for name in ('a', 'b', 'c')),
+                         sorted(call[0][1] for call in self.mock_client.add_txt_record.call_args_list))
+
+    def test_perform_reports_every_failure(self):
+        achalls = [achallenges.KeyAuthorizationAnnotatedChallenge(
+            challb=acme_util.DNS01, domain=f'{name}.{DOMAIN}', account_key=dns_test_common.KEY)
+            for name in ('a', 'b', 'c')]
+
+        def add_txt_record(domain, *unused_args, **unused_kwargs):
+            if domain != 'b.' + DOMAIN:
+                raise errors.PluginError('failed')
+            return ('zone', 'record_id')
+        self.mock_client.add_txt_record.side_effect = add_txt_record
+
+        with self.assertRaises(errors.PluginError) as context:
+            self.auth.perform(achalls)
+        self.assertIn('a.' + DOMAIN, str(context.exception))
+        self.assertIn('c.' + DOMAIN, str(context.exception))
+        self.assertEqual(3, self.mock_client.add_txt_record.call_count)
+
+    def test_persistent_records(self):
+        from certbot_dns_stackpath._internal.client import _Zone
+        from certbot_dns_stackpath._internal.dns_stackpath import Authenticator
+
+        self.config.stackpath_persistent_records = True
+        zone = _Zone('zone1', DOMAIN, STACK_ID)
+        self.mock_client.find_zone.return_value = zone
+        self.mock_client.add_txt_record.return_value = (zone, 'record1')
+        self.auth.perform([self.achall])
+        self.auth.cleanup([self.achall])
+
+        self.mock_client.add_txt_record.assert_called_once_with(
+            DOMAIN, '_acme-challenge.' + DOMAIN, mock.ANY, mock.ANY, zone=zone, journal=False)
+        self.mock_client.del_txt_record_by_id.assert_not_called()
+        self.mock_client.update_txt_record.assert_not_called()
+
+        # The next run updates the record it created.
+        auth = Authenticator(self.config, "stackpath")
+        # _get_stackpath_client | pylint: disable=protected-access
+        auth._get_stackpath_client = mock.MagicMock(return_value=self.mock_client)
+        auth.perform([self.achall])
+        auth.cleanup([self.achall])
+
+        self.assertEqual(1, self.mock_client.add_txt_record.call_count)
+        self.mock_client.update_txt_record.assert_called_once_with(
+            zone, 'record1', self.achall.validation(self.achall.account_key), mock.ANY)
+        self.mock_client.del_txt_record_by_id.assert_not_called()
+
+    def test_persistent_record_recreated(self):
+        from certbot_dns_stackpath._internal.client import _Zone
+
+        self.config.stackpath_persistent_records = True
+        self.config.stackpath_cleanup_placeholder = 'placeholder'
+        zone = _Zone('zone1', DOMAIN, STACK_ID)
+        self.mock_client.find_zone.return_value = zone
+        self.mock_client.add_txt_record.side_effect = [(zone, 'record1'), (zone, 'record2')]
+        self.auth.perform([self.achall])
+        # The record was deleted behind our back.
+        self.mock_client.update_txt_record.return_value = False
+        self.auth.perform([self.achall])
+        self.mock_client.update_txt_record.reset_mock()
+        self.auth.cleanup([self.achall])
+
+        self.assertEqual(2, self.mock_client.add_txt_record.call_count)
+        self.mock_client.update_txt_record.assert_called_once_with(
+            zone, 'record2', 'placeholder', mock.ANY)
+
+    def test_persistent_record_moved_zone(self):
+        from certbot_dns_stackpath._internal.client import _Zone
+
+        self.config.stackpath_persistent_records = True
+        old_zone = _Zone('zone1', DOMAIN, STACK_ID)
+        zone = _Zone('zone2', DOMAIN, STACK_ID)
+        self.mock_client.find_zone.side_effect = [old_zone, zone]
+        self.mock_client.add_txt_record.side_effect = [(old_zone, 'record1'), (zone, 'record2')]
+        self.mock_client.del_txt_record_by_id.return_value = False
+        self.auth.perform([self.achall])
+        self.auth._zones.clear()  # pylint: disable=protected-access
+        self.auth.perform([self.achall])
+
+        self.mock_client.update_txt_record.assert_not_called()
+        self.mock_client.del_txt_record_by_id.assert_called_once_with(old_zone, 'record1')
+        # The deletion failed, so the record is left to the sweep.
+        # _get_journal | pylint: disable=protected-access
+        self.assertEqual(['record1'],
+                         [entry['record_id'] for entry in self.auth._get_journal().pending()])
+        # _get_persistent_records | pylint: disable=protected-access
+        kept = self.auth._get_persistent_records('_acme-challenge.' + DOMAIN)
+        self.assertEqual(['record2'], [entry['record_id'] for entry in kept])
+
+    def test_deferred_cleanup(self):
+        from certbot_dns_stackpath._internal.client import _Zone
+        from certbot_dns_stackpath._internal.dns_stackpath import Authenticator
+
+        self.config.stackpath_deferred_cleanup = True
+        zone = _Zone('zone1', DOMAIN, STACK_ID)
+        self.mock_client.add_txt_record.return_value = (zone, 'record1')
+        self.mock_client.del_txt_record_by_id.return_value = False
+        self.auth.perform([self.achall])
+        self.auth.cleanup([self.achall])
+        # _cleanup_worker | pylint: disable=protected-access
+        self.auth._cleanup_worker.join()
+
+        self.mock_client.del_txt_record_by_id.assert_called_once_with(zone, 'record1')
+        self.mock_client.del_txt_records.assert_not_called()
+
+        # The deletion failed, so the next run retries it.
+        self.mock_client.del_txt_record_by_id.reset_mock()
+        self.mock_client.del_txt_record_by_id.return_value = True
+        auth = Authenticator(self.config, "stackpath")
+        # _get_stackpath_client | pylint: disable=protected-access
+        auth._get_stackpath_client = mock.MagicMock(return_value=self.mock_client)
+        auth.perform([])
+        auth._cleanup_worker.join()  # pylint: disable=protected-access
+
+        self.mock_client.del_txt_record_by_id.assert_called_once_with(zone, 'record1')
+        # _get_cleanup_queue | pylint: disable=protected-access
+        self.assertEqual([], auth._get_cleanup_queue().pending())
+
+    def test_perform_checks_propagation(self):
+        from certbot_dns_stackpath._internal.client import _Zone
+
+        self.config.stackpath_propagation_check = True
+        self.mock_client.add_txt_record.return_value = (_Zone('zone1', DOMAIN, STACK_ID), 'record_id')
+        # _propagation_checker | pylint: disable=protected-access
+        self.auth._propagation_checker = mock.MagicMock()
+        self.auth.perform([self.achall])
+
+        self.auth._propagation_checker.wait.assert_called_once_with(
+            [(DOMAIN, '_acme-challenge.' + DOMAIN, mock.ANY)], 0, {})
+
+    @mock.patch('certbot_dns_stackpath._internal.dns_stackpath.time.sleep')
+    def test_adaptive_propagation(self, sleep):
+        from certbot_dns_stackpath._internal.cache import PropagationHistory
+        from certbot_dns_stackpath._internal.client import _Zone
+
+        self.config.stackpath_adaptive_propagation = True
+        self.config.stackpath_propagation_seconds = 120
+        history = PropagationHistory(os.path.join(self.tempdir, 'dns-stackpath',
+                                                  'propagation.json'))
+        for seconds in (10, 20, 30, 40, 50):
+            history.record({DOMAIN: seconds})
+        self.mock_client.add_txt_record.return_value = (_Zone('zone1', DOMAIN, STACK_ID), 'record_id')
+        # _propagation_checker | pylint: disable=protected-access
+        self.auth._propagation_checker = mock.MagicMock()
+
+        def wait(records, unused_timeout, seen_after):
+            seen_after.update((record, 1.0) for record in records)
+            return True
+        self.auth._propagation_checker.wait.side_effect = wait
+        self.auth.perform([self.achall])
+
+        # Records seen early are still waited for as long as the zone usually takes.
+        self.assertAlmostEqual(55, sleep.call_args[0][0], delta=1)
+        self.assertEqual(1.0, history.estimate(DOMAIN, 0, min_samples=6))
+
+    @mock.patch('certbot_dns_stackpath._internal.dns_stackpath.time.sleep')
+    def test_adaptive_propagation_without_history(self, sleep):
+        from certbot_dns_stackpath._internal.client import _Zone
+
+        self.config.stackpath_adaptive_propagation = True
+        self.config.stackpath_propagation_seconds = 120
+        self.mock_client.add_txt_record.return_value = (_Zone('zone1', DOMAIN, STACK_ID), 'record_id')
+        # _propagation_checker | pylint: disable=protected-access
+        self.auth._propagation_checker = mock.MagicMock()
+        self.auth._propagation_checker.wait.return_value = False
+        self.auth.perform([self.achall])
+
+        self.auth._propagation_checker.wait.assert_called_once_with(mock.ANY, 120, mock.ANY)
+        sleep.assert_not_called()
+
+    def test_metrics_file(self):
+        path = os.path.join(self.tempdir, 'metrics.json')
+        self.config.stackpath_metrics_file = path
+        self.auth.perform([self.achall])
+
+        with open(path) as f:
+            operations = json.load(f)['operations']
+        self.assertEqual(['propagation'], [entry['operation'] for entry in operations])
+
+    def test_client_reused(self):
+        from certbot_dns_stackpath._internal.dns_stackpath import Authenticator
+
+        auth = Authenticator(self.config, "stackpath")
+        # _setup_credentials | pylint: disable=protected-access
+        auth._setup_credentials()
+        # _get_stackpath_client | pylint: disable=protected-access
+        self.assertIs(auth._get_stackpath_client(), auth._get_stackpath_client())
+
+    def test_token_cache(self):
+        from certbot_dns_stackpath._internal.cache import TokenCache
+
+        self.config.stackpath_token_cache = True
+        # _get_token_cache | pylint: disable=protected-access
+        self.assertIsInstance(self.auth._get_token_cache(), TokenCache)
+
+    def test_shared_state(self):
+        from certbot_dns_stackpath._internal.cache import TokenCache
+        from certbot_dns_stackpath._internal.retry import SharedRateLimiter
+
+        self.config.stackpath_shared_state = True
+        # _setup_credentials, _get_* | pylint: disable=protected-access
+        self.auth._setup_credentials()
+        self.assertIsInstance(self.auth._get_token_cache(), TokenCache)
+        self.assertIsNotNone(self.auth._get_zone_cache()._store)
+        limiter = self.auth._get_retry_policy().rate_limiter
+        self.assertIsInstance(limiter, SharedRateLimiter)
+        self.assertEqual(CLIENT_ID, limiter.key)
+
     def test_no_credentials(self):
         dns_test_common.write({}, self.config.stackpath_credentials)
         self.assertRaises(errors.PluginError,
@@ -93,15 +389,19 @@ class StackPathClientTest(unittest.TestCase):
     record_id = 2
 
     def setUp(self):
-        from certbot_dns_stackpath._internal.dns_stackpath import _StackPathClient
+        from certbot_dns_stackpath._internal.client import _StackPathClient
 
         self.stackpath_client = _StackPathClient(CLIENT_ID, CLIENT_SECRET, STACK_ID)
 
         self.stackpath = mock.MagicMock()
+        self.stackpath.client.send.return_value.json.return_value = {
+            'access_token': 'token123',
+            'expires_in': 3600
+        }
         self.stackpath_client.stackpath = self.stackpath
 
     def test_add_txt_record(self):
-        self.stackpath.stacks().get() \
+        self.stackpath.stacks().pk() \
             .zones().index.return_value = {
                 'zones': [
                     pystackpath.util.BaseObject(client=mock.ANY).loaddict({
@@ -112,13 +412,13 @@ class StackPathClientTest(unittest.TestCase):
         self.stackpath_client.add_txt_record(DOMAIN, self.record_name, self.record_content,
                                               self.record_ttl)
 
-        self.stackpath.stacks().get().zones().get().records().add.assert_called_with(name=mock.ANY,
+        self.stackpath.stacks().pk().zones().pk().records().add.assert_called_with(name=mock.ANY,
                                                                                      type=mock.ANY,
                                                                                      ttl=mock.ANY,
                                                                                      data=mock.ANY,
                                                                                      weight=mock.ANY)
 
-        post_data = self.stackpath.stacks().get().zones().get().records().add.call_args[1]
+        post_data = self.stackpath.stacks().pk().zones().pk().records().add.call_args[1]
         self.assertEqual('TXT', post_data['type'])
         self.assertEqual(self.record_name, post_data['name'])
         self.assertEqual(self.record_content, post_data['data'])
@@ -126,6 +426,1130 @@ class StackPathClientTest(unittest.TestCase):
         self.assertEqual(self.record_weight, post_data['weight'])
 
 
+    def test_add_txt_record_error(self):
+        self.stackpath.stacks().pk().zones().index.return_value = {
+            'zones': [pystackpath.util.BaseObject(client=mock.ANY).loaddict({'id': self.zone_id})]
+        }
+        self.stackpath.stacks().pk().zones().pk().records().add.side_effect = API_ERROR
+        self.assertRaises(errors.PluginError, self.stackpath_client.add_txt_record,
+                          DOMAIN, self.record_name, self.record_content, self.record_ttl)
+
+    def test_transport_settings(self):
+        from certbot_dns_stackpath._internal.client import _StackPathClient
+
+        client = _StackPathClient(CLIENT_ID, CLIENT_SECRET, STACK_ID, timeout=(1, 2),
+                                  pool_size=20)
+        adapter = client.stackpath.client.get_adapter('https://gateway.stackpath.com/')
+        self.assertEqual(20, adapter._pool_maxsize)  # pylint: disable=protected-access
+
+        with mock.patch('requests.adapters.HTTPAdapter.send') as send:
+            adapter.send(mock.sentinel.request)
+            adapter.send(mock.sentinel.request, timeout=5)
+        self.assertEqual([(1, 2), 5], [call[1]['timeout'] for call in send.call_args_list])
+
+    def test_token_reused_until_expiry(self):
+        self.stackpath_client._ensure_token()  # pylint: disable=protected-access
+        self.stackpath_client._ensure_token()  # pylint: disable=protected-access
+        self.assertEqual(1, self.stackpath.client.send.call_count)
+        self.assertEqual('token123', self.stackpath.client._token)  # pylint: disable=protected-access
+
+        self.stackpath_client._token_expires_at = 0  # pylint: disable=protected-access
+        self.stackpath_client._ensure_token()  # pylint: disable=protected-access
+        self.assertEqual(2, self.stackpath.client.send.call_count)
+
+    def test_token_error(self):
+        self.stackpath.client.send.return_value.raise_for_status.side_effect = API_ERROR
+        self.assertRaises(errors.PluginError,
+                          self.stackpath_client._ensure_token)  # pylint: disable=protected-access
+
+    def test_token_cache_consulted(self):
+        token_cache = mock.MagicMock()
+        token_cache.fetch.return_value = ('cached123', time.time() + 3600)
+        self.stackpath_client.token_cache = token_cache
+
+        self.stackpath_client._ensure_token()  # pylint: disable=protected-access
+        self.assertEqual('cached123', self.stackpath.client._token)  # pylint: disable=protected-access
+        self.assertEqual(0, self.stackpath.client.send.call_count)
+
+    def test_find_zone_cached(self):
+        from certbot_dns_stackpath._internal.cache import ZoneCache
+
+        self.stackpath_client.zone_cache = ZoneCache(3600)
+        self.stackpath.stacks().pk().zones().index.side_effect = [
+            {'zones': []},
+            {'zones': [pystackpath.util.BaseObject(client=mock.ANY).loaddict({'id': self.zone_id})]},
+        ]
+        self.assertEqual(self.zone_id, self.stackpath_client.find_zone('www.' + DOMAIN).id)
+        self.assertEqual(self.zone_id, self.stackpath_client.find_zone('www.' + DOMAIN).id)
+        self.assertEqual(2, self.stackpath.stacks().pk().zones().index.call_count)
+
+    def test_find_zone_not_found(self):
+        self.stackpath.stacks().pk().zones().index.return_value = {'zones': []}
+        self.assertRaises(errors.PluginError,
+                          self.stackpath_client.find_zone,
+                          DOMAIN)
+
+    def test_find_zone_listing_zones(self):
+        def zone(zone_id, domain):
+            return pystackpath.util.BaseObject(client=mock.ANY).loaddict({'id': zone_id,
+                                                                          'domain': domain})
+
+        self.stackpath_client.zone_discovery = 'list'
+        self.stackpath.stacks().pk().zones().index.side_effect = [
+            {'zones': [zone('zone1', DOMAIN), zone('zone2', 'other.org')],
+             'pageinfo': pystackpath.util.PageInfo(hasNextPage=True, endCursor='2')},
+            {'zones': [zone('zone3', 'sub.' + DOMAIN)],
+             'pageinfo': pystackpath.util.PageInfo(hasNextPage=False)},
+        ]
+        self.assertEqual('zone1', self.stackpath_client.find_zone('www.' + DOMAIN).id)
+        self.assertEqual('zone3', self.stackpath_client.find_zone('a.sub.' + DOMAIN).id)
+        self.assertRaises(errors.PluginError, self.stackpath_client.find_zone, 'example.net')
+        self.assertEqual(2, self.stackpath.stacks().pk().zones().index.call_count)
+
+
+class _FakeResponse:
+    def __init__(self, data):
+        self.data = data
+        self.status_code = 200
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        pass
+
+
+class _FakeSession:
+    """Stands in for pystackpath's OAuth2Session, recording every API request made."""
+
+    def __init__(self, zones):
+        self.zones = zones
+        self.records = {}  # type: dict
+        self.calls = []  # type: list
+
+    def prepare_request(self, request):
+        return request
+
+    def merge_environment_settings(self, *unused_args):
+        return {}
+
+    def send(self, request):
+        self.calls.append(('POST', request.url))
+        return _FakeResponse({'access_token': 'token123', 'expires_in': 3600})
+
+    def get(self, url, params=None):
+        self.calls.append(('GET', url))
+        params = params or {}
+        if url.endswith('/zones'):
+            name = params.get('page_request.filter', '').split("'")[1]
+            stack = url.split('/stacks/')[1].split('/')[0]
+            zones = [zone for zone in self.zones
+                     if zone['domain'] == name and zone.get('stack', STACK_ID) == stack]
+            return _FakeResponse({'zones': zones, 'pageInfo': {}})
+        if url.endswith('/records'):
+            clauses = re.findall(r'(\w+)="(.*?)"', params.get('page_request.filter', ''))
+            records = [record for record in self.records.values()
+                       if all(str(record.get(key)) == value for key, value in clauses)]
+            start = int(params.get('page_request.after') or 0)
+            end = start + int(params['page_request.first'])
+            return _FakeResponse({'records': records[start:end],
+                                  'pageInfo': {'hasNextPage': end < len(records),
+                                               'endCursor': str(end)}})
+        raise AssertionError(f'Unexpected GET {url}')  # pragma: no cover
+
+    def post(self, url, json=None):
+        self.calls.append(('POST', url))
+        record = dict(json, id=f'record{len(self.records)}')
+        self.records[record['id']] = record
+        return _FakeResponse({'record': record})
+
+    def patch(self, url, json=None):
+        self.calls.append(('PATCH', url))
+        record = self.records.get(url.rsplit('/', 1)[1])
+        if record is None:
+            raise _http_error(404)
+        record.update(json)
+        return _FakeResponse({'record': record})
+
+    def delete(self, url):
+        self.calls.append(('DELETE', url))
+        del self.records[url.rsplit('/', 1)[1]]
+        return _FakeResponse({})
+
+
+class StackPathClientRequestCountTest(unittest.TestCase):
+
+    def setUp(self):
+        from certbot_dns_stackpath._internal.cache import ZoneCache
+        from certbot_dns_stackpath._internal.client import _StackPathClient
+
+        self.stackpath_client = _StackPathClient(CLIENT_ID, CLIENT_SECRET, STACK_ID,
+                                                 zone_cache=ZoneCache(3600))
+        self.session = _FakeSession([{'id': 'zone1', 'domain': DOMAIN}])
+        self.stackpath_client.stackpath.client = self.session
+
+    def test_delete_records_sharing_a_name(self):
+        for content in ('foo', 'bar', 'other'):
+            self.stackpath_client.add_txt_record(DOMAIN, '_acme-challenge.' + DOMAIN, content, 42)
+        del self.session.calls[:]
+
+        self.stackpath_client.del_txt_records(DOMAIN, '_acme-challenge.' + DOMAIN, ['foo', 'bar'])
+        self.assertEqual(['other'], [record['data'] for record in self.session.records.values()])
+        self.assertEqual(['GET', 'DELETE', 'DELETE'], [method for method, _ in self.session.calls])
+
+    def test_add_and_delete(self):
+        self.stackpath_client.add_txt_record(DOMAIN, '_acme-challenge.' + DOMAIN, 'bar', 42)
+        self.assertEqual(['_acme-challenge'],
+                         [record['name'] for record in self.session.records.values()])
+        self.stackpath_client.del_txt_record(DOMAIN, '_acme-challenge.' + DOMAIN, 'bar')
+        self.assertEqual({}, self.session.records)
+
+        # One token request, one zone lookup, the add, then a record lookup and the delete.
+        self.assertEqual(['POST', 'GET', 'POST', 'GET', 'DELETE'],
+                         [method for method, _ in self.session.calls])
+
+    @mock.patch('certbot_dns_stackpath._internal.retry.time.sleep')
+    def test_zone_lookup_error_not_treated_as_missing_zone(self, unused_sleep):
+        self.session.zones.append({'id': 'zone2', 'domain': 'sub.' + DOMAIN})
+        get = self.session.get
+
+        def failing_get(url, params=None):
+            if "'sub." in (params or {}).get('page_request.filter', ''):
+                raise _http_error(503)
+            return get(url, params)
+        self.session.get = failing_get
+
+        with self.assertRaises(errors.PluginError) as context:
+            self.stackpath_client.find_zone('host.sub.' + DOMAIN)
+        self.assertIn('Error looking up zone sub.' + DOMAIN, str(context.exception))
+
+    @mock.patch('certbot_dns_stackpath._internal.retry.time.sleep')
+    def test_add_retried_without_duplicate(self, unused_sleep):
+        post = self.session.post
+
+        def failing_post(url, json=None):
+            # The first attempt creates the record, but its response is lost.
+            self.session.post = post
+            post(url, json)
+            raise _http_error(503)
+        self.session.post = failing_post
+
+        _, record_id = self.stackpath_client.add_txt_record(
+            DOMAIN, '_acme-challenge.' + DOMAIN, 'foo', 42)
+        self.assertEqual([record_id], list(self.session.records))
+
+    def test_update(self):
+        zone, record_id = self.stackpath_client.add_txt_record(
+            DOMAIN, '_acme-challenge.' + DOMAIN, 'foo', 42)
+        del self.session.calls[:]
+
+        self.assertTrue(self.stackpath_client.update_txt_record(zone, record_id, 'bar', 42))
+        self.assertEqual(['bar'], [record['data'] for record in self.session.records.values()])
+        self.assertEqual(['PATCH'], [method for method, _ in self.session.calls])
+
+        self.stackpath_client.del_txt_record_by_id(zone, record_id)
+        self.assertFalse(self.stackpath_client.update_txt_record(zone, record_id, 'bar', 42))
+
+    def test_delete_record_matching_content(self):
+        for content in ('foo', 'bar'):
+            self.stackpath_client.add_txt_record(DOMAIN, '_acme-challenge.' + DOMAIN, content, 42)
+
+        self.stackpath_client.del_txt_record(DOMAIN, '_acme-challenge.' + DOMAIN, 'bar')
+        self.assertEqual(['foo'], [record['data'] for record in self.session.records.values()])
+
+    def test_record_pages_requested_until_found(self):
+        for index in range(6):
+            self.stackpath_client.add_txt_record(DOMAIN, '_acme-challenge.' + DOMAIN,
+                                                 f'content{index}', 42)
+        del self.session.calls[:]
+
+        with mock.patch('certbot_dns_stackpath._internal.client.RECORD_PAGE_SIZE', 2):
+            self.stackpath_client.del_txt_records(DOMAIN, '_acme-challenge.' + DOMAIN,
+                                                  ['content3', 'content0'])
+        self.assertEqual(['GET', 'GET', 'DELETE', 'DELETE'],
+                         [method for method, _ in self.session.calls])
+        self.assertEqual(['content1', 'content2', 'content4', 'content5'],
+                         [record['data'] for record in self.session.records.values()])
+
+    def test_several_stacks(self):
+        from certbot_dns_stackpath._internal.cache import ZoneCache
+        from certbot_dns_stackpath._internal.client import _StackPathClient
+
+        self.session.zones = [{'id': 'zone1', 'domain': DOMAIN, 'stack': 'stack2'},
+                              {'id': 'zone2', 'domain': 'other.org', 'stack': 'stack1'}]
+        self.stackpath_client = _StackPathClient(CLIENT_ID, CLIENT_SECRET, 'stack1, stack2',
+                                                 zone_cache=ZoneCache(3600))
+        self.stackpath_client.stackpath.client = self.session
+
+        zone, _ = self.stackpath_client.add_txt_record(DOMAIN, '_acme-challenge.' + DOMAIN,
+                                                       'bar', 42)
+        self.assertEqual(('zone1', 'stack2'), (zone.id, zone.stack_id))
+        self.assertIn('/stacks/stack2/zones/zone1/records',
+                      [url for method, url in self.session.calls if method == 'POST'][-1])
+        self.assertEqual('stack1', self.stackpath_client.find_zone('other.org').stack_id)
+
+        # Both stacks are searched, once per zone name: the lookups are cached.
+        del self.session.calls[:]
+        self.stackpath_client.find_zone(DOMAIN)
+        self.assertEqual([], self.session.calls)
+
+
+class _FakeAsyncResponse:
+    def __init__(self, status, body=b'', headers=None):
+        self.status = status
+        self.reason = 'OK' if status < 400 else 'Error'
+        self.headers = headers or {}
+        self.url = 'https://gateway.stackpath.com'
+        self.body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *unused_args):
+        pass
+
+    async def read(self):
+        return self.body
+
+
+class _FakeAsyncSession:
+    """Stands in for an aiohttp session, serving the API requests from a `_FakeSession`."""
+
+    def __init__(self, session):
+        self.session = session
+        self.tokens = []  # type: list
+        self.rejected_tokens = set()  # type: set
+        self.errors = []  # type: list
+
+    def request(self, method, url, params=None, headers=None, **kwargs):
+        token = headers['Authorization'].split()[1]
+        self.tokens.append(token)
+        if token in self.rejected_tokens:
+            return _FakeAsyncResponse(401)
+        if self.errors:
+            error = self.errors.pop(0)
+            if isinstance(error, Exception):
+                raise error
+            if isinstance(error, bytes):
+                return _FakeAsyncResponse(200, error)
+            self.session.calls.append((method, url))
+            return _FakeAsyncResponse(error, headers={'Retry-After': '0'})
+        try:
+            if method == 'GET':
+                response = self.session.get(url, params=params)
+            elif method == 'DELETE':
+                response = self.session.delete(url)
+            else:
+                response = getattr(self.session, method.lower())(url, json=kwargs['json'])
+        except requests.HTTPError as e:
+            return _FakeAsyncResponse(e.response.status_code)
+        return _FakeAsyncResponse(200, json.dumps(response.json()).encode())
+
+    async def close(self):
+        pass
+
+
+class AsyncStackPathClientTest(test_util.TempDirTestCase):
+
+    def setUp(self):
+        from certbot_dns_stackpath._internal import async_client
+        from certbot_dns_stackpath._internal.cache import ZoneCache
+        from certbot_dns_stackpath._internal.client import _StackPathClient
+
+        super(AsyncStackPathClientTest, self).setUp()
+        if not async_client.available():  # pragma: no cover
+            self.skipTest('aiohttp is not installed')
+        self.stackpath_client = _StackPathClient(CLIENT_ID, CLIENT_SECRET, STACK_ID,
+                                                 zone_cache=ZoneCache(3600))
+        self.session = _FakeSession([{'id': 'zone1', 'domain': DOMAIN}])
+        self.stackpath_client.stackpath.client = self.session
+        self.async_session = _FakeAsyncSession(self.session)
+        self.async_client = async_client.AsyncStackPathClient(self.stackpath_client)
+        self.async_client._session = self.async_session  # pylint: disable=protected-access
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.addCleanup(self._run, self.async_client.close())
+
+    def _run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_add_and_delete(self):
+        zone, record_id = self._run(self.async_client.add_txt_record(
+            DOMAIN, '_acme-challenge.' + DOMAIN, 'bar', 42))
+        self.assertEqual('zone1', zone.id)
+        self.assertEqual([{'name': '_acme-challenge', 'type': 'TXT', 'ttl': 42, 'data': 'bar',
+                           'weight': 0, 'id': record_id}], list(self.session.records.values()))
+
+        self.assertTrue(self._run(self.async_client.del_txt_record_by_id(zone, record_id)))
+        self.assertEqual({}, self.session.records)
+        self.assertEqual(['POST', 'GET', 'POST', 'DELETE'],
+                         [method for method, _ in self.session.calls])
+
+    def test_delete_records_sharing_a_name(self):
+        for content in ('foo', 'bar', 'other'):
+            self._run(self.async_client.add_txt_record(DOMAIN, '_acme-challenge.' + DOMAIN,
+                                                       content, 42))
+        del self.session.calls[:]
+
+        self._run(self.async_client.del_txt_records(DOMAIN, '_acme-challenge.' + DOMAIN,
+                                                    ['foo', 'bar']))
+        self.assertEqual(['other'], [record['data'] for record in self.session.records.values()])
+        self.assertEqual(['GET', 'DELETE', 'DELETE'], [method for method, _ in self.session.calls])
+
+    def test_update_missing_record(self):
+        zone = self._run(self.async_client.find_zone(DOMAIN))
+        self.assertFalse(self._run(self.async_client.update_txt_record(zone, 'gone', 'bar', 42)))
+
+    def test_concurrent_lookups_shared(self):
+        async def find_all():
+            return await asyncio.gather(*[self.async_client.find_zone(DOMAIN)
+                                          for _ in range(5)])
+
+        self.assertEqual({'zone1'}, {zone.id for zone in self._run(find_all())})
+        self.assertEqual(1, len([url for method, url in self.session.calls
+                                 if method == 'GET' and url.endswith('/zones')]))
+
+    def test_zone_lookup_shared_with_other_processes(self):
+        from certbot_dns_stackpath._internal.cache import ZoneCache
+
+        path = os.path.join(self.tempdir, 'zones.json')
+        self.stackpath_client.zone_cache = ZoneCache(3600, path)
+        # Another process looks the zone up after this one loaded the cache.
+        ZoneCache(3600, path).put(DOMAIN, 'zone1', DOMAIN, STACK_ID)
+
+        self.assertEqual('zone1', self._run(self.async_client.find_zone(DOMAIN)).id)
+        self.assertEqual([], self.session.calls)
+
+        # Lookups made by this process are persisted for the others.
+        self.assertEqual('zone1', self._run(self.async_client.find_zone('foo.' + DOMAIN)).id)
+        self.assertEqual(1, len([url for _, url in self.session.calls if url.endswith('/zones')]))
+        self.assertEqual({'zone_id': None, 'domain': None, 'stack_id': None},
+                         {key: value for key, value in ZoneCache(3600, path).get(
+                             'foo.' + DOMAIN).items() if key != 'expires_at'})
+
+    def test_zone_lookup_error(self):
+        self.stackpath_client.retry_policy.max_attempts = 1
+        self.async_session.errors.append(503)
+        with self.assertRaises(errors.PluginError) as cm:
+            self._run(self.async_client.find_zone('foo.' + DOMAIN))
+        self.assertIn('foo.' + DOMAIN, str(cm.exception))
+
+    def test_add_retried_without_duplicate(self):
+        zone = self._run(self.async_client.find_zone(DOMAIN))
+        session = self.session
+
+        def add_then_fail(url, json=None):
+            _FakeSession.post(session, url, json=json)
+            raise _http_error(503)
+
+        self.stackpath_client.retry_policy.backoff = 0
+        with mock.patch.object(session, 'post', side_effect=add_then_fail):
+            _, record_id = self._run(self.async_client.add_txt_record(
+                DOMAIN, '_acme-challenge.' + DOMAIN, 'bar', 42, zone=zone))
+        self.assertEqual([record_id], list(self.session.records))
+
+    def test_token_refreshed_when_rejected(self):
+        self._run(self.async_client.find_zone(DOMAIN))
+        self.async_session.rejected_tokens.add('token123')
+        self.session.send = mock.MagicMock(
+            return_value=_FakeResponse({'access_token': 'token456', 'expires_in': 3600}))
+
+        self._run(self.async_client.find_zone('foo.' + DOMAIN))
+        self.assertEqual(['token123', 'token123', 'token456'], self.async_session.tokens[-3:])
+
+    def test_invalid_response(self):
+        zone = self._run(self.async_client.find_zone(DOMAIN))
+        self.async_session.errors.append(b'<html>Bad gateway</html>')
+        self.assertRaises(errors.PluginError, self._run, self.async_client.add_txt_record(
+            DOMAIN, '_acme-challenge.' + DOMAIN, 'bar', 42, zone=zone))
+
+        self.async_session.errors.append(b'{"zones": {}}')
+        with self.assertRaises(errors.PluginError) as cm:
+            self._run(self.async_client.find_zone('foo.' + DOMAIN))
+        self.assertIn('Unexpected response', str(cm.exception))
+
+    def test_pool_size(self):
+        from certbot_dns_stackpath._internal.async_client import AsyncStackPathClient
+
+        async_client = AsyncStackPathClient(self.stackpath_client, max_connections=4, pool_size=2)
+
+        async def get_limit():
+            try:
+                # _get_session | pylint: disable=protected-access
+                return async_client._get_session().connector.limit
+            finally:
+                await async_client.close()
+
+        self.assertEqual(2, self._run(get_limit()))
+
+    def test_connection_error(self):
+        import aiohttp
+
+        self.stackpath_client.retry_policy.max_attempts = 1
+        self.async_session.errors.append(aiohttp.ClientConnectionError('refused'))
+        self.assertRaises(errors.PluginError, self._run, self.async_client.find_zone(DOMAIN))
+
+
+class ExecutorStackPathClientTest(unittest.TestCase):
+
+    def setUp(self):
+        from certbot_dns_stackpath._internal.async_client import ExecutorStackPathClient
+
+        self.client = mock.MagicMock()
+        self.async_client = ExecutorStackPathClient(self.client, max_connections=2)
+        self.addCleanup(self._run, self.async_client.close())
+
+    def _run(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_add_txt_record(self):
+        self.client.add_txt_record.return_value = ('zone', 'record_id')
+        result = self._run(self.async_client.add_txt_record(DOMAIN, 'foo', 'bar', 42))
+        self.assertEqual(('zone', 'record_id'), result)
+        self.client.add_txt_record.assert_called_once_with(DOMAIN, 'foo', 'bar', 42, zone=None,
+                                                            journal=True)
+
+    def test_error_propagated(self):
+        self.client.find_zone.side_effect = errors.PluginError('not found')
+        self.assertRaises(errors.PluginError, self._run, self.async_client.find_zone(DOMAIN))
+
+
+class PropagationCheckerTest(unittest.TestCase):
+
+    def setUp(self):
+        from certbot_dns_stackpath._internal.propagation import PropagationChecker
+
+        self.checker = PropagationChecker(interval=0.01)
+        self.checker._get_nameservers = mock.MagicMock(  # pylint: disable=protected-access
+            return_value=['192.0.2.1', '192.0.2.2'])
+        self.checker._query_txt = mock.MagicMock()  # pylint: disable=protected-access
+
+    def test_wait_until_visible(self):
+        self.checker._query_txt.side_effect = [  # pylint: disable=protected-access
+            {'value'}, set(),
+            {'value'}, {'value'},
+        ]
+        self.assertTrue(self.checker.wait([(DOMAIN, '_acme-challenge.' + DOMAIN, 'value')], 10))
+        self.assertEqual(4, self.checker._query_txt.call_count)  # pylint: disable=protected-access
+
+    def test_wait_timeout(self):
+        self.checker._query_txt.return_value = set()  # pylint: disable=protected-access
+        self.assertFalse(self.checker.wait([(DOMAIN, '_acme-challenge.' + DOMAIN, 'value')], 0.05))
+
+    def test_wait_records_seen_after(self):
+        polls = collections.Counter()
+
+        def query_txt(unused_address, record_name):
+            polls[record_name] += 1
+            # The www record only reaches the nameservers for the second poll.
+            return {'a', 'b'} if 'www' not in record_name or polls[record_name] > 2 else {'a'}
+        self.checker._query_txt.side_effect = query_txt  # pylint: disable=protected-access
+        records = [(DOMAIN, '_acme-challenge.' + DOMAIN, 'a'),
+                   (DOMAIN, '_acme-challenge.www.' + DOMAIN, 'b')]
+        seen_after = {}  # type: dict
+        self.assertTrue(self.checker.wait(records, 10, seen_after))
+        self.assertLess(seen_after[records[0]], seen_after[records[1]])
+
+
+class PropagationCheckerNameserversTest(unittest.TestCase):
+
+    def setUp(self):
+        from certbot_dns_stackpath._internal import propagation
+
+        if not propagation.available():  # pragma: no cover
+            self.skipTest('dnspython is not installed')
+        self.checker = propagation.PropagationChecker()
+
+    def _resolve(self, failures):
+        import dns.exception
+
+        def resolve(name, rdtype):
+            name = str(name)
+            if (name, rdtype) in failures:
+                raise dns.exception.Timeout()
+            if rdtype == 'NS':
+                return [mock.MagicMock(target=target) for target in ('ns1.', 'ns2.')]
+            return [mock.MagicMock(to_text=mock.MagicMock(return_value=f'192.0.2.{name[2]}'))]
+        return resolve
+
+    def test_failed_nameserver_skipped(self):
+        with mock.patch('dns.resolver.resolve', side_effect=self._resolve({('ns1.', 'A')})):
+            # _get_nameservers | pylint: disable=protected-access
+            self.assertEqual(['192.0.2.2'], self.checker._get_nameservers(DOMAIN))
+
+    def test_failed_lookup_not_cached(self):
+        # _get_nameservers | pylint: disable=protected-access
+        with mock.patch('dns.resolver.resolve', side_effect=self._resolve({(DOMAIN, 'NS')})):
+            self.assertEqual([], self.checker._get_nameservers(DOMAIN))
+        with mock.patch('dns.resolver.resolve', side_effect=self._resolve(set())):
+            self.assertEqual(['192.0.2.1', '192.0.2.2'], self.checker._get_nameservers(DOMAIN))
+
+
+def _http_error(status, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return requests.HTTPError(response=response)
+
+
+@mock.patch('certbot_dns_stackpath._internal.retry.time.sleep')
+class RetryPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        from certbot_dns_stackpath._internal.retry import RetryPolicy
+
+        self.policy = RetryPolicy(max_attempts=3)
+
+    def test_retry_after(self, sleep):
+        func = mock.MagicMock(side_effect=[_http_error(429, {'Retry-After': '7'}), 'ok'])
+        self.assertEqual('ok', self.policy.call(func))
+        sleep.assert_called_once_with(7.0)
+
+    def test_server_error_retried_with_backoff(self, sleep):
+        func = mock.MagicMock(side_effect=[_http_error(503), _http_error(502), 'ok'])
+        self.assertEqual('ok', self.policy.call(func))
+        self.assertEqual(2, sleep.call_count)
+        self.assertLessEqual(sleep.call_args_list[1][0][0], 2 * self.policy.backoff)
+
+    def test_attempts_exhausted(self, unused_sleep):
+        func = mock.MagicMock(side_effect=_http_error(500))
+        self.assertRaises(requests.HTTPError, self.policy.call, func)
+        self.assertEqual(3, func.call_count)
+
+    def test_deadline(self, unused_sleep):
+        self.policy.deadline = 0
+        func = mock.MagicMock(side_effect=_http_error(429, {'Retry-After': '7'}))
+        self.assertRaises(requests.HTTPError, self.policy.call, func)
+        self.assertEqual(1, func.call_count)
+
+    def test_deadline_cuts_timeouts(self, unused_sleep):
+        from certbot_dns_stackpath._internal import retry
+
+        self.policy.deadline = 5
+        remaining = self.policy.call(retry.remaining_time)
+        self.assertTrue(0 < remaining <= 5)
+        self.assertIsNone(retry.remaining_time())
+
+    def test_deadline_abandons_attempt(self, unused_sleep):
+        self.policy.deadline = 0.05
+
+        async def hang():
+            await asyncio.sleep(10)
+
+        loop = asyncio.new_event_loop()
+        try:
+            start = time.monotonic()
+            self.assertRaises(requests.Timeout, loop.run_until_complete,
+                              self.policy.call_async(hang))
+            self.assertLess(time.monotonic() - start, 5)
+        finally:
+            loop.close()
+
+    def test_not_retried(self, unused_sleep):
+        func = mock.MagicMock(side_effect=_http_error(404))
+        self.assertRaises(requests.HTTPError, self.policy.call, func)
+        func = mock.MagicMock(side_effect=_http_error(500))
+        self.assertRaises(requests.HTTPError, self.policy.call, func, idempotent=False)
+        self.assertEqual(1, func.call_count)
+
+    def test_long_retry_after_honoured(self, sleep):
+        func = mock.MagicMock(side_effect=[_http_error(429, {'Retry-After': '120'}), 'ok'])
+        self.assertEqual('ok', self.policy.call(func))
+        sleep.assert_called_once_with(120.0)
+
+    def test_rate_limiter_paused_when_throttled(self, unused_sleep):
+        from certbot_dns_stackpath._internal.retry import RateLimiter
+
+        self.policy.rate_limiter = mock.MagicMock(spec=RateLimiter)
+        func = mock.MagicMock(side_effect=[_http_error(429, {'Retry-After': '3'}), 'ok'])
+        self.policy.call(func)
+        self.policy.rate_limiter.pause.assert_called_once_with(3.0)
+        self.assertEqual(2, self.policy.rate_limiter.acquire.call_count)
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_acquire_waits_for_tokens(self):
+        from certbot_dns_stackpath._internal.retry import RateLimiter
+
+        limiter = RateLimiter(rate=100, burst=2)
+        start = time.monotonic()
+        for _ in range(4):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.015)
+
+
+class SharedRateLimiterTest(test_util.TempDirTestCase):
+
+    def setUp(self):
+        super(SharedRateLimiterTest, self).setUp()
+        self.path = os.path.join(self.tempdir, 'rate-limit.json')
+
+    def test_budget_shared(self):
+        from certbot_dns_stackpath._internal.retry import SharedRateLimiter
+
+        limiters = [SharedRateLimiter(self.path, rate=50, burst=2) for _ in range(2)]
+        start = time.monotonic()
+        for limiter in limiters * 2:
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.03)
+
+    def test_pause_shared(self):
+        from certbot_dns_stackpath._internal.retry import SharedRateLimiter
+
+        SharedRateLimiter(self.path, rate=0).pause(0.05)
+        start = time.monotonic()
+        SharedRateLimiter(self.path, rate=0).acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.03)
+
+    def test_unlimited_calls_not_written(self):
+        from certbot_dns_stackpath._internal.retry import SharedRateLimiter
+
+        limiter = SharedRateLimiter(self.path, rate=0)
+        for _ in range(3):
+            limiter.acquire()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + '.lock'))
+
+
+class MetricsTest(test_util.TempDirTestCase):
+
+    def setUp(self):
+        from certbot_dns_stackpath._internal.metrics import Metrics
+
+        super(MetricsTest, self).setUp()
+        self.metrics = Metrics()
+
+    def test_measure(self):
+        with self.metrics.measure('records.add'):
+            pass
+        with self.assertRaises(requests.HTTPError):
+            with self.metrics.measure('records.add'):
+                raise _http_error(429)
+
+        self.assertEqual([('records.add', '429', 1), ('records.add', 'ok', 1)],
+                         [(entry['operation'], entry['status'], entry['count'])
+                          for entry in self.metrics.summary()])
+
+    def test_write_prometheus(self):
+        self.metrics.record('records.add', 'ok', 0.5)
+        path = os.path.join(self.tempdir, 'stackpath.prom')
+        self.metrics.write(path)
+
+        with open(path) as f:
+            content = f.read()
+        self.assertIn('certbot_dns_stackpath_operations_total'
+                      '{operation="records.add",status="ok"} 1\n', content)
+        self.assertIn('certbot_dns_stackpath_operation_seconds_total'
+                      '{operation="records.add",status="ok"} 0.500000\n', content)
+
+
+class TokenCacheTest(test_util.TempDirTestCase):
+
+    def setUp(self):
+        from certbot_dns_stackpath._internal.cache import TokenCache
+
+        super(TokenCacheTest, self).setUp()
+        self.path = os.path.join(self.tempdir, 'cache', 'tokens.json')
+        self.cache = TokenCache(self.path)
+
+    def test_fetch_reuses_token(self):
+        request_token = mock.MagicMock(return_value=('token123', time.time() + 3600))
+        self.assertEqual('token123', self.cache.fetch(CLIENT_ID, request_token)[0])
+        self.assertEqual('token123', self.cache.fetch(CLIENT_ID, request_token)[0])
+        self.assertEqual(1, request_token.call_count)
+        self.assertTrue(filesystem.check_mode(self.path, 0o600))
+
+    def test_fetch_expired_token(self):
+        self.cache.put(CLIENT_ID, 'old', time.time() + 10)
+        request_token = mock.MagicMock(return_value=('new', time.time() + 3600))
+        self.assertEqual('new', self.cache.fetch(CLIENT_ID, request_token, min_ttl=60)[0])
+
+
+class PropagationHistoryTest(test_util.TempDirTestCase):
+
+    def setUp(self):
+        from certbot_dns_stackpath._internal.cache import PropagationHistory
+
+        super(PropagationHistoryTest, self).setUp()
+        self.history = PropagationHistory(os.path.join(self.tempdir, 'propagation.json'),
+                                          max_samples=10)
+
+    def test_estimate_percentile(self):
+        self.history.record({DOMAIN: 1, 'example.org': 100})
+        for seconds in range(2, 21):
+            self.history.record({DOMAIN: seconds})
+        # Only the last 10 samples, 11 to 20, are kept.
+        self.assertEqual(20, self.history.estimate(DOMAIN, 95))
+        self.assertEqual(15, self.history.estimate(DOMAIN, 50))
+        self.assertEqual(11, self.history.estimate(DOMAIN, 0))
+
+    def test_too_few_samples(self):
+        self.history.record({DOMAIN: 10})
+        self.assertIsNone(self.history.estimate(DOMAIN, 95))
+        self.assertIsNone(self.history.estimate('example.org', 95))
+
+
+class ZoneCacheTest(test_util.TempDirTestCase):
+
+    def test_negative_entries_expire_sooner(self):
+        from certbot_dns_stackpath._internal.cache import ZoneCache
+
+        cache = ZoneCache(3600)
+        cache.put('example.com', 'zone1', 'example.com')
+        cache.put('www.example.com', None, None)
+        with mock.patch('certbot_dns_stackpath._internal.cache.time.time',
+                        return_value=time.time() + ZoneCache.NEGATIVE_TTL + 1):
+            self.assertEqual('zone1', cache.get('example.com')['zone_id'])
+            self.assertIsNone(cache.get('www.example.com'))
+
+    def test_lru_eviction(self):
+        from certbot_dns_stackpath._internal.cache import ZoneCache
+
+        cache = ZoneCache(3600, max_entries=2)
+        cache.put('a.com', 'zone1', 'a.com')
+        cache.put('b.com', 'zone2', 'b.com')
+        cache.get('a.com')
+        cache.put('c.com', 'zone3', 'c.com')
+        self.assertIsNone(cache.get('b.com'))
+        self.assertEqual('zone1', cache.get('a.com')['zone_id'])
+
+    def test_persisted(self):
+        from certbot_dns_stackpath._internal.cache import ZoneCache
+
+        path = os.path.join(self.tempdir, 'zones.json')
+        ZoneCache(3600, path).put('example.com', 'zone1', 'example.com')
+        self.assertEqual('zone1', ZoneCache(3600, path).get('example.com')['zone_id'])
+
+    def test_fetch_shared(self):
+        from certbot_dns_stackpath._internal.cache import ZoneCache
+
+        path = os.path.join(self.tempdir, 'zones.json')
+        caches = [ZoneCache(3600, path) for _ in range(2)]
+        lookup = mock.MagicMock(return_value={'zone_id': 'zone1', 'domain': 'example.com',
+                                              'stack_id': STACK_ID})
+        for cache in caches:
+            self.assertEqual('zone1', cache.fetch('example.com', lookup)['zone_id'])
+        self.assertEqual(1, lookup.call_count)
+
+        self.assertEqual('zone1', caches[1].fetch('example.com', lookup,
+                                                  accept=lambda zone: False)['zone_id'])
+        self.assertEqual(2, lookup.call_count)
+
+    def test_fetch_concurrent_lookups_shared(self):
+        from certbot_dns_stackpath._internal.cache import ZoneCache
+
+        cache = ZoneCache(3600)
+        zone = {'zone_id': 'zone1', 'domain': 'example.com', 'stack_id': STACK_ID}
+        lookup = mock.MagicMock(side_effect=lambda: time.sleep(0.05) or zone)
+        threads = [threading.Thread(target=cache.fetch, args=('example.com', lookup))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, lookup.call_count)
+
+    def test_fetch_failure_not_cached(self):
+        from certbot_dns_stackpath._internal.cache import ZoneCache
+
+        cache = ZoneCache(3600, os.path.join(self.tempdir, 'zones.json'))
+        self.assertIsNone(cache.fetch('example.com', lambda: None))
+        self.assertIsNone(cache.get('example.com'))
+
+
+class RecordJournalTest(test_util.TempDirTestCase):
+
+    def setUp(self):
+        from certbot_dns_stackpath._internal.client import _Zone
+        from certbot_dns_stackpath._internal.journal import RecordJournal
+
+        super(RecordJournalTest, self).setUp()
+        self.zone = _Zone('zone1', DOMAIN, STACK_ID)
+        self.path = os.path.join(self.tempdir, 'dns-stackpath', 'journal.jsonl')
+        self.journal = RecordJournal(self.path)
+
+    def test_pending(self):
+        self.journal.record_added(self.zone, 'record1', '_acme-challenge.' + DOMAIN)
+        self.journal.record_added(self.zone, 'record2', '_acme-challenge.' + DOMAIN)
+        self.journal.record_deleted(self.zone, 'record1')
+
+        self.assertEqual(['record2'], [entry['record_id'] for entry in self.journal.pending()])
+        self.assertTrue(filesystem.check_mode(self.path, 0o600))
+
+    def test_compact(self):
+        self.journal.record_added(self.zone, 'record1', '_acme-challenge.' + DOMAIN)
+        self.journal.record_added(self.zone, 'record2', '_acme-challenge.' + DOMAIN)
+        self.journal.record_deleted(self.zone, 'record1')
+        with open(self.path) as old:
+            self.journal.compact()
+            # Replaced in one rename, not truncated in place.
+            self.assertEqual(3, len(old.readlines()))
+
+        with open(self.path) as f:
+            self.assertEqual(1, len(f.readlines()))
+        self.assertTrue(filesystem.check_mode(self.path, 0o600))
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+        self.journal.record_added(self.zone, 'record3', '_acme-challenge.' + DOMAIN)
+        self.assertEqual(['record2', 'record3'],
+                         [entry['record_id'] for entry in self.journal.pending()])
+
+    def test_corrupt_entry_ignored(self):
+        self.journal.record_added(self.zone, 'record1', '_acme-challenge.' + DOMAIN)
+        with open(self.path, 'a') as f:
+            f.write('{"op": "add", "zone_\n')
+        self.journal.record_added(self.zone, 'record2', '_acme-challenge.' + DOMAIN)
+
+        self.assertEqual(['record1', 'record2'],
+                         [entry['record_id'] for entry in self.journal.pending()])
+
+
+class CleanupQueueTest(test_util.TempDirTestCase):
+
+    def test_queue(self):
+        from certbot_dns_stackpath._internal.client import _Zone
+        from certbot_dns_stackpath._internal.journal import CleanupQueue
+
+        zone = _Zone('zone1', DOMAIN, STACK_ID)
+        queue = CleanupQueue(os.path.join(self.tempdir, 'cleanup-queue.json'))
+        queue.put([(zone, 'record1'), (zone, 'record2')])
+        # Records queued again are only deleted once.
+        queue.put([(zone, 'record1')])
+        self.assertEqual(['record1', 'record2'],
+                         sorted(entry['record_id'] for entry in queue.pending()))
+
+        queue.remove([entry for entry in queue.pending() if entry['record_id'] == 'record1'])
+        self.assertEqual([{'zone_id': 'zone1', 'zone_domain': DOMAIN, 'stack_id': STACK_ID,
+                           'record_id': 'record2'}], queue.pending())
+
+    def test_corrupt_queue_not_saved_over(self):
+        from certbot_dns_stackpath._internal.client import _Zone
+        from certbot_dns_stackpath._internal.journal import CleanupQueue
+
+        path = os.path.join(self.tempdir, 'cleanup-queue.json')
+        with open(path, 'w') as f:
+            f.write('{"zone1/record1": {"zone_id": "zo')
+        queue = CleanupQueue(path)
+        self.assertEqual([], queue.pending())
+
+        queue.put([(_Zone('zone1', DOMAIN, STACK_ID), 'record2')])
+        self.assertEqual(['record2'], [entry['record_id'] for entry in queue.pending()])
+        self.assertTrue(filesystem.check_mode(path, 0o600))
+        # The corrupt queue is kept for inspection.
+        with open(path + '.corrupt') as f:
+            self.assertEqual('{"zone1/record1": {"zone_id": "zo', f.read())
+
+
+class SweepTest(test_util.TempDirTestCase):
+
+    def setUp(self):
+        from certbot_dns_stackpath._internal.client import _StackPathClient
+        from certbot_dns_stackpath._internal.journal import RecordJournal
+
+        super(SweepTest, self).setUp()
+        self.journal = RecordJournal(os.path.join(self.tempdir, 'journal.jsonl'))
+        self.stackpath_client = _StackPathClient(CLIENT_ID, CLIENT_SECRET, STACK_ID,
+                                                 journal=self.journal)
+        self.session = _FakeSession([{'id': 'zone1', 'domain': DOMAIN}])
+        self.stackpath_client.stackpath.client = self.session
+
+    def _sweep(self, *args):
+        from certbot_dns_stackpath._internal.cli import main
+
+        with mock.patch('certbot_dns_stackpath._internal.cli._get_client',
+                        return_value=self.stackpath_client):
+            return main(['sweep', '--credentials', 'unused.ini'] + list(args))
+
+    def test_sweep(self):
+        for content in ('foo', 'bar'):
+            self.stackpath_client.add_txt_record(DOMAIN, '_acme-challenge.' + DOMAIN, content, 42)
+        self.stackpath_client.del_txt_record(DOMAIN, '_acme-challenge.' + DOMAIN, 'foo')
+
+        self.assertEqual(0, self._sweep('--min-age', '3600'))
+        self.assertEqual(1, len(self.session.records))
+
+        self.assertEqual(0, self._sweep('--min-age', '0'))
+        self.assertEqual({}, self.session.records)
+        self.assertEqual([], self.journal.pending())
+
+    def test_sweep_failure(self):
+        self.stackpath_client.add_txt_record(DOMAIN, '_acme-challenge.' + DOMAIN, 'foo', 42)
+        self.session.delete = mock.MagicMock(side_effect=requests.ConnectionError())
+        self.stackpath_client.retry_policy.max_attempts = 1
+
+        self.assertEqual(1, self._sweep('--min-age', '0'))
+        self.assertEqual(1, len(self.journal.pending()))
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        from certbot_dns_stackpath._internal.cache import ZoneCache
+        from certbot_dns_stackpath._internal.client import _StackPathClient
+
+        self.stackpath_client = _StackPathClient(CLIENT_ID, CLIENT_SECRET, STACK_ID,
+                                                 zone_cache=ZoneCache(3600))
+        self.session = _FakeSession([{'id': 'zone1', 'domain': DOMAIN}])
+        self.stackpath_client.stackpath.client = self.session
+
+    def _batch(self, requests):
+        from certbot_dns_stackpath._internal.cli import main
+
+        stdin = io.StringIO(''.join(request + '\n' for request in requests))
+        stdout = io.StringIO()
+        with mock.patch('certbot_dns_stackpath._internal.cli._get_client',
+                        return_value=self.stackpath_client), \
+                mock.patch('sys.stdin', stdin), mock.patch('sys.stdout', stdout):
+            status = main(['batch', '--credentials', 'unused.ini'])
+        return status, [json.loads(line) for line in stdout.getvalue().splitlines()]
+
+    def test_batch(self):
+        names = [f'host{index}.{DOMAIN}' for index in range(20)]
+        status, responses = self._batch(
+            [json.dumps({'action': 'present', 'domain': name, 'validation': 'foo', 'id': name})
+             for name in names])
+
+        self.assertEqual(0, status)
+        self.assertEqual([{'ok': True, 'id': name} for name in names], responses)
+        self.assertEqual(20, len(self.session.records))
+        # One token request for the whole batch, and each candidate zone name is only looked up
+        # once: the names themselves, then example.com.
+        self.assertEqual(1, len([url for _, url in self.session.calls if url.endswith('/token')]))
+        self.assertEqual(21, len([url for _, url in self.session.calls if url.endswith('/zones')]))
+
+    def test_requests_for_a_domain_in_order(self):
+        present = {'action': 'present', 'domain': DOMAIN, 'validation': 'foo'}
+        status, responses = self._batch([json.dumps(present),
+                                         json.dumps(dict(present, action='cleanup'))])
+
+        self.assertEqual(0, status)
+        self.assertEqual([{'ok': True}, {'ok': True}], responses)
+        self.assertEqual({}, self.session.records)
+
+    def test_invalid_requests(self):
+        status, responses = self._batch(['not json', '{"action": "restart"}'])
+
+        self.assertEqual(1, status)
+        self.assertEqual([False, False], [response['ok'] for response in responses])
+
+
+class ChallengeHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        from certbot_dns_stackpath._internal.client import _Zone
+        from certbot_dns_stackpath._internal.daemon import ChallengeHandler
+
+        self.client = mock.MagicMock()
+        self.zone = _Zone('zone1', DOMAIN, STACK_ID)
+        self.client.add_txt_record.return_value = (self.zone, 'record1')
+        self.handler = ChallengeHandler(self.client)
+
+    def test_present_and_cleanup(self):
+        request = {'domain': '*.' + DOMAIN, 'validation': 'abc'}
+        self.assertEqual({'ok': True}, self.handler.handle(dict(request, action='present')))
+        self.client.add_txt_record.assert_called_once_with(DOMAIN, '_acme-challenge.' + DOMAIN,
+                                                           'abc', 120)
+
+        self.assertEqual({'ok': True}, self.handler.handle(dict(request, action='cleanup')))
+        self.client.del_txt_record_by_id.assert_called_once_with(self.zone, 'record1')
+        self.client.del_txt_record.assert_not_called()
+
+    def test_cleanup_unknown(self):
+        self.handler.handle({'action': 'cleanup', 'domain': DOMAIN, 'validation': 'abc'})
+        self.client.del_txt_record.assert_called_once_with(DOMAIN, '_acme-challenge.' + DOMAIN,
+                                                           'abc')
+
+    def test_error(self):
+        self.client.add_txt_record.side_effect = errors.PluginError('failed')
+        self.assertEqual({'ok': False, 'error': 'failed'}, self.handler.handle(
+            {'action': 'present', 'domain': DOMAIN, 'validation': 'abc'}))
+
+    def test_invalid_request(self):
+        for request in ([], {'action': 'remove', 'domain': DOMAIN, 'validation': 'abc'},
+                        {'action': 'present', 'validation': 'abc'}):
+            self.assertFalse(self.handler.handle(request)['ok'])
+        self.client.add_txt_record.assert_not_called()
+
+
+class ChallengeServerTest(test_util.TempDirTestCase):
+
+    def setUp(self):
+        from certbot_dns_stackpath._internal.daemon import ChallengeServer
+
+        super(ChallengeServerTest, self).setUp()
+        self.handler = mock.MagicMock()
+        self.handler.handle.return_value = {'ok': True}
+        self.path = os.path.join(self.tempdir, 'daemon.sock')
+        server = ChallengeServer(self.path, self.handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+    def test_send_request(self):
+        from certbot_dns_stackpath._internal.daemon import send_request
+
+        request = {'action': 'present', 'domain': DOMAIN, 'validation': 'abc'}
+        self.assertEqual({'ok': True}, send_request(self.path, request))
+        self.handler.handle.assert_called_once_with(request)
+        self.assertTrue(filesystem.check_mode(self.path, 0o600))
+
+    def test_already_running(self):
+        from certbot_dns_stackpath._internal.daemon import ChallengeServer
+
+        self.assertRaises(errors.PluginError, ChallengeServer, self.path, self.handler)
+
+    def test_hooks(self):
+        from certbot_dns_stackpath._internal.cli import main
+
+        with mock.patch.dict(os.environ, {'CERTBOT_DOMAIN': DOMAIN, 'CERTBOT_VALIDATION': 'abc'}):
+            self.assertEqual(0, main(['auth-hook', '--socket', self.path,
+                                      '--propagation-seconds', '0']))
+            self.handler.handle.return_value = {'ok': False, 'error': 'failed'}
+            self.assertEqual(1, main(['cleanup-hook', '--socket', self.path]))
+        self.assertEqual(['present', 'cleanup'], [call[0][0]['action']
+                                                  for call in self.handler.handle.call_args_list])
+
+    def test_daemon_not_running(self):
+        from certbot_dns_stackpath._internal.daemon import send_request
+
+        self.assertRaises(errors.PluginError, send_request,
+                          os.path.join(self.tempdir, 'missing.sock'), {})
+
+
+class ImportTest(unittest.TestCase):
+
+    # Generous, to stay reliable on slow machines; importing pystackpath and dnspython
+    # eagerly costs several times the plugin's own modules.
+    BUDGET_MICROSECONDS = 100000
+
+    @unittest.skipIf(sys.version_info < (3, 7), '-X importtime requires Python 3.7')
+    def test_import_time(self):
+        # A fresh interpreter, with what Certbot itself loads before the plugins: Certbot
+        # imports every plugin's entry point on every run, whether the plugin is used or not.
+        code = ('import sys; import certbot.plugins.dns_common; '
+                'import certbot_dns_stackpath._internal.dns_stackpath; '
+                'print(" ".join(sorted(sys.modules)))')
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        modules = process.stdout.decode().split()
+        cumulative = {}
+        for line in process.stderr.decode().splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[1].strip().isdigit():
+                cumulative[fields[2].strip()] = int(fields[1])
+
+        for module in ('pystackpath', 'dns', 'certbot_dns_stackpath._internal.client',
+                       'certbot_dns_stackpath._internal.propagation'):
+            self.assertNotIn(module, modules)
+        self.assertLess(cumulative['certbot_dns_stackpath._internal.dns_stackpath'],
+                        self.BUDGET_MICROSECONDS)
 
 if __name__ == "__main__":
     unittest.main()  # pragma: no cover